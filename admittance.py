@@ -0,0 +1,283 @@
+import copy
+from typing import TYPE_CHECKING, Dict, Tuple
+
+import numpy as np
+
+from context import ICircuitEdge, NodeStore
+
+if TYPE_CHECKING:
+    from graph import Graph
+
+
+class AdmittanceMatrix:
+    """
+    Матрица узловых проводимостей графа в формате CSR (indptr, indices, data), совместимом с scipy.sparse.
+    Строки и столбцы пронумерованы по Graph.numbering(), общий узел в матрицу не входит. Диагональные элементы
+    есть для всех узлов, внедиагональные -- для каждой пары узлов, соединенной ребром.
+    Для каждого ребра запоминаются номера элементов data, в которые оно вносит вклад (карта слотов), и
+    проводимость, учтенная при сборке. Изменение проводимостей ребер переносится в data приращениями без
+    перестроения шаблона; шаблон перестраивается только при изменении состава узлов и блоков ребер графа.
+    """
+
+    # знаки вклада ребра в элементы (i, i), (j, j), (i, j), (j, i)
+    SIGNS = np.array([1.0, 1.0, -1.0, -1.0])
+
+    def __init__(self, graph: "Graph") -> None:
+        self.graph = graph
+        self.version = -1
+        self.order: np.ndarray = np.empty(0, dtype=np.int64)
+        self.indptr: np.ndarray = np.zeros(1, dtype=np.int64)
+        self.indices: np.ndarray = np.empty(0, dtype=np.int64)
+        self.data: np.ndarray = np.empty(0, dtype=np.complex128)
+        self.__row: np.ndarray = np.empty(0, dtype=np.int64)
+        # карта слотов ребер блоков по номеру ребра в графе; -1 -- элемента нет (ребро на общий узел, блок вне графа)
+        self.__slots: np.ndarray = np.empty((0, 4), dtype=np.int64)
+        self.__assembled: np.ndarray = np.empty(0, dtype=np.complex128)
+        # отдельные ребра: концы и проводимость, учтенные при сборке, и слоты
+        self.__looseEdges: Dict[ICircuitEdge, Tuple[int, int, complex, np.ndarray]] = {}
+        self.assemble()
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.order), len(self.order)
+
+    def nnz(self) -> int:
+        return len(self.data)
+
+    def rowOf(self, ids: np.ndarray) -> np.ndarray:
+        """ Номера строк узлов; -1 для общего узла и узлов вне матрицы. """
+        ids = np.asarray(ids, dtype=np.int64)
+        res = np.full(len(ids), -1, dtype=np.int64)
+        inside = ids < len(self.__row)
+        res[inside] = self.__row[ids[inside]]
+        return res
+
+    def assemble(self) -> None:
+        """ Собрать шаблон и значения матрицы заново. """
+        g = self.graph
+        self.version = g.version
+        self.order = g.numbering()
+        n = len(self.order)
+        self.__row = np.full(g.store.size, -1, dtype=np.int64)
+        self.__row[self.order] = np.arange(n)
+
+        blocks = sorted(g.edgeBlocks(), key=lambda b: b.offset)
+        loose = list(g.looseEdges())
+        edgeCount = g.edgeCount()
+        if len(blocks) > 0:
+            # массивы блоков склеиваются целиком, без поблочных вычислений: сборка почти не удерживает GIL и может
+            # идти параллельно с расстановкой нагрузок (pipeline.StepPipeline)
+            src = np.concatenate([b.source for b in blocks])
+            tgt = np.concatenate([b.target for b in blocks])
+            c = np.concatenate([b.re for b in blocks]) + 1j * np.concatenate([b.im for b in blocks])
+            lengths = np.fromiter((len(b.source) for b in blocks), dtype=np.int64, count=len(blocks))
+            offsets = np.fromiter((b.offset for b in blocks), dtype=np.int64, count=len(blocks))
+            starts = np.cumsum(lengths) - lengths
+            edgeIds = np.arange(len(src), dtype=np.int64) + np.repeat(offsets - starts, lengths)
+        else:
+            src = tgt = edgeIds = np.empty(0, dtype=np.int64)
+            c = np.empty(0, dtype=np.complex128)
+        looseSrc = np.array([hash(e.getSourceNode()) for e in loose], dtype=np.int64)
+        looseTgt = np.array([hash(e.getTargetNode()) for e in loose], dtype=np.int64)
+        looseC = np.array([e.c for e in loose], dtype=np.complex128)
+        src = np.concatenate((src, looseSrc))
+        tgt = np.concatenate((tgt, looseTgt))
+        c = np.concatenate((c, looseC))
+
+        i = self.rowOf(src)
+        j = self.rowOf(tgt)
+        if np.any(i[src != NodeStore.GROUND] < 0) or np.any(j[tgt != NodeStore.GROUND] < 0):
+            raise Exception("Ребро графа подключено к узлу, не входящему в граф")
+        m = len(src)
+        # элементы (i, i), (j, j), (i, j), (j, i) каждого ребра; элементы с общим узлом отбрасываются
+        rows = np.stack((i, j, i, j), axis=1)
+        cols = np.stack((i, j, j, i), axis=1)
+        valid = (rows >= 0) & (cols >= 0)
+        # диагональ присутствует для всех узлов
+        diag = np.arange(n, dtype=np.int64)
+        keys = np.concatenate((diag * n + diag, (rows * n + cols)[valid]))
+        pattern, inverse = np.unique(keys, return_inverse=True)
+        slots = np.full((m, 4), -1, dtype=np.int64)
+        slots[valid] = inverse[n:]
+
+        self.indices = pattern % n if n > 0 else pattern
+        self.indptr = np.searchsorted(pattern // max(n, 1), np.arange(n + 1), side="left").astype(np.int64)
+        contributions = (c[:, None] * self.SIGNS[None, :])[valid]
+        self.data = np.zeros(len(pattern), dtype=np.complex128)
+        np.add.at(self.data, slots[valid], contributions)
+
+        nBlockEdges = len(edgeIds)
+        self.__slots = np.full((edgeCount, 4), -1, dtype=np.int64)
+        self.__slots[edgeIds] = slots[:nBlockEdges]
+        self.__assembled = np.zeros(edgeCount, dtype=np.complex128)
+        self.__assembled[edgeIds] = c[:nBlockEdges]
+        self.__looseEdges = {
+            e: (int(s), int(t), complex(cc), slots[nBlockEdges + k])
+            for k, (e, s, t, cc) in enumerate(zip(loose, looseSrc.tolist(), looseTgt.tolist(), looseC.tolist()))
+        }
+
+    def update(self, edgeIds: np.ndarray | None = None) -> None:
+        """
+        Перенести в матрицу текущие проводимости ребер блоков с номерами edgeIds (всех ребер, если не заданы) и
+        отдельных ребер графа. Изменяются только элементы data, в которые вносят вклад изменившиеся ребра. Если
+        состав узлов или блоков графа изменился, матрица собирается заново; пока емкости разделов не меняются,
+        расстановка нагрузок состав графа не меняет (см. Partition).
+        """
+        if self.version != self.graph.version:
+            self.assemble()
+            return
+        if edgeIds is None:
+            edgeIds = np.flatnonzero(np.any(self.__slots >= 0, axis=1))
+        edgeIds = np.asarray(edgeIds, dtype=np.int64)
+        if len(edgeIds) > 0:
+            c = self.graph.conductivities(edgeIds)
+            delta = c - self.__assembled[edgeIds]
+            self.__assembled[edgeIds] = c
+            slots = self.__slots[edgeIds]
+            mask = slots >= 0
+            np.add.at(self.data, slots[mask], (delta[:, None] * self.SIGNS[None, :])[mask])
+        if not self.__updateLooseEdges():
+            self.assemble()
+
+    def fork(self, graph: "Graph") -> "AdmittanceMatrix":
+        """
+        Копия матрицы для копии графа (Graph.fork). Шаблон и карта слотов не изменяются на месте и остаются общими,
+        значения копируются. Копию можно обновлять по графу graph (update), не затрагивая оригинал.
+        """
+        res = copy.copy(self)
+        res.graph = graph
+        res.data = self.data.copy()
+        res.__assembled = self.__assembled.copy()
+        res.__looseEdges = dict(self.__looseEdges)
+        return res
+
+    def toScipy(self):
+        """ Матрица scipy.sparse.csr_matrix, разделяющая массивы с этим объектом. """
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape, copy=False)
+
+    def toDense(self) -> np.ndarray:
+        res = np.zeros(self.shape, dtype=np.complex128)
+        rows = np.repeat(np.arange(len(self.order)), np.diff(self.indptr))
+        res[rows, self.indices] = self.data
+        return res
+
+    def __updateLooseEdges(self) -> bool:
+        """ Учесть изменения отдельных ребер. Возвращает False, если для нового ребра нет элементов в шаблоне. """
+        current = self.graph.looseEdges()
+        for e in [e for e in self.__looseEdges if e not in current]:
+            _, _, c, slots = self.__looseEdges.pop(e)
+            self.__add(slots, -c)
+        for e in current:
+            s, t = hash(e.getSourceNode()), hash(e.getTargetNode())
+            c = e.c
+            known = self.__looseEdges.get(e)
+            if known is not None:
+                if known[0] == s and known[1] == t:
+                    if known[2] != c:
+                        self.__add(known[3], c - known[2])
+                        self.__looseEdges[e] = (s, t, c, known[3])
+                    continue
+                self.__add(known[3], -known[2])
+                del self.__looseEdges[e]
+            slots = self.__findSlots(s, t)
+            if slots is None:
+                return False
+            self.__add(slots, c)
+            self.__looseEdges[e] = (s, t, c, slots)
+        return True
+
+    def __add(self, slots: np.ndarray, c: complex) -> None:
+        mask = slots >= 0
+        self.data[slots[mask]] += c * self.SIGNS[mask]
+
+    def __findSlots(self, s: int, t: int) -> np.ndarray | None:
+        i, j = self.rowOf(np.array([s, t]))
+        if (i < 0 and s != NodeStore.GROUND) or (j < 0 and t != NodeStore.GROUND):
+            return None
+        slots = np.full(4, -1, dtype=np.int64)
+        for k, (r, col) in enumerate(((i, i), (j, j), (i, j), (j, i))):
+            if r < 0 or col < 0:
+                continue
+            start, end = self.indptr[r], self.indptr[r + 1]
+            pos = start + np.searchsorted(self.indices[start:end], col)
+            if pos == end or self.indices[pos] != col:
+                return None
+            slots[k] = pos
+        return slots
+
+
+class ReducedAdmittance:
+    """
+    Матрица узловых проводимостей после исключения части узлов (Router.reducedAdmittance) в том же формате CSR,
+    что и AdmittanceMatrix, поэтому ее можно передать в BandedLU. Строки пронумерованы узлами order; eliminated --
+    исключенные узлы графа. Значения заданы элементами (rows, cols, values), повторы складываются.
+    """
+
+    def __init__(self, order: np.ndarray, rows: np.ndarray, cols: np.ndarray, values: np.ndarray, eliminated: np.ndarray) -> None:
+        self.version = 0
+        self.order = order
+        self.eliminated = eliminated
+        n = len(order)
+        self.__row = np.full(int(np.max(order)) + 1 if n > 0 else 0, -1, dtype=np.int64)
+        self.__row[order] = np.arange(n)
+        diag = np.arange(n, dtype=np.int64)
+        keys = np.concatenate((diag * n + diag, rows * n + cols))
+        pattern, inverse = np.unique(keys, return_inverse=True)
+        self.indices = pattern % n if n > 0 else pattern
+        self.indptr = np.searchsorted(pattern // max(n, 1), np.arange(n + 1), side="left").astype(np.int64)
+        self.data = np.zeros(len(pattern), dtype=np.complex128)
+        np.add.at(self.data, inverse[n:], values)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.order), len(self.order)
+
+    def nnz(self) -> int:
+        return len(self.data)
+
+    def rowOf(self, ids: np.ndarray) -> np.ndarray:
+        """ Номера строк узлов; -1 для общего узла, исключенных узлов и узлов вне матрицы. """
+        ids = np.asarray(ids, dtype=np.int64)
+        res = np.full(len(ids), -1, dtype=np.int64)
+        inside = ids < len(self.__row)
+        res[inside] = self.__row[ids[inside]]
+        return res
+
+    def toDense(self) -> np.ndarray:
+        res = np.zeros(self.shape, dtype=np.complex128)
+        rows = np.repeat(np.arange(len(self.order)), np.diff(self.indptr))
+        res[rows, self.indices] = self.data
+        return res
+
+
+def nodalMatrix(ids: np.ndarray, source: np.ndarray, target: np.ndarray, c: np.ndarray) -> np.ndarray:
+    """
+    Плотная матрица узловых проводимостей ребер (source, target, c) по отсортированным узлам ids. Ребро на общий
+    узел вносит вклад только в диагональ.
+    """
+    y = np.zeros((len(ids), len(ids)), dtype=np.complex128)
+    for a, b, sign in ((source, source, 1), (target, target, 1), (source, target, -1), (target, source, -1)):
+        valid = (a != NodeStore.GROUND) & (b != NodeStore.GROUND)
+        np.add.at(y, (np.searchsorted(ids, a[valid]), np.searchsorted(ids, b[valid])), sign * c[valid])
+    return y
+
+
+def kronReduce(y: np.ndarray, keep: np.ndarray) -> np.ndarray:
+    """
+    Исключение Крона узлов, не отмеченных в маске keep: y_kk - y_ke y_ee^-1 y_ek. Исключаемые узлы, не связанные ни
+    с сохраняемыми узлами, ни с общим узлом (отрезок линии без нагрузок, отсеченный разрывами), делают y_ee
+    вырожденной; на сохраняемые узлы они не влияют, и для них берется решение по методу наименьших квадратов.
+    Если не сохраняется ни один узел, результат пуст.
+    """
+    eliminated = ~keep
+    ykk = y[np.ix_(keep, keep)]
+    if not np.any(eliminated) or not np.any(keep):
+        return ykk
+    yee = y[np.ix_(eliminated, eliminated)]
+    yek = y[np.ix_(eliminated, keep)]
+    try:
+        x = np.linalg.solve(yee, yek)
+    except np.linalg.LinAlgError:
+        x = np.linalg.lstsq(yee, yek, rcond=None)[0]
+    return ykk - y[np.ix_(keep, eliminated)] @ x
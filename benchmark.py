@@ -0,0 +1,196 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from context import AcNetworkDto, ICircuitNode, NodeStore
+from graph import Graph
+from router import Router
+
+
+# удельные сопротивления контактной сети: собственные для линий 1..4 и взаимные, Ом/км
+SELF_Z = [0.2 + 0.6j, 0.2 + 0.6j, 0.25 + 0.7j, 0.25 + 0.7j]
+MUTUAL_Z = 0.05 + 0.3j
+# диапазоны параметров схемы: длина звена КС, км; число путей звена; доля узлов с разрывом
+LINK_LENGTH = (5.0, 15.0)
+TRACK_QTY = (2, 4)
+BREAKING_SHARE = 0.1
+
+
+@dataclass
+class Schema:
+    """ Сгенерированная схема: узлы графа, КС ветвей и длины ветвей, км. """
+    graph: Graph
+    networks: Dict[int, List[AcNetworkDto]]
+    lengths: List[float]
+
+
+def resistivities(trackQty: int) -> Dict[Tuple[int, int], complex]:
+    z = {}
+    for li1 in range(1, trackQty + 1):
+        for li2 in range(li1, trackQty + 1):
+            z[(li1, li2)] = SELF_Z[li1 - 1] if li1 == li2 else MUTUAL_Z / (li2 - li1)
+    return z
+
+
+def generateSchema(nodeCount: int, branches: int = 4, seed: int = 0) -> Schema:
+    """
+    Схема из branches ветвей примерно с nodeCount исходными узлами. Ветвь -- цепочка звеньев КС длиной
+    LINK_LENGTH с числом путей TRACK_QTY; узлы ставятся равномерно по линиям ветви, часть из них -- с разрывом.
+    Длина ветвей растет с числом узлов так, что на километр линии приходится около одного узла.
+    """
+    rng = np.random.default_rng(seed)
+    store = NodeStore(capacity=2 * nodeCount + 1)
+    nodes = []
+    networks: Dict[int, List[AcNetworkDto]] = {}
+    lengths = []
+    perLine = max(nodeCount // (branches * TRACK_QTY[1]), 1)
+    for branchIndex in range(branches):
+        links = []
+        x = 0.0
+        while x < perLine:
+            x += float(rng.uniform(*LINK_LENGTH))
+            trackQty = int(rng.integers(TRACK_QTY[0], TRACK_QTY[1] + 1))
+            links.append(AcNetworkDto(round(x, 3), trackQty, resistivities(trackQty)))
+        # последнее звено ветви несет все пути, чтобы у каждой линии был узел на конце ветви
+        links[-1] = AcNetworkDto(links[-1].coordinate, TRACK_QTY[1], resistivities(TRACK_QTY[1]))
+        networks[branchIndex] = links
+        length = links[-1].coordinate
+        lengths.append(length)
+        for li in range(1, TRACK_QTY[1] + 1):
+            xs = np.append(np.sort(rng.random(perLine - 1) * length), length)
+            breaking = rng.random(perLine) < BREAKING_SHARE
+            nodes.extend(
+                ICircuitNode(10_000 * branchIndex + li, float(xi), bool(b), store=store)
+                for xi, b in zip(xs.tolist(), breaking.tolist())
+            )
+    return Schema(Graph(nodes, store), networks, lengths)
+
+
+def generateSchedule(schema: Schema, trains: int, steps: int, seed: int = 0) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Расписание движения trains поездов за steps шагов (шаг -- одна минута). Поезд идет по пути 1 или 2 своей
+    ветви со скоростью 40..120 км/ч в одну сторону и разворачивается на концах ветви. Координаты -- в метрах.
+    """
+    rng = np.random.default_rng(seed)
+    branch = rng.integers(0, len(schema.lengths), trains)
+    lengths = np.array(schema.lengths)[branch] * 1000
+    start = rng.random(trains) * lengths
+    speed = rng.uniform(40, 120, trains) * 1000 / 60 * rng.choice([-1, 1], trains)
+    trackNumbers = branch * 10_000 + rng.integers(1, 3, trains)
+    schedule = []
+    for step in range(steps):
+        # отражение от концов ветви: x в [0, 2L) сворачивается в [0, L]
+        x = np.mod(start + speed * step, 2 * lengths)
+        x = np.where(x > lengths, 2 * lengths - x, x)
+        schedule.append((x.astype(np.int64), trackNumbers.copy()))
+    return schedule
+
+
+class PhaseTimer:
+    """ Время и пиковая память (tracemalloc) этапов. Память отслеживается, только если tracemalloc запущен. """
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, Dict] = {}
+
+    def measure(self, name: str, fn: Callable[[], object]) -> object:
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        res = fn()
+        seconds = time.perf_counter() - start
+        phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0, "perCall": []})
+        phase["seconds"] += seconds
+        phase["calls"] += 1
+        phase["perCall"].append(seconds)
+        if tracing:
+            _, peak = tracemalloc.get_traced_memory()
+            phase["peakBytes"] = max(phase.get("peakBytes", 0), peak - base)
+        return res
+
+
+def run(
+        nodeCount: int,
+        branches: int = 4,
+        trains: int | None = None,
+        steps: int = 20,
+        seed: int = 0,
+        ordering: str = "coordinate",
+        parallel: str = "serial",
+        memory: bool = True
+) -> Dict:
+    """
+    Прогнать схему из nodeCount узлов: построение разделов, создание ячеек, сборка матрицы проводимостей,
+    затем по шагам расписания -- расстановка нагрузок и перенос изменившихся проводимостей в матрицу.
+    При memory время этапов включает накладные расходы tracemalloc.
+    """
+    schema = generateSchema(nodeCount, branches, seed)
+    if trains is None:
+        trains = max(int(sum(schema.lengths) / 10), 1)
+    schedule = generateSchedule(schema, trains, steps, seed)
+    graph = schema.graph
+    router = Router(graph, schema.networks, ordering=ordering, parallel=parallel)
+    timer = PhaseTimer()
+    if memory:
+        tracemalloc.start()
+    try:
+        timer.measure("buildPartitions", router.buildPartitions)
+        router.planCapacity(schedule)
+        timer.measure("initCells", router.initCells)
+        matrix = timer.measure("assembleMatrix", graph.admittanceMatrix)
+        for x, trackNumbers in schedule:
+            router.dispatchPositions(x, trackNumbers)
+            edgeIds = timer.measure("arrangePayloads", lambda: router.arrangePayloads(True))
+            timer.measure("updateConductivities", lambda: matrix.update(edgeIds))  # type: ignore
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return {
+        "nodes": nodeCount,
+        "branches": branches,
+        "trains": trains,
+        "steps": steps,
+        "graphNodes": len(graph.nodeIds()),
+        "edges": graph.edgeCount(),
+        "phases": timer.phases,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Замеры трассировщика на синтетических схемах")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10_000], help="числа исходных узлов схем")
+    parser.add_argument("--branches", type=int, default=4)
+    parser.add_argument("--trains", type=int, default=None, help="по умолчанию -- один поезд на 10 км ветвей")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ordering", default="coordinate")
+    parser.add_argument("--parallel", default="serial")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="не замерять память (tracemalloc)")
+    parser.add_argument("--out", default="benchmark.json")
+    args = parser.parse_args()
+    results = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "seed": args.seed,
+        "runs": [
+            run(n, args.branches, args.trains, args.steps, args.seed, args.ordering, args.parallel, args.memory)
+            for n in args.sizes
+        ],
+    }
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    for r in results["runs"]:
+        summary = ", ".join(f"{name} {p['seconds']:.3f} s" for name, p in r["phases"].items())
+        print(f"{r['nodes']} nodes ({r['graphNodes']} in graph, {r['edges']} edges): {summary}")
+
+
+if __name__ == "__main__":
+    main()
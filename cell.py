@@ -1,10 +1,21 @@
+from functools import lru_cache
 from itertools import combinations_with_replacement
-from typing import List, Set
+from typing import Dict, List, Tuple
 
-from context import AcNetworkLattice, ICircuitEdge, ICircuitNode, ISchemaPayload, Side
-from graph import Graph
+import numpy as np
+
+import metrics
+from context import AcNetworkLattice, EdgeBlock, EdgeView, ICircuitNode, ISchemaPayload, NodeStore, Side, forked
+from graph import Graph, GraphBuffer
 from network import NetworkSection
-    
+
+
+@lru_cache(maxsize=None)
+def pairIndices(size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Индексы всех сочетаний с повторениями из size узлов по 2. """
+    pairs = np.array(list(combinations_with_replacement(range(size), 2)), dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
 
 class Cell:
     """ Ячейка ТС. """
@@ -16,7 +27,7 @@ class Cell:
             leftSection: NetworkSection,
             rightSection: NetworkSection,
             lattice: AcNetworkLattice,
-            graph: Graph,
+            graph: Graph | GraphBuffer,
             zeroNode: ICircuitNode
     ):
         self.next: "Cell" | None = None
@@ -26,93 +37,177 @@ class Cell:
         self.leftSection = leftSection
         self.rightSection = rightSection
         self.lattice = lattice
-        self.edges: Set[ICircuitEdge] = set()
-        self.__mergeInto(graph, zeroNode)
-    
-    def __mergeInto(self, graph: Graph, zeroNode: ICircuitNode):
-        # Пройти по всем сочетаниям узлов из n по 2, для каждой пары создать ребро и добавить его в граф схемы.
+        self.edgeBlock = self.__mergeInto(graph, zeroNode)
+        self.updateEdgeConductivities()
+
+    @classmethod
+    def restore(
+            cls,
+            xLeft: int,
+            xRight: int,
+            leftSection: NetworkSection,
+            rightSection: NetworkSection,
+            lattice: AcNetworkLattice,
+            edgeBlock: EdgeBlock
+    ) -> "Cell":
+        """ Ячейка с готовым блоком ребер, уже добавленным в граф (восстановление из снимка). """
+        c = cls.__new__(cls)
+        c.next = None
+        c.prev = None
+        c.xLeft = xLeft
+        c.xRight = xRight
+        c.leftSection = leftSection
+        c.rightSection = rightSection
+        c.lattice = lattice
+        c.edgeBlock = edgeBlock
+        return c
+
+    @property
+    def edges(self) -> List[EdgeView]:
+        return self.edgeBlock.views()
+
+    def __mergeInto(self, graph: Graph | GraphBuffer, zeroNode: ICircuitNode) -> EdgeBlock:
+        # Для каждой пары узлов из сочетаний с повторениями по 2 -- ребро; ребро от узла к самому себе замыкается
+        # на общий узел. Ребра ячейки хранятся одним блоком параллельных массивов.
         graph.addNode(zeroNode)
         for n in self.leftSection.nodes + self.rightSection.nodes:
             graph.addNode(n)
-        for i, j in combinations_with_replacement(range(self.leftSection.size() + self.rightSection.size()), 2):
-            # Это не тестировалось, может работать неправильно.
-            n1: ICircuitNode
-            n2: ICircuitNode
-            side1: Side
-            side2: Side
-            li1: int
-            li2: int
-            if i < self.leftSection.size():
-                n1 = self.leftSection.get(i)
-                side1 = Side.Left
-            else:
-                n1 = self.rightSection.get(i - self.leftSection.size())
-                side1 = Side.Right
-            li1 = n1.relativeLineIndex()
-            if j < self.leftSection.size():
-                n2 = self.leftSection.get(j)
-                side2 = Side.Left
-            else:
-                n2 = self.rightSection.get(j - self.leftSection.size())
-                side2 = Side.Right
-            li2 = n2.relativeLineIndex()
-            e = ICircuitEdge.createWithCond(self.lattice.cond(li1, side1, li2, side2, self.xRight - self.xLeft))
-            graph.addEdge(n1, n2 if n2 != n1 else zeroNode, e)
-            self.edges.add(e)
+        store = self.leftSection.store
+        ids = np.concatenate((self.leftSection.ids, self.rightSection.ids))
+        i, j = pairIndices(len(ids))
+        nLeft = self.leftSection.size()
+        lines = store.lineIndex[ids] % 10_000
+        sides = np.where(np.arange(len(ids)) < nLeft, Side.Left.value, Side.Right.value)
+        block = EdgeBlock(
+            ids[i], np.where(i == j, NodeStore.GROUND, ids[j]), lines[i], sides[i], lines[j], sides[j], store
+        )
+        graph.addEdgeBlock(block)
+        return block
+
+    def fork(self, memo: Dict[int, object], store: NodeStore) -> "Cell":
+        """
+        Копия ячейки для сценария (см. Router.fork): сечения, решетка и блок ребер берутся из memo, где копии общих
+        объектов создаются один раз. Ссылки на соседей восстанавливает раздел.
+        """
+        return Cell.restore(
+            self.xLeft,
+            self.xRight,
+            forked(memo, self.leftSection, lambda: self.leftSection.fork(store)),
+            forked(memo, self.rightSection, lambda: self.rightSection.fork(store)),
+            forked(memo, self.lattice, self.lattice.fork),
+            forked(memo, self.edgeBlock, lambda: self.edgeBlock.fork(store))
+        )
+
+    def __getstate__(self) -> dict:
+        # соседние ячейки не сериализуются: иначе длинная цепочка переполняет стек pickle. Связи восстанавливает раздел.
+        state = dict(self.__dict__)
+        state["next"] = None
+        state["prev"] = None
+        return state
+
+    def rewire(self, leftSection: NetworkSection, rightSection: NetworkSection) -> None:
+        """ Переключить ребра ячейки на другие сечения с тем же составом линий (при изменении длины цепочки). """
+        self.leftSection = leftSection
+        self.rightSection = rightSection
+        ids = np.concatenate((leftSection.ids, rightSection.ids))
+        i, j = pairIndices(len(ids))
+        self.edgeBlock.setEndpoints(ids[i], np.where(i == j, NodeStore.GROUND, ids[j]))
+
+    def resize(self, xLeft: int, xRight: int) -> bool:
+        """
+        Задать границы ячейки, не перемещая узлы сечений. Проводимости пересчитываются, только если границы
+        изменились. Возвращает признак пересчета.
+        """
+        if self.xLeft == xLeft and self.xRight == xRight:
+            return False
+        self.xLeft = xLeft
+        self.xRight = xRight
+        self.updateEdgeConductivities()
+        return True
 
     def pullRightSection(self, destPoint: int) -> None:
         """ Притянуть ячейку за правое сечение в заданную точку. """
         if not destPoint == self.xRight:
-            destPoint = round(destPoint, 3)
-            self.xRight = destPoint
-            for n in self.rightSection:
-                n.x = destPoint
-            if destPoint < self.xLeft:
-                self.xLeft = destPoint
-                for n in self.leftSection:
-                    n.x = destPoint
-                if self.prev is not None:
-                    self.prev.pullRightSection(destPoint)
-            self.__updateEdgeConductivities()
-            if self.next is not None:
-                self.next.pullLeftSection(destPoint)
+            Cell.__pull(self, self.next, destPoint)
 
     def pullLeftSection(self, destPoint: int) -> None:
         """ Притянуть ячейку за левое сечение в заданную точку. """
         if not destPoint == self.xLeft:
-            destPoint = round(destPoint, 3)
-            self.xLeft = destPoint
-            for n in self.leftSection:
-                n.x = destPoint
-            if destPoint > self.xRight:
-                self.xRight = destPoint
-                for n in self.rightSection:
-                    n.x = destPoint
-                if self.next is not None:
-                    self.next.pullLeftSection(destPoint)
-            self.__updateEdgeConductivities()
-            if self.prev is not None:
-                self.prev.pullRightSection(destPoint)
-    
+            Cell.__pull(self.prev, self, destPoint)
+
+    @staticmethod
+    def __pull(left: "Cell | None", right: "Cell | None", destPoint: int) -> List["Cell"]:
+        """
+        Переместить границу между ячейками left и right в точку destPoint. Ячейки, через которые перешла граница,
+        стягиваются в эту точку. Все новые границы вычисляются за один проход по цепочке без рекурсии, затем каждая
+        затронутая ячейка пересчитывается один раз.
+        """
+        segment: List[Cell] = []
+        c = left
+        while c is not None:
+            segment.append(c)
+            if c.xLeft <= destPoint:
+                break
+            c = c.prev
+        segment.reverse()
+        c = right
+        while c is not None:
+            segment.append(c)
+            if c.xRight >= destPoint:
+                break
+            c = c.next
+        if metrics.enabled:
+            metrics.count("cell.pulls")
+            metrics.count("cell.cascadeCells", len(segment))
+            metrics.maximum("cell.cascadeDepth", len(segment))
+        bounds = [destPoint if left is None else min(segment[0].xLeft, destPoint)]
+        for c in segment:
+            bounds.append(destPoint if c is not segment[-1] or c.xRight < destPoint else c.xRight)
+        if right is None:
+            bounds[-1] = destPoint
+        return Cell.moveBoundaries(segment, bounds)
+
+    @staticmethod
+    def moveBoundaries(cells: List["Cell"], bounds: List[int]) -> List["Cell"]:
+        """
+        Переместить границы цепочки ячеек в заданные точки. bounds[k] -- новое положение левого сечения k-й ячейки,
+        bounds[-1] -- правого сечения последней. Проводимости пересчитываются один раз для каждой затронутой ячейки.
+        Возвращает затронутые ячейки.
+        """
+        touched = [c for k, c in enumerate(cells) if c.xLeft != bounds[k] or c.xRight != bounds[k + 1]]
+        if len(touched) == 0:
+            return touched
+        if cells[0].xLeft != bounds[0]:
+            cells[0].leftSection.setX(bounds[0])
+        for k, c in enumerate(cells):
+            if c.xRight != bounds[k + 1]:
+                c.rightSection.setX(bounds[k + 1])
+            c.xLeft = bounds[k]
+            c.xRight = bounds[k + 1]
+        for c in touched:
+            c.updateEdgeConductivities()
+        return touched
+
+    def edgeIds(self) -> np.ndarray:
+        """ Номера ребер ячейки в графе. """
+        return np.arange(self.edgeBlock.offset, self.edgeBlock.offset + len(self.edgeBlock))
+
     def getConnectingNode(self, pl: ISchemaPayload) -> ICircuitNode:
-        for lst in self.leftSection, self.rightSection:
-            for n in lst:
-                if n.x == pl.x and pl.trackNumber == n.lineIndex:
-                    return n
+        """ Узел граничного сечения ячейки в точке нагрузки на ее пути. """
+        section = self.leftSection if pl.x == self.xLeft else self.rightSection if pl.x == self.xRight else None
+        if section is not None:
+            ids = section.ids[section.store.lineIndex[section.ids] == pl.trackNumber]
+            if len(ids) > 0:
+                return section.store.node(int(ids[0]))
         raise Exception("Не найден узел для подключения нагрузки")
-    
-    def __updateEdgeConductivities(self):
-        length = self.xRight - self.xLeft
-        for e in self.edges:
-            n1 = e.getSourceNode()
-            n2 = e.getTargetNode()
-            side1 = Side.Left if n1 in self.leftSection else Side.Right
-            side2 = Side.Left if n2 in self.leftSection else Side.Right
-            if n2.lineIndex % 10_000 == 0:
-                e.c = self.lattice.cond(n1.lineIndex, side1, n1.lineIndex, side1, length)
-            elif n1.lineIndex % 10_000 == 0:
-                e.c = self.lattice.cond(n2.lineIndex, side2, n2.lineIndex, side2, length)
-            e.c = self.lattice.cond(n1.lineIndex, side1, n2.lineIndex, side2, length)
+
+    def updateEdgeConductivities(self):
+        """ Пересчитать проводимости всех ребер ячейки по ее текущей длине. """
+        b = self.edgeBlock
+        if metrics.enabled:
+            metrics.count("cell.edgesRecomputed", len(b))
+        length = np.full(len(b), self.xRight - self.xLeft)
+        b.setConductivities(self.lattice.condBatch(b.line1, b.side1, b.line2, b.side2, length))
 
     def __repr__(self) -> str:
         return f"{{left: {{x: {self.xLeft}, section: {self.leftSection}}}, right: {{x: {self.xRight}, section: {self.rightSection}}}}}"
\ No newline at end of file
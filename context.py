@@ -1,6 +1,13 @@
+import copy
+from collections import OrderedDict
+from dataclasses import dataclass
 from enum import Enum
 from functools import total_ordering
-from typing import Dict, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+import metrics
 
 
 MutualResistivities = Dict[Tuple[int, int], complex]
@@ -11,9 +18,252 @@ class Side(Enum):
     Right = 1
 
 
+@dataclass
+class CacheInfo:
+    hits: int
+    misses: int
+    size: int
+    maxSize: int
+
+    @property
+    def hitRatio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
 class AcNetworkLattice:
+    """
+    Решетка проводимостей звена КС.
+    Удельные взаимные сопротивления линий (Ом/км) задаются таблицей MutualResistivities; по ней один раз вычисляется
+    удельная матрица проводимостей 2k-полюсника (k линий, два сечения). Матрица для конкретной длины ячейки получается
+    масштабированием и запоминается в LRU-кэше -- поезда многократно стоят в одних и тех же точках.
+    Без таблицы все проводимости равны 1.
+    """
+
+    MIN_LENGTH = 1  # м; ячейка нулевой длины заменяется отрезком минимальной длины
+
+    def __init__(
+            self,
+            lines: Iterable[int] = (),
+            resistivities: MutualResistivities | None = None,
+            cacheSize: int = 1024
+    ) -> None:
+        self.lines = sorted(lines)
+        self.__cacheSize = cacheSize
+        self.__cache: OrderedDict[int, np.ndarray] = OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+        self.__port: np.ndarray = np.zeros(max(self.lines, default=0) + 1, dtype=np.int64)
+        self.__unitMatrix: np.ndarray | None = None
+        if resistivities is not None:
+            k = len(self.lines)
+            self.__port[self.lines] = np.arange(k)
+            z = np.zeros((k, k), dtype=complex)
+            for (li1, li2), r in resistivities.items():
+                i, j = self.__port[li1], self.__port[li2]
+                z[i, j] = r
+                if (li2, li1) not in resistivities:
+                    z[j, i] = r
+            a = np.linalg.inv(z)
+            y = np.block([[a, -a], [-a, a]])
+            # проводимость ребра между полюсами p и q -- минус взаимная проводимость, ребра на общий узел -- сумма строки
+            c = -y
+            np.fill_diagonal(c, y.sum(axis=1))
+            self.__unitMatrix = c
+
     def cond(self, lineIndex1: int, side1: Side, lineIndex2: int, side2: Side, length: float) -> complex:
-        return 1 + 0j
+        if metrics.enabled:
+            metrics.count("lattice.cond")
+        if self.__unitMatrix is None:
+            return 1 + 0j
+        m = self.__matrix(int(length))
+        k = len(self.lines)
+        return complex(m[self.__port[lineIndex1] + side1.value * k, self.__port[lineIndex2] + side2.value * k])
+
+    def condBatch(
+            self,
+            lineIndex1: np.ndarray,
+            side1: np.ndarray,
+            lineIndex2: np.ndarray,
+            side2: np.ndarray,
+            length: np.ndarray
+    ) -> np.ndarray:
+        """ Проводимости для массива пар (линия, сечение). Сечения заданы значениями Side.value. """
+        if metrics.enabled:
+            metrics.count("lattice.condBatch")
+            metrics.count("lattice.condEdges", len(lineIndex1))
+        if self.__unitMatrix is None:
+            return np.full(len(lineIndex1), 1 + 0j)
+        if len(length) == 0:
+            return np.empty(0, dtype=np.complex128)
+        k = len(self.lines)
+        p = self.__port[lineIndex1] + side1 * k
+        q = self.__port[lineIndex2] + side2 * k
+        lengths, inverse = np.unique(length, return_inverse=True)
+        if len(lengths) == 1:
+            return self.__matrix(int(lengths[0]))[p, q]
+        matrices = np.stack([self.__matrix(int(l)) for l in lengths])
+        return matrices[inverse, p, q]
+
+    def cacheInfo(self) -> CacheInfo:
+        return CacheInfo(self.__hits, self.__misses, len(self.__cache), self.__cacheSize)
+
+    def fork(self) -> "AcNetworkLattice":
+        """ Решетка с той же удельной таблицей и копией кэша; кэши копий изменяются независимо. """
+        res = copy.copy(self)
+        res.__cache = OrderedDict(self.__cache)
+        res.__hits = 0
+        res.__misses = 0
+        return res
+
+    def __matrix(self, length: int) -> np.ndarray:
+        m = self.__cache.get(length)
+        if m is not None:
+            self.__hits += 1
+            self.__cache.move_to_end(length)
+            return m
+        self.__misses += 1
+        m = self.__unitMatrix * (1000 / max(length, self.MIN_LENGTH))  # type: ignore
+        self.__cache[length] = m
+        if len(self.__cache) > self.__cacheSize:
+            self.__cache.popitem(last=False)
+        return m
+
+
+class NodeStore:
+    """
+    Хранилище атрибутов узлов схемы в непрерывных массивах numpy.
+    Узел адресуется целочисленным идентификатором -- индексом в массивах. Идентификатор 0 зарезервирован за общим
+    (базовым) узлом.
+    Копия хранилища (fork) разделяет массивы с оригиналом до первой записи: записывающая сторона сначала копирует
+    массивы. Поэтому все изменения атрибутов идут через методы хранилища (allocate, setX и т. п.).
+    Идентификаторы, возвращенные хранилищу (release), повторно выдаются allocate.
+    """
+
+    GROUND = 0
+
+    def __init__(self, capacity: int = 1024) -> None:
+        capacity = max(capacity, 1)
+        self.size = 0
+        self.lineIndex = np.zeros(capacity, dtype=np.int32)
+        self.x = np.zeros(capacity, dtype=np.int32)
+        self.breaking = np.zeros(capacity, dtype=np.bool_)
+        self.duplicatedBreakingNode = np.zeros(capacity, dtype=np.bool_)
+        self.__shared = False
+        self.__released: List[int] = []
+        self.allocate(0, 0)
+
+    @classmethod
+    def fromArrays(cls, lineIndex: np.ndarray, x: np.ndarray, breaking: np.ndarray, duplicatedBreakingNode: np.ndarray) -> "NodeStore":
+        """ Хранилище поверх готовых массивов (например, отображенных в память). Массивы не копируются. """
+        s = cls.__new__(cls)
+        s.size = len(x)
+        s.lineIndex = lineIndex
+        s.x = x
+        s.breaking = breaking
+        s.duplicatedBreakingNode = duplicatedBreakingNode
+        s.__shared = False
+        s.__released = []
+        return s
+
+    def fork(self) -> "NodeStore":
+        """ Копия хранилища, разделяющая массивы с оригиналом до первой записи в любое из них. """
+        res = NodeStore.fromArrays(self.lineIndex, self.x, self.breaking, self.duplicatedBreakingNode)
+        res.size = self.size
+        res.__released = list(self.__released)
+        res.__shared = True
+        self.__shared = True
+        return res
+
+    def own(self) -> None:
+        """ Скопировать массивы, если они разделяются с другим хранилищем. Вызывается перед каждой записью. """
+        if self.__shared:
+            for name in ("lineIndex", "x", "breaking", "duplicatedBreakingNode"):
+                setattr(self, name, np.array(getattr(self, name)))
+            self.__shared = False
+
+    def setX(self, ids: np.ndarray | int, x: np.ndarray | int) -> None:
+        self.own()
+        self.x[ids] = x
+
+    def setLineIndex(self, ids: np.ndarray | int, lineIndex: np.ndarray | int) -> None:
+        self.own()
+        self.lineIndex[ids] = lineIndex
+
+    def setBreaking(self, ids: np.ndarray | int, breaking: np.ndarray | bool) -> None:
+        self.own()
+        self.breaking[ids] = breaking
+
+    def setDuplicatedBreakingNode(self, ids: np.ndarray | int, duplicated: np.ndarray | bool) -> None:
+        self.own()
+        self.duplicatedBreakingNode[ids] = duplicated
+
+    def allocate(self, lineIndex: int, x: int, breaking: bool = False) -> int:
+        """ Выделить место под новый узел и вернуть его идентификатор; сначала выдаются возвращенные (release). """
+        self.own()
+        if len(self.__released) > 0:
+            i = self.__released.pop()
+        else:
+            if self.size == len(self.x):
+                self.__grow(self.size + 1)
+            i = self.size
+            self.size += 1
+        self.lineIndex[i] = lineIndex
+        self.x[i] = x
+        self.breaking[i] = breaking
+        self.duplicatedBreakingNode[i] = False
+        return i
+
+    def allocateMany(self, lineIndex: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """ Выделить место под группу узлов. Возвращает массив идентификаторов. """
+        self.own()
+        n = len(x)
+        if self.size + n > len(self.x):
+            self.__grow(self.size + n)
+        ids = np.arange(self.size, self.size + n)
+        self.lineIndex[ids] = lineIndex
+        self.x[ids] = x
+        self.breaking[ids] = False
+        self.duplicatedBreakingNode[ids] = False
+        self.size += n
+        return ids
+
+    def release(self, ids: np.ndarray) -> None:
+        """
+        Вернуть идентификаторы узлов, которые больше нигде не используются, для повторного выделения (allocate).
+        Общий узел не возвращается.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        self.__released.extend(ids[ids != NodeStore.GROUND].tolist())
+
+    def copy(self, ids: np.ndarray) -> np.ndarray:
+        """ Создать копии узлов (без признаков разрыва). Возвращает идентификаторы копий. """
+        return self.allocateMany(self.lineIndex[ids], self.x[ids])
+
+    def node(self, id: int) -> "ICircuitNode":
+        """ Получить описатель узла по идентификатору. """
+        return ICircuitNode.handle(self, id)
+
+    def ground(self) -> "ICircuitNode":
+        """ Описатель общего узла. Все ребра на общий узел подключаются к нему, а не к узлам нулевых линий ветвей. """
+        return ICircuitNode.handle(self, NodeStore.GROUND)
+
+    def nodes(self, ids: Iterable[int]) -> List["ICircuitNode"]:
+        return [ICircuitNode.handle(self, int(i)) for i in ids]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __grow(self, minCapacity: int) -> None:
+        capacity = max(minCapacity, 2 * len(self.x))
+        for name in ("lineIndex", "x", "breaking", "duplicatedBreakingNode"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+
+nodeStore = NodeStore()
 
 
 @total_ordering
@@ -23,17 +273,62 @@ class ICircuitNode:
         - Все комплексные числа хранить в примитивных float-ов. Существующие интерфейсы поддержать через свойства.
         - Координату хранить как целое 4-байтовое число со знаком. Единица измерения - м.
         - equal и hashCode остаются как есть сейчас в проекте, отсюда не переносим.
+
+    Сам объект узла -- легкий описатель с идентификатором; атрибуты хранятся в NodeStore.
     """
 
-    def __init__(self, lineIndex: int, axisCoordinate: float, breaking=False) -> None:
-        self.breaking = breaking
-        self.lineIndex = lineIndex
-        self.x = round(axisCoordinate * 1000)
-        self.duplicatedBreakingNode = False
+    __slots__ = ("id", "store", "_key")
+
+    def __init__(self, lineIndex: int, axisCoordinate: float, breaking=False, store: NodeStore | None = None) -> None:
+        self.store = store if store is not None else nodeStore
+        self.id = self.store.allocate(lineIndex, round(axisCoordinate * 1000), breaking)
+        self._key = self.id if lineIndex % 10_000 != 0 else NodeStore.GROUND
 
     @classmethod
-    def createInstance(cls, x: int, branchIndex: int, lineIndex: int) -> "ICircuitNode":
-        return ICircuitNode(branchIndex * 10_000 + lineIndex, 1e-3 * x)
+    def handle(cls, store: NodeStore, id: int) -> "ICircuitNode":
+        """ Описатель уже существующего узла. """
+        n = cls.__new__(cls)
+        n.store = store
+        n.id = id
+        n._key = id if store.lineIndex[id] % 10_000 != 0 else NodeStore.GROUND
+        return n
+
+    @classmethod
+    def createInstance(cls, x: int, branchIndex: int, lineIndex: int, store: NodeStore | None = None) -> "ICircuitNode":
+        return ICircuitNode(branchIndex * 10_000 + lineIndex, 1e-3 * x, store=store)
+
+    @property
+    def lineIndex(self) -> int:
+        return int(self.store.lineIndex[self.id])
+
+    @lineIndex.setter
+    def lineIndex(self, value: int) -> None:
+        self.store.setLineIndex(self.id, value)
+        self._key = self.id if value % 10_000 != 0 else NodeStore.GROUND
+
+    @property
+    def x(self) -> int:
+        return int(self.store.x[self.id])
+
+    @x.setter
+    def x(self, value: int) -> None:
+        self.store.setX(self.id, value)
+
+    @property
+    def breaking(self) -> bool:
+        return bool(self.store.breaking[self.id])
+
+    @breaking.setter
+    def breaking(self, value: bool) -> None:
+        self.store.setBreaking(self.id, value)
+
+    @property
+    def duplicatedBreakingNode(self) -> bool:
+        return bool(self.store.duplicatedBreakingNode[self.id])
+
+    @duplicatedBreakingNode.setter
+    def duplicatedBreakingNode(self, value: bool) -> None:
+        self.store.setDuplicatedBreakingNode(self.id, value)
 
     def branchIndex(self) -> int:
         return self.lineIndex // 10_000
@@ -52,11 +347,10 @@ class ICircuitNode:
         return str(self.x)
 
     def __eq__(self, __value: object) -> bool:
+        # Все узлы нулевой линии отождествляются с общим узлом (_key == 0), остальные сравниваются по идентификатору.
         if not isinstance(__value, ICircuitNode):
             return False
-        if self.relativeLineIndex() == 0:
-            return __value.relativeLineIndex() == 0
-        return id(self) == id(__value) #(self.lineIndex == __value.lineIndex) and (self.x == __value.x) and (self.breaking == __value.breaking) and (self.duplicatedBreakingNode == __value.duplicatedBreakingNode)
+        return self._key == __value._key and self.store is __value.store
 
     def __lt__(self, __value: object) -> bool:
         if not isinstance(__value, ICircuitNode):
@@ -64,13 +358,11 @@ class ICircuitNode:
         return self.x < __value.x
 
     def __hash__(self):
-        if self.relativeLineIndex() == 0:
-            return 0
-        return id(self)
+        return self._key
 
 
 class ICircuitEdge:
-    """ Похожий интерфейс используется в проекте. Изменить способ хранения комплексных величин. """
+    """ Похожий интерфейс используется в проекте. Комплексная проводимость хранится парой float-ов. """
 
     def __init__(self, resistance: complex = 1+0j) -> None:
         self.__source: ICircuitNode | None = None
@@ -81,6 +373,15 @@ class ICircuitEdge:
     def createWithCond(cls, c: complex) -> "ICircuitEdge":
         return ICircuitEdge(1 / c)
 
+    @property
+    def c(self) -> complex:
+        return complex(self.re, self.im)
+
+    @c.setter
+    def c(self, value: complex) -> None:
+        self.re = float(value.real)
+        self.im = float(value.imag)
+
     def setConductivity(self, conductivity: float):
         self.c = conductivity
 
@@ -94,24 +395,165 @@ class ICircuitEdge:
             raise Exception("Ребро не было добавлено в граф")
         return self.__target
 
+    def fork(self, store: "NodeStore") -> "ICircuitEdge":
+        """ Копия ребра с той же проводимостью, подключенная к тем же узлам копии хранилища store. """
+        res = copy.copy(self)
+        if self.__source is not None:
+            res.__source = store.node(hash(self.__source))
+        if self.__target is not None:
+            res.__target = store.node(hash(self.__target))
+        return res
+
     def __repr__(self) -> str:
         return f"{self.__source} -> {self.__target}"
 
 
+class EdgeBlock:
+    """
+    Группа ребер в виде параллельных массивов: идентификаторы узлов-концов, индексы линий и сечений (Side.value),
+    действительная и мнимая части проводимости.
+    """
+
+    def __init__(
+            self,
+            source: np.ndarray,
+            target: np.ndarray,
+            line1: np.ndarray,
+            side1: np.ndarray,
+            line2: np.ndarray,
+            side2: np.ndarray,
+            store: NodeStore
+    ) -> None:
+        self.source = np.asarray(source, dtype=np.int64)
+        self.target = np.asarray(target, dtype=np.int64)
+        self.line1 = np.asarray(line1, dtype=np.int32)
+        self.side1 = np.asarray(side1, dtype=np.int8)
+        self.line2 = np.asarray(line2, dtype=np.int32)
+        self.side2 = np.asarray(side2, dtype=np.int8)
+        self.re = np.zeros(len(self.source))
+        self.im = np.zeros(len(self.source))
+        self.store = store
+        self.offset = -1  # номер первого ребра блока в графе; -1 -- блок не добавлен в граф
+        self.__shared = False
+
+    @classmethod
+    def fromArrays(
+            cls,
+            source: np.ndarray,
+            target: np.ndarray,
+            line1: np.ndarray,
+            side1: np.ndarray,
+            line2: np.ndarray,
+            side2: np.ndarray,
+            re: np.ndarray,
+            im: np.ndarray,
+            store: NodeStore,
+            offset: int
+    ) -> "EdgeBlock":
+        """ Блок поверх готовых массивов (например, отображенных в память). Массивы не копируются. """
+        b = cls.__new__(cls)
+        b.source, b.target, b.line1, b.side1, b.line2, b.side2, b.re, b.im = source, target, line1, side1, line2, side2, re, im
+        b.store = store
+        b.offset = offset
+        b.__shared = False
+        return b
+
+    def fork(self, store: NodeStore) -> "EdgeBlock":
+        """ Копия блока, разделяющая массивы с оригиналом до первой записи (см. NodeStore.fork). """
+        res = EdgeBlock.fromArrays(
+            self.source, self.target, self.line1, self.side1, self.line2, self.side2, self.re, self.im, store, self.offset
+        )
+        res.__shared = True
+        self.__shared = True
+        return res
+
+    def own(self) -> None:
+        """ Скопировать массивы, если они разделяются с другим блоком. Вызывается перед каждой записью. """
+        if self.__shared:
+            for name in ("source", "target", "line1", "side1", "line2", "side2", "re", "im"):
+                setattr(self, name, np.array(getattr(self, name)))
+            self.__shared = False
+
+    def conductivities(self) -> np.ndarray:
+        return self.re + 1j * self.im
+
+    def setConductivities(self, c: np.ndarray) -> None:
+        self.own()
+        self.re[:] = c.real
+        self.im[:] = c.imag
+
+    def setEndpoints(self, source: np.ndarray, target: np.ndarray) -> None:
+        """ Переключить ребра на другие узлы. """
+        self.own()
+        self.source[:] = source
+        self.target[:] = target
+
+    def edge(self, slot: int) -> "EdgeView":
+        return EdgeView(self, slot)
+
+    def views(self) -> List["EdgeView"]:
+        return [EdgeView(self, i) for i in range(len(self.source))]
+
+    def __len__(self) -> int:
+        return len(self.source)
+
+
+class EdgeView(ICircuitEdge):
+    """ Ребро из EdgeBlock, представленное интерфейсом ICircuitEdge. """
+
+    def __init__(self, block: EdgeBlock, slot: int) -> None:
+        self.block = block
+        self.slot = slot
+
+    @property
+    def c(self) -> complex:
+        return complex(self.block.re[self.slot], self.block.im[self.slot])
+
+    @c.setter
+    def c(self, value: complex) -> None:
+        self.block.own()
+        self.block.re[self.slot] = value.real
+        self.block.im[self.slot] = value.imag
+
+    def getSourceNode(self) -> ICircuitNode:
+        return self.block.store.node(int(self.block.source[self.slot]))
+
+    def getTargetNode(self) -> ICircuitNode:
+        return self.block.store.node(int(self.block.target[self.slot]))
+
+    def __repr__(self) -> str:
+        return f"{self.getSourceNode()} -> {self.getTargetNode()}"
+
+
 class ISchemaPayload:
     def __init__(self, x: float) -> None:
         self.x: int = round(x * 1000)
         self.trackNumber: int = 1
         self.iplEdge: ICircuitEdge = ICircuitEdge()
 
+    def fork(self, memo: Dict[int, Any], store: "NodeStore") -> "ISchemaPayload":
+        """ Копия нагрузки со своим ребром (копия ребра берется из memo, см. Graph.fork). """
+        res = copy.copy(self)
+        res.iplEdge = forked(memo, self.iplEdge, lambda: self.iplEdge.fork(store))
+        return res
+
     def __repr__(self) -> str:
         return f"{{x: {self.x}, li: {self.trackNumber % 10_000}, br: {self.trackNumber // 10_000}}}"
 
 
+def forked(memo: Dict[int, Any], obj: Any, make: Callable[[], Any]) -> Any:
+    """ Копия obj из memo; при первом обращении создается вызовом make. Сохраняет общие ссылки между копиями. """
+    res = memo.get(id(obj))
+    if res is None:
+        res = memo[id(obj)] = make()
+    return res
+
+
 class AcNetworkDto:
-    def __init__(self, coordinate: float, trackQty: int = 2) -> None:
+    def __init__(self, coordinate: float, trackQty: int = 2, resistivities: MutualResistivities | None = None) -> None:
         self.coordinate = round(coordinate, 3)
         self.trackQty = trackQty
+        self.resistivities = resistivities
 
     def __repr__(self) -> str:
         return f"{{ xRight: {self.coordinate}, trackQty: {self.trackQty}}}"
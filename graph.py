@@ -1,31 +1,415 @@
-from typing import Iterable, Set
+import copy
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple
+import numpy as np
 from matplotlib import pyplot as plt
-from context import ICircuitEdge, ICircuitNode
+import metrics
+from admittance import AdmittanceMatrix
+from context import EdgeBlock, ICircuitEdge, ICircuitNode, NodeStore, forked, nodeStore
 
 
 class Graph:
-    """ Имитирует граф схемы """
+    """
+    Имитирует граф схемы. Узлы хранятся как идентификаторы в NodeStore; общий узел один -- NodeStore.GROUND, узлы
+    нулевых линий ветвей при подключении ребер заменяются на него. Ребра хранятся блоками (EdgeBlock) и по одному
+    (ребра нагрузок); и те и другие удаляются за O(1). Смежность узлов (adjacency) строится по массивам концов
+    ребер при первом запросе после изменения графа.
+    """
 
-    def __init__(self, nodes: Iterable[ICircuitNode]) -> None:
-        self.__nodes: Set[ICircuitNode] = set()
+    def __init__(self, nodes: Iterable[ICircuitNode], store: NodeStore | None = None) -> None:
+        self.store = store if store is not None else nodeStore
+        self.__nodes: Set[int] = set()
         self.__edges: Set[ICircuitEdge] = set()
-        self.__nodesBeforeWiring: Set[ICircuitNode] = set()
+        self.__edgeBlocks: Dict[int, EdgeBlock] = {}
+        self.__edgeCount = 0
+        self.__nodesBeforeWiring: Set[int] = set()
+        self.__numbering: np.ndarray | None = None
+        self.__ordering: Callable[["Graph"], np.ndarray] | None = None
+        # номер версии состава узлов, для которой вычислена нумерация
+        self.__numberedAt = -1
+        self.__nodesVersion = 0
+        self.__admittance: AdmittanceMatrix | None = None
+        self.__blockIndex: Tuple[np.ndarray, np.ndarray, List[EdgeBlock]] = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), [])
+        self.__blockIndexVersion = -1
+        # версия состава отдельных ребер и кэши концов ребер и смежности, построенные для пары версий
+        self.__edgesVersion = 0
+        self.__endpoints: Tuple[np.ndarray, np.ndarray] = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self.__endpointsAt = (-1, -1)
+        self.__adjacency: Tuple[np.ndarray, np.ndarray] = (np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self.__adjacencyAt = (-1, -1)
+        self.__blockAdjacency: Tuple[np.ndarray, np.ndarray] = self.__adjacency
+        self.__blockAdjacencyAt = -1
+        # номер версии состава узлов и блоков ребер; по нему матрица проводимостей определяет, что шаблон устарел
+        self.version = 0
         for n in nodes:
             self.addNode(n)
-            self.__nodesBeforeWiring.add(n)
+            self.__nodesBeforeWiring.add(n.id)
+
+    @classmethod
+    def fromIds(cls, ids: np.ndarray, nodesBeforeWiring: np.ndarray, store: NodeStore) -> "Graph":
+        """ Граф из идентификаторов узлов без создания описателей (восстановление из снимка). """
+        g = cls([], store)
+        g.__nodes.update(ids.tolist())
+        g.__nodesBeforeWiring.update(nodesBeforeWiring.tolist())
+        g.__nodesVersion += 1
+        g.version += 1
+        return g
+
+    def fork(self, store: NodeStore, memo: Dict[int, Any]) -> "Graph":
+        """
+        Копия графа для сценария (см. Router.fork) над копией хранилища store. Множество узлов копируется, отдельные
+        ребра копируются через memo (их же получают копии нагрузок разделов), блоки ребер разделяют массивы с
+        оригиналом до первой записи. Матрица проводимостей строится заново.
+        """
+        g = copy.copy(self)
+        g.store = store
+        g.__nodes = set(self.__nodes)
+        g.__nodesBeforeWiring = set(self.__nodesBeforeWiring)
+        g.__edges = {forked(memo, e, lambda e=e: e.fork(store)) for e in self.__edges}
+        g.__edgeBlocks = {offset: forked(memo, b, lambda b=b: b.fork(store)) for offset, b in self.__edgeBlocks.items()}
+        g.__admittance = None
+        g.__blockIndexVersion = -1
+        g.__endpointsAt = g.__adjacencyAt = (-1, -1)
+        g.__blockAdjacencyAt = -1
+        return g
 
     def nodes(self) -> Set[ICircuitNode]:
-        return self.__nodes
+        return set(self.store.nodes(self.__nodes))
+
+    def nodeIds(self) -> np.ndarray:
+        """ Идентификаторы узлов графа. """
+        return np.fromiter(self.__nodes, dtype=np.int64, count=len(self.__nodes))
 
     def addNode(self, node: ICircuitNode) -> None:
         """ Добавить узел """
-        self.__nodes.add(node)
+        # hash узла -- его идентификатор; все узлы нулевой линии отображаются в общий узел
+        key = hash(node)
+        if key not in self.__nodes:
+            self.__nodes.add(key)
+            self.version += 1
+            self.__nodesVersion += 1
+
+    def addNodeIds(self, ids: np.ndarray) -> None:
+        """ Добавить узлы по идентификаторам (узлы не должны принадлежать нулевой линии). """
+        self.__nodes.update(ids.tolist())
+        self.version += 1
+        self.__nodesVersion += 1
+        if metrics.enabled:
+            metrics.count("graph.nodesAdded", len(ids))
+
+    def removeNodeIds(self, ids: np.ndarray) -> None:
+        """ Удалить узлы по идентификаторам. """
+        self.__nodes.difference_update(ids.tolist())
+        self.version += 1
+        self.__nodesVersion += 1
+        if metrics.enabled:
+            metrics.count("graph.nodesRemoved", len(ids))
+
+    def hasNodeIds(self, ids: np.ndarray) -> np.ndarray:
+        """ Маска узлов, входящих в граф. """
+        return np.fromiter((id in self.__nodes for id in ids.tolist()), dtype=bool, count=len(ids))
+
+    def addSchemaNode(self, node: ICircuitNode) -> None:
+        """ Добавить исходный узел схемы -- как если бы он был передан в конструктор (см. Router.addNode). """
+        self.addNode(node)
+        self.__nodesBeforeWiring.add(node.id)
+
+    def removeSchemaNodeIds(self, ids: np.ndarray) -> None:
+        """ Удалить исходные узлы схемы из графа. """
+        self.removeNodeIds(ids)
+        self.__nodesBeforeWiring.difference_update(ids.tolist())
+
+    def isSchemaNode(self, ids: np.ndarray) -> np.ndarray:
+        """ Маска исходных узлов схемы. """
+        return np.fromiter((id in self.__nodesBeforeWiring for id in ids.tolist()), dtype=bool, count=len(ids))
+
+    def ground(self) -> ICircuitNode:
+        return self.store.ground()
 
     def addEdge(self, src: ICircuitNode, tgt: ICircuitNode, edge: ICircuitEdge) -> None:
-        """ Добавить ребро """
-        edge._ICircuitEdge__source = src  # type: ignore
-        edge._ICircuitEdge__target = tgt  # type: ignore
+        """ Добавить ребро. Ребро, уже входящее в граф, переподключается к новым концам. """
+        edge._ICircuitEdge__source = src if hash(src) != NodeStore.GROUND else self.store.ground()  # type: ignore
+        edge._ICircuitEdge__target = tgt if hash(tgt) != NodeStore.GROUND else self.store.ground()  # type: ignore
         self.__edges.add(edge)
+        self.__edgesVersion += 1
+        if metrics.enabled:
+            metrics.count("graph.edgesAdded")
+
+    def removeEdge(self, edge: ICircuitEdge) -> None:
+        """ Удалить отдельное ребро. """
+        try:
+            self.__edges.remove(edge)
+        except KeyError:
+            raise Exception("Ребро не входит в граф")
+        self.__edgesVersion += 1
+        if metrics.enabled:
+            metrics.count("graph.edgesRemoved")
+
+    def replaceEdge(self, old: ICircuitEdge, new: ICircuitEdge) -> None:
+        """ Заменить отдельное ребро другим с теми же концами. """
+        self.removeEdge(old)
+        self.addEdge(old.getSourceNode(), old.getTargetNode(), new)
+
+    def addEdgeBlock(self, block: EdgeBlock) -> None:
+        """
+        Добавить группу ребер. Ребрам блока присваиваются номера offset, offset + 1, ... Блок, уже побывавший в графе,
+        сохраняет свои номера.
+        """
+        if block.offset < 0:
+            block.offset = self.__edgeCount
+            self.__edgeCount += len(block)
+        else:
+            self.__edgeCount = max(self.__edgeCount, block.offset + len(block))
+        self.__edgeBlocks[block.offset] = block
+        self.version += 1
+        if metrics.enabled:
+            metrics.count("graph.blocksAdded")
+
+    def removeEdgeBlock(self, block: EdgeBlock) -> None:
+        """ Удалить группу ребер. Номера ребер остаются закрепленными за блоком. """
+        del self.__edgeBlocks[block.offset]
+        self.version += 1
+        if metrics.enabled:
+            metrics.count("graph.blocksRemoved")
+
+    def edgeBlocks(self) -> List[EdgeBlock]:
+        return list(self.__edgeBlocks.values())
+
+    def nodesBeforeWiring(self) -> np.ndarray:
+        """ Идентификаторы узлов, переданных в конструктор. """
+        return np.fromiter(self.__nodesBeforeWiring, dtype=np.int64, count=len(self.__nodesBeforeWiring))
+
+    def snapshot(self, base: "Graph | None" = None, edgeIds: np.ndarray | None = None) -> "Graph":
+        """
+        Копия графа для чтения из других потоков (см. pipeline.StepPipeline); снимок не изменяется. Если base --
+        предыдущий снимок этого графа при той же версии состава, а edgeIds -- номера ребер, проводимости которых
+        могли измениться после него, новый снимок разделяет с base множество узлов, нумерацию и копии
+        неизменившихся блоков; заново копируются только блоки с ребрами edgeIds. Иначе снимок -- Graph.fork.
+        """
+        if base is None or edgeIds is None or base.version != self.version:
+            return self.fork(self.store.fork(), {})
+        g = copy.copy(base)
+        g.store = self.store.fork()
+        g.__edges = set(self.__edges)
+        g.__edgesVersion = self.__edgesVersion
+        g.__admittance = None
+        offsets, lengths, live = self.__blocksByOffset()
+        blocks = dict(base.__edgeBlocks)
+        ordered = list(base.__blocksByOffset()[2])
+        k = np.unique(np.searchsorted(offsets, np.asarray(edgeIds, dtype=np.int64), side="right") - 1)
+        for b in k[k >= 0].tolist():
+            ordered[b] = blocks[live[b].offset] = live[b].fork(g.store)
+        g.__edgeBlocks = blocks
+        g.__blockIndex = (offsets, lengths, ordered)
+        g.__blockIndexVersion = g.version
+        return g
+
+    def __blocksByOffset(self) -> Tuple[np.ndarray, np.ndarray, List[EdgeBlock]]:
+        """ Начальные номера, длины и сами блоки ребер по возрастанию номеров; перестраивается при изменении состава. """
+        if self.__blockIndexVersion != self.version:
+            blocks = sorted(self.__edgeBlocks.values(), key=lambda b: b.offset)
+            offsets = np.array([b.offset for b in blocks], dtype=np.int64)
+            self.__blockIndex = (offsets, np.array([len(b) for b in blocks], dtype=np.int64), blocks)
+            self.__blockIndexVersion = self.version
+        return self.__blockIndex
+
+    def conductivities(self, edgeIds: np.ndarray) -> np.ndarray:
+        """ Проводимости ребер блоков по номерам ребер в графе. """
+        re, im = self.__gather(edgeIds, ("re", "im"))
+        return re + 1j * im
+
+    def edgeEndpoints(self, edgeIds: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Идентификаторы начал и концов ребер блоков по номерам ребер в графе. """
+        source, target = self.__gather(edgeIds, ("source", "target"))
+        return source.astype(np.int64, copy=False), target.astype(np.int64, copy=False)
+
+    def __gather(self, edgeIds: np.ndarray, names: Tuple[str, ...]) -> List[np.ndarray]:
+        """
+        Значения массивов блоков names для ребер edgeIds. Массивы затронутых блоков склеиваются, и значения
+        выбираются одной индексацией: время линейно по числу ребер и не зависит от числа блоков.
+        """
+        edgeIds = np.asarray(edgeIds, dtype=np.int64)
+        if len(edgeIds) == 0:
+            return [np.empty(0, dtype=np.float64 if n in ("re", "im") else np.int64) for n in names]
+        offsets, lengths, blocks = self.__blocksByOffset()
+        # ребра блока занимают номера offset .. offset + len - 1
+        k = np.searchsorted(offsets, edgeIds, side="right") - 1
+        if np.any(k < 0) or np.any(edgeIds - offsets[k] >= lengths[k]):
+            raise Exception("Ребро с таким номером не входит в граф")
+        touched, inverse = np.unique(k, return_inverse=True)
+        chosen = [blocks[b] for b in touched.tolist()]
+        starts = np.cumsum(lengths[touched]) - lengths[touched]
+        pos = starts[inverse] + edgeIds - offsets[k]
+        return [np.concatenate([getattr(b, n) for b in chosen])[pos] for n in names]
+
+    def endpoints(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Идентификаторы начал и концов всех ребер графа: сначала ребра блоков, затем отдельные ребра. """
+        if self.__endpointsAt != (self.version, self.__edgesVersion):
+            blocks = list(self.__edgeBlocks.values())
+            loose = list(self.__edges)
+            src = [b.source for b in blocks] + [np.array([hash(e.getSourceNode()) for e in loose], dtype=np.int64)]
+            tgt = [b.target for b in blocks] + [np.array([hash(e.getTargetNode()) for e in loose], dtype=np.int64)]
+            self.__endpoints = (np.concatenate(src).astype(np.int64, copy=False), np.concatenate(tgt).astype(np.int64, copy=False))
+            self.__endpointsAt = (self.version, self.__edgesVersion)
+        return self.__endpoints
+
+    def adjacency(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Смежность узлов в формате CSR (indptr, indices) по идентификаторам узлов: соседи узла id --
+        indices[indptr[id]:indptr[id + 1]], по одному элементу на каждое инцидентное ребро (кратные ребра
+        повторяются). Включает общий узел.
+        Смежность не обновляется по строкам: смежность ребер блоков строится заново сортировкой при изменении
+        состава узлов и блоков (version), а при расстановке нагрузок он меняется только вместе с емкостью
+        разделов (см. Partition). Отдельные ребра нагрузок меняются каждый шаг; их смежность строится отдельно
+        и вливается в строки смежности блоков за линейное время без повторной сортировки.
+        """
+        if self.__adjacencyAt != (self.version, self.__edgesVersion):
+            if self.__blockAdjacencyAt != self.version:
+                src = [b.source for b in self.__edgeBlocks.values()] + [np.empty(0, dtype=np.int64)]
+                tgt = [b.target for b in self.__edgeBlocks.values()] + [np.empty(0, dtype=np.int64)]
+                self.__blockAdjacency = Graph.__csr(np.concatenate(src), np.concatenate(tgt), self.store.size)
+                self.__blockAdjacencyAt = self.version
+            loose = list(self.__edges)
+            if len(loose) == 0:
+                self.__adjacency = self.__blockAdjacency
+            else:
+                src = np.array([hash(e.getSourceNode()) for e in loose], dtype=np.int64)
+                tgt = np.array([hash(e.getTargetNode()) for e in loose], dtype=np.int64)
+                self.__adjacency = Graph.__mergeRows(self.__blockAdjacency, Graph.__csr(src, tgt, self.store.size))
+            self.__adjacencyAt = (self.version, self.__edgesVersion)
+        return self.__adjacency
+
+    @staticmethod
+    def __csr(src: np.ndarray, tgt: np.ndarray, size: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ Смежность ребер src -> tgt в формате CSR по идентификаторам узлов 0 .. size - 1 (и концам ребер). """
+        src = src.astype(np.int64, copy=False)
+        tgt = tgt.astype(np.int64, copy=False)
+        rows = np.concatenate((src, tgt))
+        cols = np.concatenate((tgt, src))
+        order = np.argsort(rows, kind="stable")
+        counts = np.bincount(rows, minlength=size)
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return indptr, cols[order]
+
+    @staticmethod
+    def __mergeRows(a: Tuple[np.ndarray, np.ndarray], b: Tuple[np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """ Сложить две смежности CSR построчно: в каждой строке сначала элементы a, затем b. """
+        n = max(len(a[0]), len(b[0]))
+        ai = np.concatenate((a[0], np.full(n - len(a[0]), a[0][-1], dtype=np.int64)))
+        bi = np.concatenate((b[0], np.full(n - len(b[0]), b[0][-1], dtype=np.int64)))
+        indptr = ai + bi
+        indices = np.empty(indptr[-1], dtype=np.int64)
+        for own, other, values, first in ((ai, bi, a[1], True), (bi, ai, b[1], False)):
+            rows = np.repeat(np.arange(n - 1), np.diff(own))
+            pos = indptr[rows] + np.arange(len(values)) - own[rows]
+            if not first:
+                pos += np.diff(other)[rows]
+            indices[pos] = values
+        return indptr, indices
+
+    def neighbors(self, id: int) -> np.ndarray:
+        """ Идентификаторы соседей узла без повторов. """
+        indptr, indices = self.adjacency()
+        if id + 1 >= len(indptr):
+            return np.empty(0, dtype=np.int64)
+        return np.unique(indices[indptr[id]:indptr[id + 1]])
+
+    def degree(self, id: int) -> int:
+        """ Число ребер, инцидентных узлу. """
+        indptr, _ = self.adjacency()
+        return int(indptr[id + 1] - indptr[id]) if id + 1 < len(indptr) else 0
+
+    def looseEdges(self) -> Set[ICircuitEdge]:
+        """ Ребра, добавленные по одному (не из блоков). """
+        return self.__edges
+
+    def edgeCount(self) -> int:
+        """ Число выданных номеров ребер блоков. """
+        return self.__edgeCount
+
+    def numbering(self) -> np.ndarray:
+        """
+        Нумерация узлов графа без общего узла: i-й элемент -- идентификатор узла с номером i. Нумерация
+        пересчитывается только при изменении состава узлов. Если задан способ нумерации (setOrdering), узлы
+        нумеруются им заново; иначе удаленные узлы выбывают с сохранением порядка остальных, а новые добавляются
+        в конец по возрастанию идентификатора.
+        """
+        if self.__numbering is not None and self.__numberedAt == self.__nodesVersion:
+            return self.__numbering
+        if self.__ordering is not None:
+            self.__numbering = self.__ordering(self)
+        else:
+            ids = self.nodeIds()
+            ids = np.sort(ids[ids != NodeStore.GROUND])
+            if self.__numbering is None:
+                self.__numbering = ids
+            else:
+                kept = self.__numbering[np.isin(self.__numbering, ids)]
+                self.__numbering = np.concatenate((kept, np.setdiff1d(ids, kept)))
+        self.__numberedAt = self.__nodesVersion
+        return self.__numbering
+
+    def setNumbering(self, order: np.ndarray) -> None:
+        """ Задать нумерацию узлов: order -- идентификаторы узлов (без общего) в порядке номеров. """
+        self.__numbering = np.asarray(order, dtype=np.int64)
+        self.__numberedAt = self.__nodesVersion
+        self.version += 1
+
+    def setOrdering(self, ordering: Callable[["Graph"], np.ndarray] | None) -> None:
+        """ Задать способ нумерации узлов (см. ordering.ORDERINGS) и пронумеровать узлы заново. """
+        self.__ordering = ordering
+        self.__numbering = None
+        self.version += 1
+
+    def merge(self, buffer: "GraphBuffer", idMap: np.ndarray | None = None) -> None:
+        """
+        Применить изменения, накопленные в буфере, в порядке их записи. Если задано отображение idMap, идентификаторы
+        узлов буфера (и концов ребер его блоков) заменяются на idMap[id], а блоки переводятся на хранилище графа.
+        Номера ребер новым блокам выдаются здесь, поэтому слияние буферов в одном и том же порядке дает те же номера,
+        что и последовательное построение.
+        """
+        for op, arg in buffer.ops():
+            if op == GraphBuffer.ADD_NODES:
+                ids = arg if idMap is None else idMap[arg]
+                new = [i for i in ids.tolist() if i not in self.__nodes]
+                if len(new) > 0:
+                    self.__nodes.update(new)
+                    self.version += 1
+                    self.__nodesVersion += 1
+            elif op == GraphBuffer.REMOVE_NODES:
+                self.removeNodeIds(arg if idMap is None else idMap[arg])
+            elif op == GraphBuffer.ADD_BLOCK:
+                if idMap is not None and arg.store is not self.store:
+                    arg.setEndpoints(idMap[arg.source], idMap[arg.target])
+                    arg.store = self.store
+                self.addEdgeBlock(arg)
+            elif op == GraphBuffer.REMOVE_BLOCK:
+                self.removeEdgeBlock(arg)
+            elif op == GraphBuffer.REMOVE_EDGE:
+                self.removeEdge(arg)
+            else:
+                src, tgt, edge = arg
+                if idMap is not None:
+                    src, tgt = int(idMap[src]), int(idMap[tgt])
+                self.addEdge(self.store.node(src), self.store.node(tgt), edge)
+
+    def admittanceMatrix(self, edgeIds: np.ndarray | None = None) -> AdmittanceMatrix:
+        """
+        Матрица узловых проводимостей графа. Матрица создается один раз и при следующих вызовах обновляется на
+        месте: переносятся проводимости ребер edgeIds (всех ребер, если не заданы) и отдельных ребер.
+        """
+        if self.__admittance is None:
+            self.__admittance = AdmittanceMatrix(self)
+        else:
+            self.__admittance.update(edgeIds)
+        return self.__admittance
+
+    def edges(self) -> List[ICircuitEdge]:
+        """ Все ребра графа, включая представления ребер из блоков. """
+        res: List[ICircuitEdge] = list(self.__edges)
+        for b in self.__edgeBlocks.values():
+            res.extend(b.views())
+        return res
 
     def plot(self, showZeroNode: bool = False, shift: float = 0.25) -> None:
         """ Разместить узлы и ребра на графике """
@@ -34,7 +418,7 @@ class Graph:
         xxSrc = []
         yySrc = []
         ccSrc = []
-        for n in self.__nodesBeforeWiring:
+        for n in self.store.nodes(self.__nodesBeforeWiring):
             c = "red" if n.breaking else "black"
             ccSrc.append(c)
             xxSrc.append(n.axisCoordinate())
@@ -44,21 +428,21 @@ class Graph:
         xx = []
         yy = []
         cc = []
-        for n in self.__nodes:
+        for n in self.store.nodes(self.__nodes):
             if not showZeroNode and n.relativeLineIndex() == 0:
                 continue
             x = n.axisCoordinate() if not n.duplicatedBreakingNode else n.axisCoordinate() + shift
             xx.append(x)
             yy.append(-n.lineIndex)
             c = "blue"
-            if n in self.__nodesBeforeWiring:
+            if n.id in self.__nodesBeforeWiring:
                 c = "black"
             if n.breaking:
                 c = "red"
             cc.append(c)
 
         edges = []
-        for e in self.__edges:
+        for e in self.edges():
             if not showZeroNode and e.getTargetNode().relativeLineIndex() == 0:
                 continue
             n1 = e.getSourceNode()
@@ -76,3 +460,50 @@ class Graph:
             ax.set_yticks([-1, -2, -3], labels=["1-я линия", "2-я линия", "3-я линия"])
         f.tight_layout()
         plt.show()
+
+
+class GraphBuffer:
+    """
+    Журнал изменений графа одной ветви. Повторяет интерфейс изменения Graph (addNode, addNodeIds, removeNodeIds,
+    addEdge, removeEdge, addEdgeBlock, removeEdgeBlock) и только записывает операции; в граф они переносятся методом Graph.merge.
+    Позволяет строить ветви в разных потоках или процессах: у каждой ветви свой буфер, а буферы сливаются в граф
+    в фиксированном порядке.
+    """
+
+    ADD_NODES = 0
+    REMOVE_NODES = 1
+    ADD_BLOCK = 2
+    REMOVE_BLOCK = 3
+    ADD_EDGE = 4
+    REMOVE_EDGE = 5
+
+    def __init__(self, store: NodeStore) -> None:
+        self.store = store
+        self.__ops: List[Tuple[int, object]] = []
+
+    def addNode(self, node: ICircuitNode) -> None:
+        self.__ops.append((GraphBuffer.ADD_NODES, np.array([hash(node)], dtype=np.int64)))
+
+    def addNodeIds(self, ids: np.ndarray) -> None:
+        self.__ops.append((GraphBuffer.ADD_NODES, np.array(ids, dtype=np.int64)))
+
+    def removeNodeIds(self, ids: np.ndarray) -> None:
+        self.__ops.append((GraphBuffer.REMOVE_NODES, np.array(ids, dtype=np.int64)))
+
+    def addEdge(self, src: ICircuitNode, tgt: ICircuitNode, edge: ICircuitEdge) -> None:
+        self.__ops.append((GraphBuffer.ADD_EDGE, (hash(src), hash(tgt), edge)))
+
+    def removeEdge(self, edge: ICircuitEdge) -> None:
+        self.__ops.append((GraphBuffer.REMOVE_EDGE, edge))
+
+    def addEdgeBlock(self, block: EdgeBlock) -> None:
+        self.__ops.append((GraphBuffer.ADD_BLOCK, block))
+
+    def removeEdgeBlock(self, block: EdgeBlock) -> None:
+        self.__ops.append((GraphBuffer.REMOVE_BLOCK, block))
+
+    def ops(self) -> List[Tuple[int, object]]:
+        return self.__ops
+
+    def __len__(self) -> int:
+        return len(self.__ops)
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from typing import AsyncIterable, AsyncIterator, Callable, Dict, Iterator, Tuple
+
+import numpy as np
+
+from router import Router, StepDelta
+
+
+@dataclass
+class Tick:
+    """ Положения всех поездов на момент закрытия тика. trains, x и trackNumbers -- параллельные последовательности. """
+    number: int
+    closedAt: float
+    trains: Tuple[str, ...]
+    x: np.ndarray
+    trackNumbers: np.ndarray
+
+
+@dataclass
+class IngestStats:
+    """
+    Счетчики приема. malformed -- отброшенные сообщения: неразборчивые, без пути или с путем, которого нет в
+    схеме. coalesced -- сообщения, перекрытые более поздним сообщением того же поезда в том же тике;
+    dropped -- тики, вытесненные из очереди более новыми (политика dropOldest). Задержка (lag) -- время от закрытия
+    тика до начала его расстановки, секунды.
+    """
+    messages: int = 0
+    malformed: int = 0
+    coalesced: int = 0
+    ticks: int = 0
+    applied: int = 0
+    dropped: int = 0
+    queueDepth: int = 0
+    maxQueueDepth: int = 0
+    lastLag: float = 0.0
+    maxLag: float = 0.0
+    totalLag: float = 0.0
+    lastApplyTime: float = 0.0
+
+    @property
+    def meanLag(self) -> float:
+        return self.totalLag / self.applied if self.applied > 0 else 0.0
+
+
+def parseMessage(line: bytes | str) -> Tuple[str, int | None, int]:
+    """
+    Разобрать сообщение о положении поезда -- строку JSON {"train": ..., "x": ..., "track": ...}. x -- координата
+    в метрах, track -- номер пути (lineIndex), обязателен. x = null означает, что поезд покинул схему.
+    """
+    msg = json.loads(line)
+    x = msg["x"]
+    return str(msg["train"]), None if x is None else int(x), int(msg["track"])
+
+
+async def tail(path: str, interval: float = 0.1, follow: bool = True) -> AsyncIterator[bytes]:
+    """ Строки файла по мере дописывания. Без follow чтение заканчивается на текущем конце файла. """
+    with open(path, "rb") as f:
+        buffer = b""
+        while True:
+            chunk = f.readline()
+            if chunk:
+                buffer += chunk
+                if buffer.endswith(b"\n"):
+                    yield buffer
+                    buffer = b""
+                continue
+            if not follow:
+                if buffer:
+                    yield buffer
+                return
+            await asyncio.sleep(interval)
+
+
+class PositionIngestor:
+    """
+    Прием положений поездов из потока сообщений (сокет, файл) и расстановка нагрузок трассировщика по тикам.
+    Сообщения одного поезда внутри тика сливаются: учитывается последнее. По истечении тика положения всех
+    поездов ставятся в очередь, и очередной тик расставляется одним инкрементальным шагом Router.simulate в
+    рабочем потоке, не блокируя цикл событий. Трассировщик изменяется только из этого потока, по одному тику.
+    Если расстановка не успевает за потоком, очередь тиков ограничена maxPending:
+      block -- закрытие тика ждет места в очереди, и чтение потока приостанавливается (для сокета это
+               противодавление на отправителя), сообщения продолжают сливаться в открытом тике;
+      dropOldest -- устаревший тик вытесняется из очереди новым. Тик содержит положения всех поездов, поэтому
+               вытеснение теряет только промежуточные состояния.
+    """
+
+    POLICIES = ("block", "dropOldest")
+
+    def __init__(
+            self,
+            router: Router,
+            tick: float = 0.1,
+            maxPending: int = 2,
+            policy: str = "block",
+            onDelta: Callable[[Tick, StepDelta], None] | None = None,
+            parse: Callable[[bytes | str], Tuple[str, int | None, int]] = parseMessage
+    ) -> None:
+        if policy not in PositionIngestor.POLICIES:
+            raise Exception(f"Неизвестная политика очереди тиков: {policy}")
+        if maxPending < 1:
+            raise Exception("Очередь тиков должна вмещать хотя бы один тик")
+        self.router = router
+        self.tick = tick
+        self.maxPending = maxPending
+        self.policy = policy
+        self.onDelta = onDelta
+        self.parse = parse
+        self.stats = IngestStats()
+        self.__positions: Dict[str, Tuple[int, int]] = {}
+        self.__open: Dict[str, Tuple[int, int] | None] = {}
+        self.__step: Tuple[np.ndarray, np.ndarray] = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self.__steps = router.simulate(self.__feed(), incremental=True)
+
+    async def run(self, lines: AsyncIterable[bytes | str]) -> IngestStats:
+        """
+        Принимать сообщения до конца потока, затем расставить последний тик и дождаться очереди. Если расстановка
+        тика или onDelta завершились ошибкой, прием прекращается и ошибка передается из run.
+        """
+        queue: asyncio.Queue[Tick | None] = asyncio.Queue(self.maxPending)
+        readable = asyncio.Event()
+        readable.set()
+        done = asyncio.Event()
+        applier = asyncio.create_task(self.__apply(queue))
+        ticker = asyncio.create_task(self.__tickEvery(queue, readable, done))
+        runner = asyncio.current_task()
+
+        def applied(task: "asyncio.Task[None]") -> None:
+            # прервать ожидание в run (чтение потока, место в очереди) -- иначе при политике block прием ждал бы
+            # освобождения очереди вечно
+            if not task.cancelled() and task.exception() is not None and runner is not None:
+                readable.set()
+                runner.cancel()
+
+        applier.add_done_callback(applied)
+        try:
+            async for line in lines:
+                self.__receive(line)
+                if not readable.is_set():
+                    await readable.wait()
+            done.set()
+            await ticker
+            await self.__close(queue, readable)
+            await queue.put(None)
+            await applier
+        except asyncio.CancelledError:
+            if applier.done() and not applier.cancelled() and applier.exception() is not None:
+                raise applier.exception() from None  # type: ignore
+            raise
+        finally:
+            ticker.cancel()
+            applier.cancel()
+        return self.stats
+
+    def positions(self) -> Dict[str, Tuple[int, int]]:
+        """ Положения поездов (координата, номер пути) по последнему закрытому тику. """
+        return dict(self.__positions)
+
+    def __receive(self, line: bytes | str) -> None:
+        try:
+            train, x, track = self.parse(line)
+        except (ValueError, KeyError, TypeError):
+            self.stats.malformed += 1
+            return
+        if x is not None and not self.__knownTrack(track):
+            self.stats.malformed += 1
+            return
+        self.stats.messages += 1
+        if train in self.__open:
+            self.stats.coalesced += 1
+        self.__open[train] = None if x is None else (x, track)
+
+    def __knownTrack(self, track: int) -> bool:
+        """ Путь есть в схеме трассировщика: ветвь известна, номер линии не больше числа путей ее КС. """
+        branchIndex, li = divmod(track, 10_000)
+        networks = self.router.networks.get(branchIndex)
+        return networks is not None and 1 <= li <= max((n.trackQty for n in networks), default=0)
+
+    async def __tickEvery(self, queue: "asyncio.Queue[Tick | None]", readable: asyncio.Event, done: asyncio.Event) -> None:
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), self.tick)
+            except asyncio.TimeoutError:
+                await self.__close(queue, readable)
+
+    async def __close(self, queue: "asyncio.Queue[Tick | None]", readable: asyncio.Event) -> None:
+        """ Закрыть тик: перенести слитые сообщения в положения поездов и поставить тик в очередь. """
+        if len(self.__open) == 0:
+            return
+        for train, pos in self.__open.items():
+            if pos is None:
+                self.__positions.pop(train, None)
+            else:
+                self.__positions[train] = pos
+        self.__open = {}
+        n = len(self.__positions)
+        t = Tick(
+            self.stats.ticks,
+            time.monotonic(),
+            tuple(self.__positions),
+            np.fromiter((pos[0] for pos in self.__positions.values()), dtype=np.int64, count=n),
+            np.fromiter((pos[1] for pos in self.__positions.values()), dtype=np.int64, count=n)
+        )
+        self.stats.ticks += 1
+        if queue.full() and self.policy == "dropOldest":
+            queue.get_nowait()
+            self.stats.dropped += 1
+        if queue.full():
+            readable.clear()
+            try:
+                await queue.put(t)
+            finally:
+                readable.set()
+        else:
+            queue.put_nowait(t)
+        self.stats.queueDepth = queue.qsize()
+        self.stats.maxQueueDepth = max(self.stats.maxQueueDepth, self.stats.queueDepth)
+
+    async def __apply(self, queue: "asyncio.Queue[Tick | None]") -> None:
+        while True:
+            t = await queue.get()
+            self.stats.queueDepth = queue.qsize()
+            if t is None:
+                return
+            lag = time.monotonic() - t.closedAt
+            self.stats.lastLag = lag
+            self.stats.maxLag = max(self.stats.maxLag, lag)
+            self.stats.totalLag += lag
+            start = time.perf_counter()
+            delta = await asyncio.to_thread(self.__next, t)
+            self.stats.lastApplyTime = time.perf_counter() - start
+            self.stats.applied += 1
+            if self.onDelta is not None:
+                self.onDelta(t, delta)
+
+    def __next(self, t: Tick) -> StepDelta:
+        self.__step = (t.x, t.trackNumbers)
+        return next(self.__steps)
+
+    def __feed(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        # расписание для Router.simulate: очередной шаг -- положения из тика, переданного в __next
+        while True:
+            yield self.__step
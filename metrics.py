@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List
+
+# Счетчики и замеры этапов трассировки. Выключены по умолчанию: места подсчета в горячих циклах проверяют флаг
+# enabled (metrics.enabled) до вызова count/maximum, поэтому без включения затраты -- одно чтение атрибута модуля.
+# Замеры этапов (phase, step) при выключенных метриках возвращают общий пустой контекст.
+# Трасса пишется в формате Chrome Trace Event (JSON), который открывают chrome://tracing, Perfetto и speedscope:
+# этапы -- события "X" с длительностью, значения счетчиков в конце шага -- события "C".
+enabled = False
+
+_lock = threading.Lock()
+_counters: Dict[str, int] = {}
+_maxima: Dict[str, int] = {}
+_phases: Dict[str, List[float]] = {}  # имя -> [число вызовов, секунды]
+_steps: List["StepMetrics"] = []
+_events: List[Dict] | None = None
+_tracePath: str | None = None
+_start = time.perf_counter()
+_NULL = nullcontext()
+
+
+@dataclass
+class StepMetrics:
+    """ Шаг расписания: длительность, приращения счетчиков и время этапов за шаг. """
+    step: int
+    seconds: float
+    counters: Dict[str, int]
+    phases: Dict[str, float]
+
+
+@dataclass
+class MetricsSnapshot:
+    counters: Dict[str, int] = field(default_factory=dict)
+    maxima: Dict[str, int] = field(default_factory=dict)
+    phaseCalls: Dict[str, int] = field(default_factory=dict)
+    phaseSeconds: Dict[str, float] = field(default_factory=dict)
+    steps: List[StepMetrics] = field(default_factory=list)
+
+
+def enable(trace: str | None = None) -> None:
+    """ Включить метрики со сбросом накопленных. trace -- файл трассы, записывается при disable(). """
+    global enabled, _events, _tracePath
+    reset()
+    _tracePath = trace
+    _events = [] if trace is not None else None
+    enabled = True
+
+
+def disable() -> None:
+    """ Выключить метрики и записать трассу, если она велась. Накопленные значения доступны через snapshot(). """
+    global enabled, _events, _tracePath
+    enabled = False
+    if _tracePath is not None and _events is not None:
+        writeTrace(_tracePath)
+    _events = None
+    _tracePath = None
+
+
+def reset() -> None:
+    global _start
+    with _lock:
+        _counters.clear()
+        _maxima.clear()
+        _phases.clear()
+        _steps.clear()
+        if _events is not None:
+            _events.clear()
+        _start = time.perf_counter()
+
+
+def count(name: str, n: int = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def maximum(name: str, value: int) -> None:
+    with _lock:
+        if value > _maxima.get(name, value - 1):
+            _maxima[name] = value
+
+
+def phase(name: str):
+    """ Замер этапа: with metrics.phase("arrangePayloads"): ... """
+    if not enabled:
+        return _NULL
+    return _phase(name)
+
+
+def step(number: int):
+    """ Замер шага расписания: этапы и приращения счетчиков внутри попадают в StepMetrics шага. """
+    if not enabled:
+        return _NULL
+    return _step(number)
+
+
+def snapshot() -> MetricsSnapshot:
+    with _lock:
+        return MetricsSnapshot(
+            dict(_counters),
+            dict(_maxima),
+            {name: int(p[0]) for name, p in _phases.items()},
+            {name: p[1] for name, p in _phases.items()},
+            list(_steps)
+        )
+
+
+def writeTrace(path: str) -> None:
+    """ Записать собранные события трассы в файл формата Chrome Trace Event. """
+    with _lock:
+        events = list(_events) if _events is not None else []
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _now() -> float:
+    return (time.perf_counter() - _start) * 1e6
+
+
+@contextmanager
+def _phase(name: str) -> Iterator[None]:
+    start = _now()
+    try:
+        yield
+    finally:
+        end = _now()
+        with _lock:
+            p = _phases.setdefault(name, [0, 0.0])
+            p[0] += 1
+            p[1] += (end - start) / 1e6
+            if _events is not None:
+                _events.append({
+                    "name": name, "ph": "X", "ts": start, "dur": end - start, "pid": os.getpid(), "tid": threading.get_ident()
+                })
+
+
+@contextmanager
+def _step(number: int) -> Iterator[None]:
+    with _lock:
+        counters = dict(_counters)
+        phases = {name: p[1] for name, p in _phases.items()}
+    start = _now()
+    try:
+        with _phase("step"):
+            yield
+    finally:
+        end = _now()
+        with _lock:
+            delta = {name: n - counters.get(name, 0) for name, n in _counters.items() if n != counters.get(name, 0)}
+            spent = {name: p[1] - phases.get(name, 0.0) for name, p in _phases.items() if name != "step" and p[1] != phases.get(name, 0.0)}
+            _steps.append(StepMetrics(number, (end - start) / 1e6, delta, spent))
+            if _events is not None:
+                _events.append({"name": "counters", "ph": "C", "ts": end, "pid": os.getpid(), "args": dict(_counters)})
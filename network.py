@@ -1,42 +1,62 @@
+from bisect import bisect_right
 from dataclasses import dataclass
-from typing import Dict, List, Set
+from typing import Iterable, List, Set, Tuple
 import numpy as np
 
-from context import AcNetworkDto, AcNetworkLattice, ICircuitNode
+from context import AcNetworkDto, AcNetworkLattice, ICircuitNode, NodeStore, nodeStore
 
 
 class NetworkSection:
-    def __init__(self, nodes: List[ICircuitNode]) -> None:
-        self.nodes: List[ICircuitNode] = nodes
-        self.__idx = -1
+    """ Сечение ТС. Хранит идентификаторы узлов в NodeStore. """
+
+    def __init__(self, nodes: List[ICircuitNode], store: NodeStore | None = None) -> None:
+        if store is None:
+            store = nodes[0].store if len(nodes) > 0 else nodeStore
+        self.store = store
+        self.ids: np.ndarray = np.array([n.id for n in nodes], dtype=np.int64)
+
+    @classmethod
+    def fromIds(cls, ids: np.ndarray, store: NodeStore) -> "NetworkSection":
+        s = cls.__new__(cls)
+        s.store = store
+        s.ids = np.asarray(ids, dtype=np.int64)
+        return s
+
+    @property
+    def nodes(self) -> List[ICircuitNode]:
+        return self.store.nodes(self.ids)
 
     def size(self):
-        return len(self.nodes)
+        return len(self.ids)
 
     def get(self, idx: int) -> ICircuitNode:
-        return self.nodes[idx]
-    
+        return self.store.node(int(self.ids[idx]))
+
+    def append(self, node: ICircuitNode) -> None:
+        self.ids = np.append(self.ids, node.id)
+
+    def setX(self, x: int) -> None:
+        """ Переместить все узлы сечения в точку x. """
+        self.store.setX(self.ids, x)
+
+    def fork(self, store: NodeStore) -> "NetworkSection":
+        """ Сечение из тех же узлов в другом хранилище (копии хранилища, см. NodeStore.fork). """
+        return NetworkSection.fromIds(self.ids, store)
+
     def deepCopy(self) -> "NetworkSection":
-        cp = NetworkSection([])
-        for n in self.nodes:
-            cp.nodes.append(ICircuitNode.createInstance(n.x, n.branchIndex(), n.relativeLineIndex()))
-        return cp
+        return NetworkSection.fromIds(self.store.copy(self.ids), self.store)
 
-    def __iter__(self):
-        self.__idx = -1
-        return self
+    def __contains__(self, node: object) -> bool:
+        return isinstance(node, ICircuitNode) and node.store is self.store and node.id in self.ids
 
-    def __next__(self) -> ICircuitNode:
-        self.__idx += 1
-        if self.__idx < len(self.nodes):
-            return self.nodes[self.__idx]
-        raise StopIteration
+    def __iter__(self):
+        return iter(self.nodes)
 
     def __repr__(self) -> str:
         return str([n for n in self.nodes])
 
 
-@dataclass
+@dataclass(frozen=True)
 class BranchNetworkChainLink:
     xLeft: int
     xRight: int
@@ -45,53 +65,115 @@ class BranchNetworkChainLink:
 
 
 class BranchNetworkChain:
+    """
+    Неизменяемая цепочка звеньев КС ветви. Поиск звена -- бинарный по отсортированному массиву правых границ, поэтому
+    цепочку можно использовать из нескольких потоков одновременно.
+    Точка x принадлежит звену, для которого xLeft <= x < xRight; правая граница последнего звена принадлежит ему.
+    """
+
     def __init__(self, chainLinks: List[BranchNetworkChainLink]) -> None:
-        self.chainLinks = sorted(chainLinks, key=lambda cl: cl.xRight)
-        self.__idx = 0
+        self.chainLinks: Tuple[BranchNetworkChainLink, ...] = tuple(sorted(chainLinks, key=lambda cl: cl.xRight))
+        self.__xRight: List[int] = [cl.xRight for cl in self.chainLinks]
+        self.xRight: np.ndarray = np.array(self.__xRight, dtype=np.int32)
 
     @classmethod
-    def fromAcNetworkDto(cls, networks: List[AcNetworkDto]) -> "BranchNetworkChain":
-        xLeft = np.iinfo(np.int32).min
+    def fromAcNetworkDto(cls, networks: List[AcNetworkDto], xLeft: int | None = None) -> "BranchNetworkChain":
+        """ xLeft -- левая граница первого звена (по умолчанию звено не ограничено слева). """
+        if xLeft is None:
+            xLeft = int(np.iinfo(np.int32).min)
         chainLinks = []
         for ntw in networks:
             x = ntw.coordinate
             trackQty = ntw.trackQty
             xRight = round(round(x, 3) * 1000)
+            lines = set(range(1, trackQty + 1))
             chainLinks.append(
                 BranchNetworkChainLink(
-                    xLeft, xRight, set(range(1, trackQty + 1)), AcNetworkLattice())
+                    xLeft, xRight, lines, AcNetworkLattice(lines, ntw.resistivities))
             )
             xLeft = xRight
         return BranchNetworkChain(chainLinks)
 
     def findChainLink(self, x: int) -> BranchNetworkChainLink:
-        idx = self.__findIndex(x)
-        if idx is None:
-            raise Exception(f"Точка за границами КС -- {x}")
+        idx = bisect_right(self.__xRight, x)
+        if idx == len(self.__xRight):
+            if x > self.__xRight[-1]:
+                raise Exception(f"Точка за границами КС -- {x}")
+            idx -= 1
         return self.chainLinks[idx]
 
+    def findChainLinks(self, xs: np.ndarray) -> np.ndarray:
+        """ Индексы звеньев для массива координат. """
+        idx = np.searchsorted(self.xRight, xs, side="right")
+        beyond = idx == len(self.xRight)
+        if np.any(beyond):
+            if np.any(xs[beyond] > self.xRight[-1]):
+                raise Exception(f"Точка за границами КС -- {np.max(xs)}")
+            idx[beyond] -= 1
+        return idx
+
     def last(self):
         return self.chainLinks[-1]
 
-    def __findIndex(self, x: int) -> int | None:
-        cl = self.chainLinks[self.__idx]
-        if x == cl.xLeft:
-            return self.__idx - 1
-        elif cl.xRight == x:
-            if self.__idx < len(self.chainLinks) - 1:
-                self.__idx += 1
-            return self.__idx
-        elif x > self.chainLinks[-1].xRight:
-            return None
-        elif x < cl.xLeft:
-            self.__idx -= 1
-            return self.__findIndex(x)
-        elif x > cl.xRight:
-            self.__idx += 1
-            return self.__findIndex(x)
-        else:  # x > cl.xLeft and x < cl.xRight
-            return self.__idx
-
     def __repr__(self) -> str:
         return "_".join(str(cl.xRight) for cl in self.chainLinks)
 
+
+class StreamingChain:
+    """
+    Цепочка звеньев КС ветви, читаемая из отсортированного по координате потока AcNetworkDto по мере обращения к
+    ней (потоковое построение разделов, см. router.NodeStream). Звенья левее точки release отбрасываются.
+    """
+
+    def __init__(self, networks: Iterable[AcNetworkDto]) -> None:
+        self.__networks = iter(networks)
+        self.__links: List[BranchNetworkChainLink] = []
+        self.__xRight: List[int] = []
+        self.__xLeft = int(np.iinfo(np.int32).min)
+        self.exhausted = False
+
+    def readUntil(self, x: int) -> None:
+        """ Прочитать звенья, пока правая граница последнего не окажется правее x. """
+        while not self.exhausted and (len(self.__links) == 0 or self.__xRight[-1] <= x):
+            ntw = next(self.__networks, None)
+            if ntw is None:
+                self.exhausted = True
+                break
+            cl = BranchNetworkChain.fromAcNetworkDto([ntw], self.__xLeft).last()
+            if len(self.__links) > 0 and cl.xRight <= self.__xLeft:
+                raise Exception(f"Звенья КС не упорядочены по координате -- {cl.xRight}")
+            self.__links.append(cl)
+            self.__xRight.append(cl.xRight)
+            self.__xLeft = cl.xRight
+
+    def linkAt(self, x: int) -> BranchNetworkChainLink | None:
+        """ Звено, которому принадлежит точка x, или None, если точка за границами КС. """
+        self.readUntil(x)
+        idx = bisect_right(self.__xRight, x)
+        if idx == len(self.__xRight):
+            if len(self.__xRight) == 0 or x > self.__xRight[-1]:
+                return None
+            idx -= 1
+        return self.__links[idx]
+
+    def findChainLink(self, x: int) -> BranchNetworkChainLink:
+        cl = self.linkAt(x)
+        if cl is None:
+            raise Exception(f"Точка за границами КС -- {x}")
+        return cl
+
+    def release(self, x: int) -> None:
+        """ Отбросить звенья, лежащие левее точки x. Последнее прочитанное звено сохраняется. """
+        k = min(bisect_right(self.__xRight, x), len(self.__links) - 1)
+        if k > 0:
+            del self.__links[:k]
+            del self.__xRight[:k]
+
+    def end(self) -> int | None:
+        """ Правая граница КС, если поток звеньев прочитан до конца. """
+        if self.exhausted and len(self.__xRight) > 0:
+            return self.__xRight[-1]
+        return None
+
+    def __len__(self) -> int:
+        return len(self.__links)
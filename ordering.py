@@ -0,0 +1,147 @@
+from dataclasses import dataclass
+from heapq import heappop, heappush
+from typing import TYPE_CHECKING, Callable, Dict, List, Set, Tuple
+
+import numpy as np
+
+from context import NodeStore
+
+if TYPE_CHECKING:
+    from graph import Graph
+
+
+Ordering = Callable[["Graph"], np.ndarray]
+
+
+@dataclass
+class OrderingReport:
+    """ Характеристики матрицы проводимостей при заданной нумерации узлов и прогноз заполнения ее LU-разложения. """
+    method: str
+    size: int
+    nnz: int
+    bandwidth: int
+    profile: int
+    factorNnz: int  # ненулевые элементы множителя L (с диагональю); U симметричен по структуре
+    fill: int  # элементы L, ненулевые в разложении, но нулевые в исходной матрице
+
+    @property
+    def fillRatio(self) -> float:
+        lower = (self.nnz + self.size) // 2
+        return self.factorNnz / lower if lower > 0 else 0.0
+
+
+def graphNodes(graph: "Graph") -> np.ndarray:
+    """ Идентификаторы узлов графа без общего узла по возрастанию. """
+    ids = graph.nodeIds()
+    return np.sort(ids[ids != NodeStore.GROUND])
+
+
+def adjacency(graph: "Graph", order: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Симметричная структура смежности узлов графа без диагонали и общего узла в формате CSR (indptr, indices).
+    Узел order[k] соответствует строке k.
+    """
+    n = len(order)
+    row = np.full(graph.store.size, -1, dtype=np.int64)
+    row[order] = np.arange(n)
+    src, tgt = graph.endpoints()
+    i = row[src]
+    j = row[tgt]
+    mask = (i >= 0) & (j >= 0) & (i != j)
+    i, j = i[mask], j[mask]
+    keys = np.unique(np.concatenate((i * n + j, j * n + i)))
+    rows = keys // max(n, 1)
+    indptr = np.searchsorted(rows, np.arange(n + 1), side="left").astype(np.int64)
+    return indptr, keys % max(n, 1)
+
+
+def coordinateOrdering(graph: "Graph") -> np.ndarray:
+    """
+    Нумерация по возрастанию координаты (обход enumerateNodes из scattering.ipynb). Обход начинается с соседей
+    общего узла; в графе ТС каждый узел соединен с общим узлом ребром ячейки, поэтому обход с очередью по
+    координате сводится к сортировке узлов всех ветвей по (координата, линия, идентификатор).
+    """
+    ids = graphNodes(graph)
+    store = graph.store
+    return ids[np.lexsort((ids, store.lineIndex[ids], store.x[ids]))]
+
+
+def reverseCuthillMcKeeOrdering(graph: "Graph") -> np.ndarray:
+    """ Обратная нумерация Катхилла -- Макки (scipy.sparse.csgraph), начиная с нумерации по координате. """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+    ids = coordinateOrdering(graph)
+    indptr, indices = adjacency(graph, ids)
+    pattern = csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(len(ids), len(ids)))
+    return ids[reverse_cuthill_mckee(pattern, symmetric_mode=True)]
+
+
+def minimumDegreeOrdering(graph: "Graph") -> np.ndarray:
+    """
+    Нумерация по минимальной степени: следующим исключается узел с наименьшим числом соседей в графе исключения.
+    Степени хранятся в очереди с отложенным удалением устаревших записей; при равных степенях выбирается узел,
+    раньше стоящий в нумерации по координате.
+    """
+    ids = coordinateOrdering(graph)
+    indptr, indices = adjacency(graph, ids)
+    n = len(ids)
+    adj: List[Set[int]] = [set(indices[indptr[k]:indptr[k + 1]].tolist()) for k in range(n)]
+    q = [(len(adj[k]), k) for k in range(n)]
+    q.sort()
+    eliminated = np.zeros(n, dtype=np.bool_)
+    res: List[int] = []
+    while q:
+        d, v = heappop(q)
+        if eliminated[v] or d != len(adj[v]):
+            continue
+        eliminated[v] = True
+        res.append(v)
+        nbrs = adj[v]
+        for u in nbrs:
+            a = adj[u]
+            a.discard(v)
+            a.update(nbrs)
+            a.discard(u)
+            heappush(q, (len(a), u))
+        adj[v] = set()
+    return ids[np.array(res, dtype=np.int64)]
+
+
+ORDERINGS: Dict[str, Ordering] = {
+    "coordinate": coordinateOrdering,
+    "rcm": reverseCuthillMcKeeOrdering,
+    "minimumDegree": minimumDegreeOrdering,
+}
+
+
+def orderingReport(graph: "Graph", order: np.ndarray | None = None, method: str = "") -> OrderingReport:
+    """
+    Ширина ленты, профиль и прогноз заполнения для нумерации order (по умолчанию -- текущей нумерации графа).
+    Структура множителя L вычисляется символьным исключением по дереву исключения: структура столбца -- соседи
+    узла с большими номерами и структуры дочерних столбцов.
+    """
+    if order is None:
+        order = graph.numbering()
+    indptr, indices = adjacency(graph, order)
+    n = len(order)
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    lower = indices < rows
+    bandwidth = int(np.max(rows - indices)) if len(indices) > 0 else 0
+    firstCols = np.arange(n)
+    np.minimum.at(firstCols, rows[lower], indices[lower])
+    profile = int(np.sum(np.arange(n) - firstCols))
+
+    children: List[List[Set[int]]] = [[] for _ in range(n)]
+    factorNnz = n
+    for j in range(n):
+        s = set(indices[indptr[j]:indptr[j + 1]][indices[indptr[j]:indptr[j + 1]] > j].tolist())
+        for cs in children[j]:
+            s |= cs
+        children[j] = []
+        s.discard(j)
+        factorNnz += len(s)
+        if s:
+            children[min(s)].append(s)
+    nnz = len(indices) + n
+    return OrderingReport(method, n, nnz, bandwidth, profile, factorNnz, factorNnz - (len(indices) // 2 + n))
@@ -1,13 +1,33 @@
-from typing import List, Set, Tuple
+import copy
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Set, Tuple
+import numpy as np
+import metrics
+from admittance import kronReduce, nodalMatrix
 from cell import Cell
 
-from context import AcNetworkLattice, ICircuitNode, ISchemaPayload
-from graph import Graph
+from context import AcNetworkLattice, ICircuitEdge, ICircuitNode, ISchemaPayload, NodeStore, forked
+from graph import Graph, GraphBuffer
 from network import NetworkSection
 
 
+@dataclass
+class Equivalent:
+    """ Многополюсник: матрица узловых проводимостей y между узлами ports, опорный узел -- общий. """
+    ports: np.ndarray
+    y: np.ndarray
+
+
 class Partition:
-    """ Раздел ТС. """
+    """
+    Раздел ТС.
+    Цепочка ячеек раздела держит емкость раздела (см. planCapacity): сечения, не занятые нагрузками, стоят между
+    занятыми и остаются в графе, поэтому, пока емкость не меняется, расстановка нагрузок только передвигает сечения
+    и пересчитывает проводимости ячеек, а состав узлов и блоков ребер графа остается прежним. Цепочка удлиняется,
+    когда нагрузок в разделе больше емкости, и укорачивается до емкости, когда их снова становится меньше.
+    Отключенные при этом ячейки и сечения остаются в пуле раздела и берутся при следующем удлинении с прежними
+    узлами и номерами ребер.
+    """
 
     def __init__(
             self,
@@ -17,7 +37,7 @@ class Partition:
             rightSection: NetworkSection,
             zeroNode: ICircuitNode,
             lattice: AcNetworkLattice,
-            graph: Graph
+            graph: Graph | GraphBuffer
     ) -> None:
         self.xLeft = xLeft
         self.xRight = xRight
@@ -30,6 +50,26 @@ class Partition:
         self.lattice = lattice
         self.graph = graph
         self.__payloads: List[ISchemaPayload] = []
+        self.__payloadsSorted = True
+        # положения нагрузок по возрастанию координаты и узлы, к которым они подключены
+        self.__payloadX: np.ndarray = np.empty(0, dtype=np.int64)
+        self.__payloadLines: np.ndarray = np.empty(0, dtype=np.int64)
+        self.__payloadNodes: np.ndarray = np.empty(0, dtype=np.int64)
+        self.__cells: List[Cell] = []
+        # ячейки и сечения, отключенные при укорачивании цепочки (и сечения, созданные reserveSections)
+        self.__cellPool: List[Cell] = []
+        self.__sectionPool: List[NetworkSection] = []
+        self.__detachedEdges: np.ndarray = np.empty(0, dtype=np.int64)
+        # ребра нагрузок, подключенные к графу при последней расстановке
+        self.__attachedEdges: List[ICircuitEdge] = []
+        # индекс подключения нагрузок: (координата, номер линии) -> узел сечения, координата -> ячейка, начинающаяся
+        # в этой точке (последняя ячейка -- также и для xRight); положения проиндексированных сечений
+        self.__nodeIndex: Dict[Tuple[int, int], int] = {}
+        self.__cellIndex: Dict[int, Cell] = {}
+        self.__indexedAt: Dict[int, int] = {}
+        self.__equivalent: Equivalent | None = None
+        # узлы, выделенные при построении раздела, но не вошедшие в его сечения (см. release)
+        self.orphanIds: np.ndarray = np.empty(0, dtype=np.int64)
 
     def updateCapacity(self, payloadCoordinates: List[int]):
         """ Обновить значение емкости раздела. """
@@ -37,32 +77,66 @@ class Partition:
         for x in payloadCoordinates:
             if x > self.xLeft and x < self.xRight:
                 coordinates.add(x)
-        if len(coordinates) > self.__capacity:
+        if len(coordinates) >= self.__capacity:
             self.__capacity = len(coordinates) + 1
 
+    def planCapacity(self, schedule: Iterable[np.ndarray]) -> int:
+        """
+        Определить емкость раздела по расписанию: наибольшее за окно число одновременно занятых точек внутри раздела
+        плюс одна ячейка. Элемент расписания -- координаты нагрузок на одном шаге. Емкость -- число ячеек, которое
+        раздел держит в цепочке; если ячейки уже созданы, цепочка сразу приводится к емкости.
+        """
+        peak = 0
+        for xs in schedule:
+            xs = np.asarray(xs)
+            peak = max(peak, len(np.unique(xs[(xs > self.xLeft) & (xs < self.xRight)])))
+        self.__capacity = peak + 1
+        if len(self.__cells) > 0:
+            self.__rearrange(self.__targets())
+            self.__equivalent = None
+        return self.__capacity
+
+    def capacity(self) -> int:
+        return self.__capacity
+
     def initCells(self) -> None:
-        """ Создать ячейки в количестве, равном текущему значению емкости. """
-        makeCell = lambda xl, xr, ls, rs: Cell(xl, xr, ls, rs, self.lattice, self.graph, self.zeroNode)
+        """ Создать цепочку ячеек по емкости раздела: свободные сечения расставляются по разделу равномерно. """
+        self.__cells = [Cell(self.xLeft, self.xRight, self.leftSection, self.rightSection, self.lattice, self.graph, self.zeroNode)]
+        self.__relink()
+        self.__reindex()
+        if self.__capacity > 1:
+            self.__rearrange([])
 
-        if self.__capacity == 1:
-            self.firstCell = makeCell(self.xLeft, self.xRight, self.leftSection, self.rightSection)
-            self.lastCell = self.firstCell
-            return
+    def restoreCells(self, cells: List[Cell], capacity: int) -> None:
+        """ Задать цепочку ячеек и емкость раздела (восстановление из снимка). """
+        self.__cells = cells
+        self.__capacity = capacity
+        self.__relink()
+        self.__reindex()
 
-        self.firstCell = makeCell(self.xLeft, self.xRight, self.leftSection, self.rightSection.deepCopy())
-        prev = self.firstCell
-        for _ in range(self.__capacity - 1):
-            next = makeCell(self.xRight, self.xRight, prev.rightSection, self.rightSection.deepCopy())
-            next.prev = prev
-            prev.next = next
-            prev = next
-        self.lastCell = makeCell(self.xRight, self.xRight, prev.rightSection, self.rightSection)
+    def cells(self) -> List[Cell]:
+        return self.__cells
+
+    def cellAt(self, x: int) -> Cell:
+        """ Ячейка, к сечению которой в точке x подключается нагрузка: ячейка, начинающаяся в x, или последняя для xRight. """
+        c = self.__cellIndex.get(x)
+        if c is None:
+            raise Exception(f"В точке {x} нет сечения раздела")
+        return c
+
+    def connectingNode(self, x: int, line: int) -> int:
+        """ Узел сечения в точке x на линии line, к которому подключается нагрузка. """
+        n = self.__nodeIndex.get((x, line))
+        if n is None:
+            raise Exception("Не найден узел для подключения нагрузки")
+        return n
 
     def addPayload(self, pl: ISchemaPayload) -> bool:
         if self.firstCell is None or self.lastCell is None:
             raise Exception()
         if pl.x >= self.xLeft and pl.x <= self.xRight:
             self.__payloads.append(pl)
+            self.__payloadsSorted = False
             return True
         return False
 
@@ -73,30 +147,400 @@ class Partition:
                 cnt += 1
         return cnt
 
-    def arrangePayloads(self) -> None:
+    def setPayloads(self, x: np.ndarray, trackNumbers: np.ndarray, pls: List[ISchemaPayload] | None = None) -> None:
+        """
+        Задать нагрузки раздела, уже отсортированные по координате. Массивы не копируются. Если объекты нагрузок
+        не переданы, к графу ничего не добавляется -- узлы подключения доступны через payloadNodes().
+        """
+        self.__payloads = pls if pls is not None else []
+        self.__payloadsSorted = True
+        self.__payloadX = x
+        self.__payloadLines = trackNumbers
+
+    def hasPayloads(self) -> bool:
+        return len(self.__payloadX) > 0 or len(self.__payloads) > 0
+
+    def equivalent(self) -> Equivalent:
+        """
+        Многополюсник раздела между узлами левого и правого сечений: матрица узловых проводимостей цепочки ячеек,
+        из которой исключением Крона удалены узлы внутренних сечений. Цепочка держится на плановой емкости, поэтому
+        и в разделе без нагрузок ячеек может быть несколько: свободные внутренние сечения тоже исключаются.
+        Кэшируется до изменения цепочки ячеек, то есть до расстановки нагрузок.
+        """
+        if self.__equivalent is None:
+            if len(self.__cells) == 0:
+                raise Exception("Ячейки раздела не созданы")
+            blocks = [c.edgeBlock for c in self.__cells]
+            ports = np.concatenate((self.leftSection.ids, self.rightSection.ids))
+            nodes = np.unique(np.concatenate([ports] + [c.rightSection.ids for c in self.__cells[:-1]]))
+            y = nodalMatrix(
+                nodes,
+                np.concatenate([b.source for b in blocks]),
+                np.concatenate([b.target for b in blocks]),
+                np.concatenate([b.conductivities() for b in blocks])
+            )
+            keep = np.isin(nodes, ports)
+            idx = np.searchsorted(nodes[keep], ports)
+            self.__equivalent = Equivalent(ports, kronReduce(y, keep)[np.ix_(idx, idx)])
+        return self.__equivalent
+
+    def payloadNodes(self) -> np.ndarray:
+        """ Идентификаторы узлов, к которым подключены нагрузки, в порядке возрастания координаты нагрузок. """
+        return self.__payloadNodes
+
+    def detachedEdges(self) -> np.ndarray:
+        """ Номера ребер ячеек, отключенных от графа при последней расстановке нагрузок. """
+        return self.__detachedEdges
+
+    def arrangePayloads(self, incremental: bool = False) -> np.ndarray:
+        """
+        Расставить ячейки по нагрузкам и подключить нагрузки к графу. Возвращает номера ребер, которые были
+        добавлены в граф или проводимости которых могли измениться.
+        В инкрементальном режиме перемещаются только те границы ячеек, которые не совпадают с положением нагрузок
+        на предыдущем шаге, и пересчитываются проводимости только затронутых ячеек. Без него пересчитываются все
+        ячейки раздела.
+        """
+        changed = self.arrangeCells(incremental)
+        if len(changed) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([c.edgeIds() for c in changed])
+
+    def arrangeCells(self, incremental: bool = False) -> List[Cell]:
+        """ То же, что arrangePayloads, но возвращает сами ячейки: номера ребер новых ячеек выдает граф. """
         if self.firstCell is None or self.lastCell is None:
             raise Exception()
-        self.__payloads.sort(key=lambda pl: pl.x)
-        # стянуть все ячейки к правой границе
-        self.firstCell.pullRightSection(self.lastCell.xRight)
-        cell = self.firstCell
-        for pl in self.__payloads:
-            cell, n = self.__addPayloadToCell(cell, pl)
-            self.graph.addEdge(n, self.zeroNode, pl.iplEdge)
+        targets = self.__targets()
+        changed = self.__rearrange(targets)
+        if not incremental:
+            for c in self.__cells:
+                c.updateEdgeConductivities()
+            changed = self.__cells
+        self.__connectPayloads()
+        return changed
+
+    def reserveSections(self) -> int:
+        """
+        Заранее создать сечения, которых не хватит при следующей расстановке нагрузок. Сечения кладутся на дно
+        пула в том порядке, в котором их создала бы расстановка, поэтому идентификаторы узлов получаются те же.
+        После этого расстановка не выделяет узлов в хранилище и может выполняться параллельно с другими разделами.
+        Возвращает число созданных сечений.
+        """
+        inner = max(len(self.__cells) - 1, 0)
+        missing = max(len(self.__targets()), self.__capacity - 1) - inner - len(self.__sectionPool)
+        if missing <= 0:
+            return 0
+        reserved = [self.rightSection.deepCopy() for _ in range(missing)]
+        reserved.reverse()
+        self.__sectionPool[:0] = reserved
+        return missing
+
+    def rebind(self, store: NodeStore, graph: Graph, idMap: np.ndarray) -> None:
+        """
+        Перевести раздел, построенный на локальном хранилище ветви, на общее хранилище: идентификаторы узлов
+        сечений заменяются на idMap[id]. Ребра ячеек переводятся при слиянии буфера ветви с графом.
+        """
+        sections = {id(s): s for s in [self.leftSection, self.rightSection] + self.__sectionPool}
+        for c in self.__cells + self.__cellPool:
+            sections[id(c.leftSection)] = c.leftSection
+            sections[id(c.rightSection)] = c.rightSection
+        for s in sections.values():
+            s.ids = idMap[s.ids]
+            s.store = store
+        self.zeroNode = store.node(int(idMap[self.zeroNode.id]))
+        self.__payloadNodes = idMap[self.__payloadNodes]
+        self.orphanIds = idMap[self.orphanIds]
+        self.graph = graph
+        self.__equivalent = None
+        self.__reindex()
+
+    def fork(self, store: NodeStore, graph: Graph, memo: Dict[int, Any]) -> "Partition":
+        """
+        Копия раздела для сценария (см. Router.fork) над копиями хранилища и графа. Ячейки, сечения и решетка
+        копируются через memo, поэтому общие для соседних разделов сечения остаются общими и в копии. Массивы
+        положений нагрузок не изменяются на месте и разделяются с оригиналом. Объекты нагрузок и их ребра
+        копируются (ISchemaPayload.fork): расстановка нагрузок копии не переподключает ребра оригинала.
+        """
+        p = copy.copy(self)
+        p.leftSection = forked(memo, self.leftSection, lambda: self.leftSection.fork(store))
+        p.rightSection = forked(memo, self.rightSection, lambda: self.rightSection.fork(store))
+        p.zeroNode = store.node(self.zeroNode.id)
+        p.lattice = forked(memo, self.lattice, self.lattice.fork)
+        p.graph = graph
+        p.__payloads = [forked(memo, pl, lambda pl=pl: pl.fork(memo, store)) for pl in self.__payloads]
+        p.__attachedEdges = [forked(memo, e, lambda e=e: e.fork(store)) for e in self.__attachedEdges]
+        p.__cells = [c.fork(memo, store) for c in self.__cells]
+        p.__cellPool = [c.fork(memo, store) for c in self.__cellPool]
+        p.__sectionPool = [forked(memo, s, lambda s=s: s.fork(store)) for s in self.__sectionPool]
+        p.firstCell = p.lastCell = None
+        if len(p.__cells) > 0:
+            p.__relink()
+        p.__reindex()
+        return p
+
+    def attachedEdges(self) -> List[ICircuitEdge]:
+        """ Ребра нагрузок, подключенные к графу разделом. """
+        return self.__attachedEdges
+
+    def detachDepartedPayloads(self) -> None:
+        """
+        Отключить от графа ребра нагрузок, которые ушли из раздела после последней расстановки. Router вызывает
+        это для всех расставляемых разделов до расстановки любого из них: ребро нагрузки, перешедшей в раздел,
+        расставляемый раньше, иначе было бы отключено прежним разделом уже после подключения новым.
+        """
+        self.__detachPayloadEdges(self.__payloads)
 
     def removePayloads(self):
-        self.__payloads.clear()
-
-    def __addPayloadToCell(self, cell: Cell, pl: ISchemaPayload) -> Tuple[Cell, ICircuitNode]:
-        if cell.xLeft == pl.x or cell.xRight == pl.x:
-            return cell, cell.getConnectingNode(pl)
-        elif pl.x < cell.xRight:
-            cell.pullRightSection(pl.x)
-            return cell, cell.getConnectingNode(pl)
-        elif pl.x > cell.xRight and cell.next is not None:
-            return self.__addPayloadToCell(cell.next, pl)
+        """ Удалить нагрузки раздела и отключить их ребра от графа. """
+        self.__detachPayloadEdges([])
+        self.__payloads = []
+        self.__payloadsSorted = True
+        self.__payloadX = np.empty(0, dtype=np.int64)
+        self.__payloadLines = np.empty(0, dtype=np.int64)
+
+    def release(self) -> None:
+        """
+        Отпустить раздел окна потокового построения (router.streamPartitions): отключить от графа ячейки и нагрузки,
+        удалить из графа узлы сечений, кроме правого, и вернуть их идентификаторы хранилищу вместе с orphanIds.
+        Правое сечение -- левое сечение следующего раздела и отпускается вместе с ним, а узлы правого сечения,
+        которые следующий раздел не взял, -- его orphanIds. Поэтому разделы отпускаются в порядке выдачи.
+        """
+        self.removePayloads()
+        ids = [self.leftSection.ids, self.orphanIds] + [c.rightSection.ids for c in self.__cells[:-1]] + [s.ids for s in self.__sectionPool]
+        for c in self.__cells:
+            self.graph.removeEdgeBlock(c.edgeBlock)
+        self.__cells = []
+        self.__cellPool = []
+        self.__sectionPool = []
+        self.__equivalent = None
+        self.firstCell = self.lastCell = None
+        self.__cellIndex = {}
+        self.__reindex()
+        released = np.unique(np.concatenate(ids))
+        released = released[released != NodeStore.GROUND]
+        self.graph.removeNodeIds(released)
+        self.leftSection.store.release(released)
+
+    def __targets(self) -> List[int]:
+        """ Точки внутри раздела, занятые нагрузками, по возрастанию. """
+        if not self.__payloadsSorted:
+            self.__payloads.sort(key=lambda pl: pl.x)
+            self.__payloadX = np.array([pl.x for pl in self.__payloads], dtype=np.int64)
+            self.__payloadLines = np.array([pl.trackNumber for pl in self.__payloads], dtype=np.int64)
+            self.__payloadsSorted = True
+        return [x for x in np.unique(self.__payloadX).tolist() if x > self.xLeft and x < self.xRight]
+
+    def __rearrange(self, targets: List[int]) -> List[Cell]:
+        """
+        Расставить внутренние сечения цепочки ячеек по точкам targets. Сечения, не занятые нагрузками (свободные),
+        остаются в цепочке и в графе и стоят между занятыми (см. __place). Решетка ячеек последовательная, поэтому
+        лишнее сечение внутри раздела схему не меняет, а состав узлов и блоков ребер графа -- и шаблон матрицы
+        проводимостей -- между шагами постоянен. Цепочка удлиняется, только если точек больше, чем сечений, и
+        укорачивается до емкости раздела, когда их становится меньше.
+        Сечения предыдущего шага сопоставляются точкам слиянием двух упорядоченных списков: совпавшие остаются на
+        месте. Возвращает ячейки, которые подключены к графу заново или проводимости которых пересчитаны.
+        """
+        store = self.leftSection.store
+        inner = [c.rightSection for c in self.__cells[:-1]]
+        old = [int(store.x[s.ids[0]]) for s in inner]
+        # цепочка приводится к емкости раздела, но не короче, чем нужно для нагрузок: недостающие сечения
+        # добавляются в конец цепочки, лишние свободные удаляются с конца
+        size = max(len(targets), self.__capacity - 1)
+        while len(inner) < size:
+            inner.append(self.__acquireSection())
+            old.append(self.xRight)
+        points: List[int | None] = [None] * len(inner)
+        i = 0
+        for j, x in enumerate(targets):
+            while old[i] != x and len(inner) - i > len(targets) - j:
+                i += 1
+            points[i] = x
+            i += 1
+        removed: List[NetworkSection] = []
+        excess = len(inner) - size
+        for k in range(len(inner) - 1, -1, -1):
+            if excess <= 0:
+                break
+            if points[k] is None:
+                removed.append(inner.pop(k))
+                del points[k], old[k]
+                excess -= 1
+        sections = [self.leftSection] + inner + [self.rightSection]
+        bounds = [self.xLeft] + self.__place(points, old) + [self.xRight]
+
+        shifted = 0
+        for k in range(1, len(sections) - 1):
+            if store.x[sections[k].ids[0]] != bounds[k]:
+                sections[k].setX(bounds[k])
+                shifted += 1
+        # индекс узлов обновляется только для удаленных и перемещенных сечений. Сначала из индекса удаляются
+        # все они, затем добавляются перемещенные: сечение может встать в точку, которую освобождает другое
+        moved = [(s, x) for s, x in zip(sections, bounds) if self.__indexedAt.get(id(s)) != x]
+        for s in removed:
+            self.__unindex(s)
+        for s, _ in moved:
+            self.__unindex(s)
+        for s, x in moved:
+            self.__index(s, x)
+
+        # k-я ячейка соединяет k-е и (k + 1)-е сечения; при неизменном числе сечений ячейки не переподключаются
+        oldCells = self.__cells
+        cells: List[Cell] = []
+        changed: List[Cell] = []
+        for k in range(len(sections) - 1):
+            if k >= len(oldCells):
+                c = self.__acquireCell(sections[k], sections[k + 1], bounds[k], bounds[k + 1])
+                changed.append(c)
+            else:
+                c = oldCells[k]
+                if c.leftSection is not sections[k] or c.rightSection is not sections[k + 1]:
+                    # блок переподключается к другим узлам -- шаблон матрицы проводимостей графа меняется
+                    self.graph.removeEdgeBlock(c.edgeBlock)
+                    c.rewire(sections[k], sections[k + 1])
+                    self.graph.addEdgeBlock(c.edgeBlock)
+                    c.resize(bounds[k], bounds[k + 1])
+                    changed.append(c)
+                elif c.resize(bounds[k], bounds[k + 1]):
+                    changed.append(c)
+            cells.append(c)
+
+        detached = oldCells[len(cells):]
+        for c in detached:
+            self.graph.removeEdgeBlock(c.edgeBlock)
+        for s in removed:
+            self.graph.removeNodeIds(s.ids)
+        # отключенные ячейки и сечения берутся снова при следующем удлинении цепочки: их узлы и номера ребер
+        # остаются за разделом, и хранилище и граф не растут при колебании числа нагрузок около емкости
+        self.__cellPool.extend(detached)
+        self.__sectionPool.extend(removed)
+        self.__detachedEdges = np.concatenate([c.edgeIds() for c in detached]) if len(detached) > 0 else np.empty(0, dtype=np.int64)
+        self.__cells = cells
+        self.__relink()
+        if metrics.enabled:
+            # те же счетчики, что у притягивания сечений (Cell.pullRightSection): перемещенные сечения и серии
+            # соседних пересчитанных ячеек
+            touched = {id(c) for c in changed}
+            run = 0
+            for c in cells + [None]:
+                if c is not None and id(c) in touched:
+                    run += 1
+                elif run > 0:
+                    metrics.count("cell.cascadeCells", run)
+                    metrics.maximum("cell.cascadeDepth", run)
+                    run = 0
+            metrics.count("cell.pulls", shifted)
+        return changed
+
+    def __place(self, points: List[int | None], current: List[int]) -> List[int]:
+        """
+        Координаты внутренних сечений: занятое сечение -- в своей точке points[k], свободные остаются на прежних
+        местах current, если стоят между соседними занятыми точками по возрастанию, иначе расставляются между
+        ними равномерно. Свободное сечение, которое не сдвинулось, не меняет проводимостей соседних ячеек.
+        """
+        res = list(points)
+        k = 0
+        while k < len(res):
+            if res[k] is not None:
+                k += 1
+                continue
+            e = k
+            while e < len(res) and res[e] is None:
+                e += 1
+            a = res[k - 1] if k > 0 else self.xLeft
+            b = res[e] if e < len(res) else self.xRight
+            run = [a] + current[k:e] + [b]
+            if any(run[i] >= run[i + 1] for i in range(len(run) - 1)):
+                run = [a + (b - a) * (i + 1) // (e - k + 1) for i in range(-1, e - k + 1)]
+            res[k:e] = run[1:-1]
+            k = e
+        return res  # type: ignore
+
+    def __acquireSection(self) -> NetworkSection:
+        if len(self.__sectionPool) > 0:
+            s = self.__sectionPool.pop()
         else:
-            raise Exception()
+            s = self.rightSection.deepCopy()
+        self.graph.addNodeIds(s.ids)
+        return s
+
+    def __acquireCell(self, left: NetworkSection, right: NetworkSection, xLeft: int, xRight: int) -> Cell:
+        """ Ячейка между сечениями left и right: из пула (с прежними номерами ребер) или новая. """
+        if len(self.__cellPool) == 0:
+            return Cell(xLeft, xRight, left, right, self.lattice, self.graph, self.zeroNode)
+        c = self.__cellPool.pop()
+        c.rewire(left, right)
+        self.graph.addEdgeBlock(c.edgeBlock)
+        c.resize(xLeft, xRight)
+        return c
+
+    def __connectPayloads(self) -> None:
+        index = self.__nodeIndex
+        try:
+            nodes = [index[key] for key in zip(self.__payloadX.tolist(), self.__payloadLines.tolist())]
+        except KeyError:
+            raise Exception("Не найден узел для подключения нагрузки")
+        self.__payloadNodes = np.array(nodes, dtype=np.int64)
+        if metrics.enabled:
+            metrics.count("partition.payloadsAttached", len(nodes))
+        store = self.leftSection.store
+        # ребра ушедших нагрузок отключаются, ребра оставшихся переподключаются к новым узлам
+        self.__detachPayloadEdges(self.__payloads)
+        for pl, n in zip(self.__payloads, nodes):
+            self.graph.addEdge(store.node(n), self.zeroNode, pl.iplEdge)
+        self.__attachedEdges = [pl.iplEdge for pl in self.__payloads]
+
+    def __detachPayloadEdges(self, keep: List[ISchemaPayload]) -> None:
+        kept = {id(pl.iplEdge) for pl in keep}
+        for e in self.__attachedEdges:
+            if id(e) not in kept:
+                self.graph.removeEdge(e)
+        self.__attachedEdges = [e for e in self.__attachedEdges if id(e) in kept]
+
+    def __index(self, s: NetworkSection, x: int) -> None:
+        self.__indexedAt[id(s)] = x
+        for li, n in zip(s.store.lineIndex[s.ids].tolist(), s.ids.tolist()):
+            self.__nodeIndex.setdefault((x, li), n)
+
+    def __unindex(self, s: NetworkSection) -> None:
+        x = self.__indexedAt.pop(id(s), None)
+        if x is None:
+            return
+        for li, n in zip(s.store.lineIndex[s.ids].tolist(), s.ids.tolist()):
+            if self.__nodeIndex.get((x, li)) == n:
+                del self.__nodeIndex[(x, li)]
+
+    def __reindex(self) -> None:
+        """ Построить индекс узлов заново по текущей цепочке ячеек. """
+        self.__nodeIndex = {}
+        self.__indexedAt = {}
+        if len(self.__cells) == 0:
+            return
+        self.__index(self.__cells[0].leftSection, self.__cells[0].xLeft)
+        for c in self.__cells:
+            self.__index(c.rightSection, c.xRight)
+
+    def __relink(self) -> None:
+        prev = None
+        self.__cellIndex = {}
+        # цепочка ячеек изменилась -- многополюсник раздела пересчитывается при следующем обращении
+        self.__equivalent = None
+        for c in self.__cells:
+            c.prev = prev
+            c.next = None
+            if prev is not None:
+                prev.next = c
+            prev = c
+            self.__cellIndex[c.xLeft] = c
+        self.firstCell = self.__cells[0]
+        self.lastCell = self.__cells[-1]
+        self.__cellIndex.setdefault(self.lastCell.xRight, self.lastCell)
+
+    def __setstate__(self, state: Dict) -> None:
+        # ячейки передаются между процессами без ссылок next/prev (см. Cell.__getstate__)
+        self.__dict__.update(state)
+        if len(self.__cells) > 0:
+            self.__relink()
+        # индекс узлов ссылается на сечения по id объектов
+        self.__reindex()
 
     def __repr__(self) -> str:
         return f"{{ left: {self.leftSection}, right: {self.rightSection} }}"
@@ -0,0 +1,149 @@
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+import metrics
+from admittance import AdmittanceMatrix
+from graph import Graph
+from router import Router, StepDelta
+
+
+@dataclass
+class PipelineStep:
+    """
+    Шаг конвейера: изменение графа за шаг, снимок графа после расстановки нагрузок шага и результаты этапов в
+    порядке их следования. Снимок не изменяется следующими шагами, поэтому этапы читают его без блокировок.
+    """
+    delta: StepDelta
+    graph: Graph
+    results: List[Any] = field(default_factory=list)
+
+
+class AdmittanceAssembly:
+    """
+    Этап конвейера: матрица проводимостей снимка графа шага. Матрица предыдущего шага копируется (AdmittanceMatrix.fork)
+    и обновляется по изменившимся ребрам; при изменении состава узлов и блоков графа собирается заново. Матрицы
+    шагов независимы, и следующие этапы могут работать с матрицей шага t, пока собирается матрица шага t + 1.
+    """
+
+    def __init__(self) -> None:
+        self.__matrix: AdmittanceMatrix | None = None
+
+    def __call__(self, step: PipelineStep) -> AdmittanceMatrix:
+        if self.__matrix is None:
+            m = AdmittanceMatrix(step.graph)
+        else:
+            m = self.__matrix.fork(step.graph)
+            m.update(step.delta.edgeIds)
+        self.__matrix = m
+        return m
+
+
+class StepPipeline:
+    """
+    Конвейерное выполнение расписания (Router.simulate). Распределение и расстановка нагрузок шага t + 1 идут в
+    отдельном потоке одновременно с этапами stages шага t: каждый этап -- свой поток, этапы связаны очередями
+    глубиной depth. Если этап не успевает, очередь перед ним заполняется и предыдущие этапы, включая расстановку,
+    ждут, поэтому число шагов, расставленных, но еще не выданных, ограничено глубиной и числом очередей.
+    Этап -- функция от PipelineStep; ее результат добавляется в step.results. Трассировщик изменяется только
+    потоком расстановки; этапы получают снимок графа (Graph.snapshot) на момент окончания расстановки шага и не
+    должны обращаться к трассировщику и его графу. Шаги выдаются в порядке расписания, этапы обрабатывают их по одному.
+    Исключение в любом этапе останавливает конвейер и передается вызывающей стороне.
+    """
+
+    def __init__(
+            self,
+            router: Router,
+            stages: Sequence[Callable[[PipelineStep], Any]] = (),
+            depth: int = 2,
+            incremental: bool = True
+    ) -> None:
+        if depth < 1:
+            raise Exception("Глубина очередей конвейера должна быть не меньше 1")
+        self.router = router
+        self.stages = list(stages)
+        self.depth = depth
+        self.incremental = incremental
+
+    def run(self, schedule: Iterable[Tuple[np.ndarray, np.ndarray]]) -> Iterator[PipelineStep]:
+        """
+        Прогнать расписание через конвейер. Если перебор шагов прекращен досрочно, потоки останавливаются, а
+        расстановка прерывается на ближайшем шаге.
+        """
+        stop = threading.Event()
+        queues: List[queue.Queue] = [queue.Queue(self.depth) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.__arrange, args=(schedule, queues[0], stop), daemon=True)]
+        for k, fn in enumerate(self.stages):
+            threads.append(threading.Thread(target=self.__stage, args=(fn, queues[k], queues[k + 1], stop), daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            # освободить потоки, ждущие места в очередях
+            for q in queues:
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+            for t in threads:
+                t.join()
+
+    def __arrange(self, schedule: Iterable[Tuple[np.ndarray, np.ndarray]], out: queue.Queue, stop: threading.Event) -> None:
+        graph = self.router.graph
+        snapshot: Graph | None = None
+        try:
+            for delta in self.router.simulate(schedule, self.incremental):
+                with metrics.phase("snapshot"):
+                    # пока состав графа не меняется, снимок шага копирует только блоки с изменившимися ребрами
+                    snapshot = graph.snapshot(snapshot, delta.edgeIds)
+                if not StepPipeline.__put(out, PipelineStep(delta, snapshot), stop):
+                    return
+            StepPipeline.__put(out, None, stop)
+        except BaseException as e:
+            StepPipeline.__put(out, e, stop)
+
+    @staticmethod
+    def __stage(fn: Callable[[PipelineStep], Any], inp: queue.Queue, out: queue.Queue, stop: threading.Event) -> None:
+        while True:
+            item = StepPipeline.__get(inp, stop)
+            if item is None or isinstance(item, BaseException):
+                StepPipeline.__put(out, item, stop)
+                return
+            try:
+                item.results.append(fn(item))
+            except BaseException as e:
+                StepPipeline.__put(out, e, stop)
+                return
+            if not StepPipeline.__put(out, item, stop):
+                return
+
+    @staticmethod
+    def __put(q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        """ Поставить элемент в очередь, дожидаясь места. Возвращает False, если конвейер остановлен. """
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def __get(q: queue.Queue, stop: threading.Event) -> Any:
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        return None
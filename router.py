@@ -1,138 +1,1089 @@
-import heapq
-from itertools import combinations
-from typing import Dict, List, Set
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import copy
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Set, Tuple
 
 import numpy as np
-from context import AcNetworkDto, ICircuitEdge, ICircuitNode
-from graph import Graph
-from partition import Partition
-from network import BranchNetworkChain, NetworkSection
+import metrics
+from admittance import ReducedAdmittance, kronReduce
+from context import AcNetworkDto, ICircuitNode, ISchemaPayload, NodeStore, forked
+from graph import Graph, GraphBuffer
+from partition import Equivalent, Partition
+from network import BranchNetworkChain, NetworkSection, StreamingChain
+from ordering import ORDERINGS, OrderingReport, orderingReport
 
 
 class Router:
     """ Трассировщик """
 
-    def __init__(self, graph: Graph, networks: Dict[int, List[AcNetworkDto]]) -> None:
+    PARALLEL_MODES = ("serial", "thread", "process")
+    # число разделов ветви в отрезке, многополюсник которого кэшируется при построении reducedAdmittance
+    REDUCTION_SEGMENT = 32
+
+    def __init__(
+            self,
+            graph: Graph,
+            networks: Dict[int, List[AcNetworkDto]],
+            ordering: str = "coordinate",
+            parallel: str = "serial",
+            workers: int | None = None
+    ) -> None:
+        """
+        parallel -- режим выполнения по ветвям: serial, thread (пул потоков) или process (пул процессов). Пул
+        процессов используется только при построении разделов (buildPartitions); ячейки и расстановка нагрузок в
+        этом режиме обрабатываются пулом потоков -- разделы живут в основном процессе.
+        """
+        if ordering not in ORDERINGS:
+            raise Exception(f"Неизвестный способ нумерации узлов: {ordering}")
+        if parallel not in Router.PARALLEL_MODES:
+            raise Exception(f"Неизвестный режим выполнения: {parallel}")
         self.__graph = graph
+        self.networks = networks
+        self.__ordering = ordering
+        self.__parallel = parallel
+        self.__workers = workers
+        self.__store: NodeStore = graph.store
         self.__network: Dict[int, BranchNetworkChain] = {
             li: BranchNetworkChain.fromAcNetworkDto(ntw) for li, ntw in networks.items()
         }
         self.partitions: Dict[int, List[Partition]] = {}
+        self.__partitionBounds: Dict[int, np.ndarray] = {}
+        self.__loadedPartitions: Set[Partition] = set()
+        # разделы, нагрузки которых изменились после последней расстановки
+        self.__pendingPartitions: Set[Partition] = set()
+        # занятые разделы последнего шага и исходные индексы их нагрузок (в порядке возрастания координаты)
+        self.__dispatched: List[Tuple[Partition, np.ndarray]] = []
+        self.__arranged: List[Partition] = []
+        # исходные узлы схемы по ветвям и линиям, отсортированные по (координата, идентификатор); строятся при
+        # первой правке схемы
+        self.__schema: Dict[int, Dict[int, Tuple[np.ndarray, np.ndarray]]] | None = None
+        # многополюсники отрезков цепочек разделов без нагрузок: разделы отрезка -> (многополюсники разделов,
+        # сохраняемые узлы отрезка, многополюсник отрезка)
+        self.__segments: Dict[Tuple[int, ...], Tuple[List[Equivalent], Tuple[int, ...], Equivalent]] = {}
 
-    def buildPartitions(self):
-        """ Построить разделы ТС """
-        for branchIndex in self.__network.keys():
-            self.partitions[branchIndex] = self.__buildBranchPartitions(
-                self.__arrangeNodesByBranchIndex(self.__graph.nodes()),
-                self.__network,
-                branchIndex
-            )
+    @property
+    def graph(self) -> Graph:
+        return self.__graph
+
+    @property
+    def ordering(self) -> str:
+        return self.__ordering
+
+    def chain(self, branchIndex: int) -> BranchNetworkChain:
+        return self.__network[branchIndex]
+
+    def fork(self) -> "Router":
+        """
+        Копия трассировщика для отдельного сценария расчета. Хранилище узлов и блоки ребер разделяют массивы с
+        оригиналом до первой записи (копирование при записи), разделы, ячейки, сечения и граф копируются
+        поверхностно. Копии можно вести независимо, в том числе в разных потоках. Описания КС ветвей общие.
+        Объекты нагрузок (ISchemaPayload и их ребра) между копиями не разделяются: каждому сценарию -- свои.
+        """
+        r = copy.copy(self)
+        memo: Dict[int, Any] = {}
+        store = self.__store.fork()
+        graph = self.__graph.fork(store, memo)
+        r.__store = store
+        r.__graph = graph
+        r.partitions = {
+            branchIndex: [forked(memo, p, lambda p=p: p.fork(store, graph, memo)) for p in partitions]
+            for branchIndex, partitions in self.partitions.items()
+        }
+
+        def part(p: Partition) -> Partition:
+            return memo[id(p)]
+
+        r.__partitionBounds = dict(self.__partitionBounds)
+        r.__loadedPartitions = {part(p) for p in self.__loadedPartitions}
+        r.__pendingPartitions = {part(p) for p in self.__pendingPartitions}
+        r.__dispatched = [(part(p), idx) for p, idx in self.__dispatched]
+        r.__arranged = [part(p) for p in self.__arranged]
+        if self.__schema is not None:
+            r.__schema = {branchIndex: dict(lines) for branchIndex, lines in self.__schema.items()}
+        return r
+
+    def restorePartitions(self, partitions: Dict[int, List[Partition]]) -> None:
+        """ Задать готовые разделы с ячейками (восстановление из снимка) и нумерацию узлов графа. """
+        self.partitions = partitions
+        self.__partitionBounds.clear()
+        self.__schema = None
+        self.__loadedPartitions = set()
+        self.__pendingPartitions = set()
+        self.__dispatched = []
+        self.__graph.setOrdering(ORDERINGS[self.__ordering])
+
+    def buildPartitions(self, initCells: bool = False):
+        """
+        Построить разделы ТС. С initCells сразу создаются и ячейки разделов (см. initCells). В параллельном режиме
+        каждая ветвь строится отдельной задачей пула на локальном хранилище узлов и со своим буфером изменений графа;
+        затем ветви по порядку переносятся в общее хранилище и граф, так что идентификаторы узлов и номера ребер
+        совпадают с последовательным построением.
+        """
+        with metrics.phase("buildPartitions"):
+            branches = self.__arrangeNodesByBranchIndex(self.__graph.nodeIds())
+            self.__partitionBounds.clear()
+            self.__schema = None
+            if self.__parallel == "serial":
+                builder = BranchBuilder(self.__store, self.__graph)
+                for branchIndex, chain in self.__network.items():
+                    queues = {li: LineQueue(ids, xx) for li, (ids, xx) in branches.get(branchIndex, {}).items()}
+                    self.partitions[branchIndex] = builder.build(queues, chain, branchIndex)
+                if initCells:
+                    self.initCells()
+                return
+
+            tasks = []
+            nodeIds = []
+            for branchIndex, chain in self.__network.items():
+                lines = branches.get(branchIndex, {})
+                ids = np.concatenate([ids for ids, _ in lines.values()]) if len(lines) > 0 else np.empty(0, dtype=np.int64)
+                nodeIds.append(ids)
+                tasks.append((
+                    branchIndex,
+                    chain,
+                    [(li, xx, self.__store.lineIndex[ids]) for li, (ids, xx) in lines.items()],
+                    self.__store.breaking[ids],
+                    self.__store.duplicatedBreakingNode[ids],
+                    initCells
+                ))
+            with self.__executor() as executor:
+                results = list(executor.map(buildBranch, *zip(*tasks)))
+            for (branchIndex, _, _, _, _, _), ids, (partitions, buffer, local) in zip(tasks, nodeIds, results):
+                # узлы, созданные ветвью, получают идентификаторы в общем хранилище в порядке создания
+                created = np.arange(len(ids) + 1, local.size)
+                newIds = self.__store.allocateMany(local.lineIndex[created], local.x[created])
+                self.__store.setBreaking(newIds, local.breaking[created])
+                self.__store.setDuplicatedBreakingNode(newIds, local.duplicatedBreakingNode[created])
+                idMap = np.concatenate(([NodeStore.GROUND], ids, newIds)).astype(np.int64)
+                for p in partitions:
+                    p.rebind(self.__store, self.__graph, idMap)
+                self.__graph.merge(buffer, idMap)
+                self.partitions[branchIndex] = partitions
+            if initCells:
+                self.__graph.setOrdering(ORDERINGS[self.__ordering])
 
     def initCells(self):
-        for partitions in self.partitions.values():
+        """ Создать ячейки разделов и задать графу нумерацию узлов выбранным способом. """
+        with metrics.phase("initCells"):
+            if self.__parallel == "serial":
+                for partitions in self.partitions.values():
+                    for p in partitions:
+                        p.initCells()
+            else:
+                for partitions in self.partitions.values():
+                    for p in partitions:
+                        p.reserveSections()
+                self.__runBranches(lambda partitions: [p.initCells() for p in partitions])
+            self.__graph.setOrdering(ORDERINGS[self.__ordering])
+
+    def arrangePayloads(self, incremental: bool = False) -> np.ndarray:
+        """
+        Расставить ячейки разделов по нагрузкам (см. Partition.arrangePayloads). Возвращает номера ребер, которые
+        были добавлены в граф или проводимости которых могли измениться. В инкрементальном режиме расставляются
+        только разделы, нагрузки которых изменились после предыдущей расстановки.
+        В параллельном режиме ветви расставляются в пуле потоков: недостающие сечения заранее создаются
+        последовательно, изменения графа каждой ветви пишутся в ее буфер и переносятся в граф по порядку ветвей.
+        """
+        with metrics.phase("arrangePayloads"):
+            pending = self.__pendingPartitions
+            self.__pendingPartitions = set()
+
+            def active(partitions: List[Partition]) -> List[Partition]:
+                return [p for p in partitions if not incremental or p in pending]
+
+            self.__arranged = [p for partitions in self.partitions.values() for p in active(partitions)]
+            if metrics.enabled:
+                metrics.count("router.partitionsArranged", len(self.__arranged))
+            # ребра нагрузок, перешедших между разделами, отключаются до подключения в новых разделах
+            for p in self.__arranged:
+                p.detachDepartedPayloads()
+            if self.__parallel == "serial":
+                changed = [p.arrangePayloads(incremental) for p in self.__arranged]
+            else:
+                for p in self.__arranged:
+                    p.reserveSections()
+                cells = self.__runBranches(lambda partitions: [c for p in active(partitions) for c in p.arrangeCells(incremental)])
+                changed = [c.edgeIds() for cc in cells for c in cc]
+            if len(changed) == 0:
+                return np.empty(0, dtype=np.int64)
+            return np.concatenate(changed)
+
+    def simulate(
+            self,
+            schedule: Iterable[Tuple[np.ndarray, np.ndarray]],
+            incremental: bool = True
+    ) -> Iterator["StepDelta"]:
+        """
+        Прогнать расписание: элемент расписания -- пара массивов (координаты, номера путей) нагрузок на одном шаге.
+        На каждом шаге нагрузки распределяются по разделам, ячейки расставляются, и выдается изменение графа
+        относительно предыдущего шага (StepDelta). Копии графа не создаются; расписание читается по одному шагу,
+        поэтому его можно передавать генератором. Состояние графа до первого шага читается из самого графа.
+        """
+        previous = np.empty(0, dtype=np.int64)
+        for step, (x, trackNumbers) in enumerate(schedule):
+            with metrics.step(step):
+                x = np.asarray(x, dtype=np.int64)
+                trackNumbers = np.asarray(trackNumbers, dtype=np.int64)
+                with metrics.phase("dispatchPositions"):
+                    self.dispatchPositions(x, trackNumbers)
+                edgeIds = self.arrangePayloads(incremental)
+                with metrics.phase("stepDelta"):
+                    detached = [p.detachedEdges() for p in self.__arranged]
+                    payloadNodes = self.payloadNodes(len(x))
+                    attached = np.unique(payloadNodes[payloadNodes >= 0])
+                    sources, targets = self.__graph.edgeEndpoints(edgeIds)
+                    delta = StepDelta(
+                        step,
+                        edgeIds,
+                        self.__graph.conductivities(edgeIds),
+                        sources,
+                        targets,
+                        np.concatenate(detached) if len(detached) > 0 else np.empty(0, dtype=np.int64),
+                        payloadNodes,
+                        np.setdiff1d(attached, previous, assume_unique=True),
+                        np.setdiff1d(previous, attached, assume_unique=True)
+                    )
+            # шаг замеряется без времени обработки изменения вызывающей стороной
+            yield delta
+            previous = attached
+
+    def payloadNodes(self, count: int) -> np.ndarray:
+        """
+        Узлы подключения нагрузок последнего шага в порядке, в котором нагрузки были переданы в dispatchPositions
+        (count -- их число). Нагрузкам вне разделов соответствует -1.
+        """
+        res = np.full(count, -1, dtype=np.int64)
+        for p, idx in self.__dispatched:
+            res[idx] = p.payloadNodes()
+        return res
+
+    def __runBranches(self, fn: Callable[[List[Partition]], List]) -> List[List]:
+        """
+        Выполнить fn над разделами каждой ветви в пуле потоков. На время выполнения разделы ветви пишут изменения
+        графа в буфер ветви; буферы сливаются с графом в порядке ветвей. Возвращает результаты fn по ветвям.
+        """
+        def run(partitions: List[Partition]) -> Tuple[List, GraphBuffer]:
+            buffer = GraphBuffer(self.__store)
             for p in partitions:
-                p.initCells()
+                p.graph = buffer
+            try:
+                return fn(partitions), buffer
+            finally:
+                for p in partitions:
+                    p.graph = self.__graph
+
+        with ThreadPoolExecutor(self.__workers) as executor:
+            results = list(executor.map(run, self.partitions.values()))
+        for _, buffer in results:
+            self.__graph.merge(buffer)
+        return [res for res, _ in results]
+
+    def __executor(self) -> Executor:
+        if self.__parallel == "process":
+            return ProcessPoolExecutor(self.__workers)
+        return ThreadPoolExecutor(self.__workers)
+
+    def reducedAdmittance(self, keep: np.ndarray | None = None) -> ReducedAdmittance:
+        """
+        Матрица узловых проводимостей графа, в которой цепочки соседних разделов без нагрузок заменены
+        многополюсниками: узлы, к которым подключены только разделы цепочки, исключены (исключение Крона).
+        Сохраняются узлы keep, узлы разделов с нагрузками и узлы подключения нагрузок. При тех же токах в сохраненных
+        узлах их напряжения совпадают с решением полной системы (Graph.admittanceMatrix). Нумерация сохраненных
+        узлов -- по Graph.numbering().
+        Цепочка делится на отрезки по REDUCTION_SEGMENT разделов ветви. Многополюсник отрезка кэшируется, пока
+        не изменятся его разделы и их ячейки (разделы кэшируют свои многополюсники, см. Partition.equivalent), а
+        многополюсник цепочки собирается из многополюсников отрезков. Поэтому на шаге расчета пересчитываются
+        только отрезки, в которые вошли или из которых ушли нагрузки.
+        """
+        graph = self.__graph
+        external: Set[int] = set(keep.tolist()) if keep is not None else set()
+        full: List[Partition] = []
+        runs: List[List[List[Partition]]] = []
+        for partitions in self.partitions.values():
+            run: List[List[Partition]] = []
+            for k, p in enumerate(partitions):
+                if len(p.cells()) == 0:
+                    continue
+                if p.hasPayloads():
+                    full.append(p)
+                    for c in p.cells():
+                        external.update(c.leftSection.ids.tolist())
+                        external.update(c.rightSection.ids.tolist())
+                    if len(run) > 0:
+                        runs.append(run)
+                    run = []
+                elif len(run) == 0 or k % Router.REDUCTION_SEGMENT == 0:
+                    run.append([p])
+                else:
+                    run[-1].append(p)
+            if len(run) > 0:
+                runs.append(run)
+        loose = list(graph.looseEdges())
+        for e in loose:
+            external.add(hash(e.getSourceNode()))
+            external.add(hash(e.getTargetNode()))
 
-    def __buildBranchPartitions(self, branches: Dict[int, Dict[int, List[ICircuitNode]]], network: Dict[int, BranchNetworkChain], branchIndex: int) -> List[Partition]:
-        branchNodeQueues = branches[branchIndex]
-        branchNetwork = network[branchIndex]
-        partitions: List[Partition] = []
-        zeroNode = ICircuitNode(0, 0)
+        cache: Dict[Tuple[int, ...], Tuple[List[Equivalent], Tuple[int, ...], Equivalent]] = {}
+        equivalents = []
+        removed = []
+        for run in runs:
+            parts = [[p.equivalent() for p in segment] for segment in run]
+            reduced = []
+            for k, (segment, eqs) in enumerate(zip(run, parts)):
+                # узлы, общие с соседними отрезками, остаются полюсами отрезка
+                shared = set(external)
+                if k > 0:
+                    shared.update(np.intersect1d(parts[k - 1][-1].ports, eqs[0].ports).tolist())
+                if k + 1 < len(run):
+                    shared.update(np.intersect1d(eqs[-1].ports, parts[k + 1][0].ports).tolist())
+                key = tuple(id(p) for p in segment)
+                terminals = tuple(n for eq in eqs for n in eq.ports.tolist() if n in shared)
+                cached = self.__segments.get(key)
+                if cached is not None and cached[1] == terminals and all(a is b for a, b in zip(cached[0], eqs)):
+                    eq = cached[2]
+                else:
+                    eq = Router.__reduceChain(eqs, shared)
+                cache[key] = (eqs, terminals, eq)
+                reduced.append(eq)
+            equivalents.append(Router.__reduceChain(reduced, external) if len(reduced) > 1 else reduced[0])
+            removed.append(np.concatenate([s.ids for segment in run for p in segment for c in p.cells() for s in (c.leftSection, c.rightSection)]))
+        self.__segments = cache
+        if metrics.enabled:
+            metrics.count("router.runsReduced", len(runs))
+
+        order = graph.numbering()
+        kept = np.concatenate([eq.ports for eq in equivalents] + [np.empty(0, dtype=np.int64)])
+        eliminated = np.setdiff1d(np.concatenate(removed + [np.empty(0, dtype=np.int64)]), kept)
+        order = order[~np.isin(order, eliminated)]
+        row = np.full(graph.store.size, -1, dtype=np.int64)
+        row[order] = np.arange(len(order))
+
+        blocks = [c.edgeBlock for p in full for c in p.cells()]
+        src = np.concatenate([b.source for b in blocks] + [np.array([hash(e.getSourceNode()) for e in loose], dtype=np.int64)])
+        tgt = np.concatenate([b.target for b in blocks] + [np.array([hash(e.getTargetNode()) for e in loose], dtype=np.int64)])
+        c = np.concatenate([b.conductivities() for b in blocks] + [np.array([e.c for e in loose], dtype=np.complex128)])
+        i, j = row[src], row[tgt]
+        rows = [np.concatenate((i, j, i, j))]
+        cols = [np.concatenate((i, j, j, i))]
+        values = [np.concatenate((c, c, -c, -c))]
+        for eq in equivalents:
+            r = row[eq.ports]
+            rows.append(np.repeat(r, len(r)))
+            cols.append(np.tile(r, len(r)))
+            values.append(eq.y.ravel())
+        rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+        valid = (rows >= 0) & (cols >= 0)
+        return ReducedAdmittance(order, rows[valid], cols[valid], values[valid], eliminated)
+
+    @staticmethod
+    def __reduceChain(parts: List[Equivalent], external: Set[int]) -> Equivalent:
+        """
+        Многополюсник цепочки многополюсников: они присоединяются по одному, и после каждого исключаются узлы,
+        которые не входят в external и в следующий многополюсник.
+        """
+        ids = np.empty(0, dtype=np.int64)
+        y = np.empty((0, 0), dtype=np.complex128)
+        for k, part in enumerate(parts):
+            nodes = np.union1d(ids, part.ports)
+            merged = np.zeros((len(nodes), len(nodes)), dtype=np.complex128)
+            a = np.searchsorted(nodes, ids)
+            b = np.searchsorted(nodes, part.ports)
+            merged[np.ix_(a, a)] += y
+            merged[np.ix_(b, b)] += part.y
+            following = parts[k + 1].ports if k + 1 < len(parts) else np.empty(0, dtype=np.int64)
+            keep = np.isin(nodes, following) | np.fromiter((n in external for n in nodes.tolist()), dtype=bool, count=len(nodes))
+            y = kronReduce(merged, keep)
+            ids = nodes[keep]
+        return Equivalent(ids, y)
+
+    def orderingReport(self) -> OrderingReport:
+        """ Ширина ленты и прогноз заполнения LU-разложения матрицы проводимостей при текущей нумерации узлов. """
+        return orderingReport(self.__graph, method=self.__ordering)
+
+    def dispatchPayloads(self, payloads: List[ISchemaPayload]) -> None:
+        """ Распределить нагрузки шага по разделам. Предыдущие нагрузки разделов удаляются. """
+        x = np.fromiter((pl.x for pl in payloads), dtype=np.int64, count=len(payloads))
+        trackNumbers = np.fromiter((pl.trackNumber for pl in payloads), dtype=np.int64, count=len(payloads))
+        self.dispatchPositions(x, trackNumbers, payloads)
+
+    def dispatchPositions(self, x: np.ndarray, trackNumbers: np.ndarray, payloads: List[ISchemaPayload] | None = None) -> None:
+        """
+        Распределить нагрузки, заданные параллельными массивами координат и номеров путей, по разделам за один
+        проход searchsorted по границам разделов каждой ветви. Каждый раздел получает свои нагрузки
+        отсортированными по координате. Нагрузка на границе двух разделов достается левому.
+        """
+        loaded: Set[Partition] = set()
+        self.__dispatched = []
+        for p, xs, tns, idx in self.__binPositions(x, trackNumbers):
+            p.setPayloads(xs, tns, [payloads[j] for j in idx.tolist()] if payloads is not None else None)
+            loaded.add(p)
+            self.__dispatched.append((p, idx))
+        for p in self.__loadedPartitions - loaded:
+            p.removePayloads()
+        self.__pendingPartitions |= loaded | self.__loadedPartitions
+        self.__loadedPartitions = loaded
+
+    def planCapacity(self, schedule: Iterable[Tuple[np.ndarray, np.ndarray]]) -> None:
+        """
+        Определить емкости разделов по расписанию. Элемент расписания -- пара массивов (координаты, номера путей)
+        нагрузок на одном шаге.
+        """
+        steps: Dict[Partition, List[np.ndarray]] = {p: [] for partitions in self.partitions.values() for p in partitions}
+        for x, trackNumbers in schedule:
+            for p, xs, _, _ in self.__binPositions(np.asarray(x), np.asarray(trackNumbers)):
+                steps[p].append(xs)
+        for p, xx in steps.items():
+            p.planCapacity(xx)
+
+    def addNode(self, node: ICircuitNode) -> "RouteEdit":
+        """ Добавить исходный узел схемы (выделенный в хранилище графа) и перестроить затронутые разделы ветви. """
+        if node.store is not self.__store:
+            raise Exception("Узел выделен в другом хранилище")
+        ids = np.array([node.id], dtype=np.int64)
+        if self.__graph.isSchemaNode(ids)[0]:
+            raise Exception(f"Узел {node.id} уже входит в схему")
+        branchIndex, li, x = self.__locate(node.id)
+        lines = self.__schemaLines(branchIndex)
+        lineIds, xx = lines.get(li, (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)))
+        a, b = np.searchsorted(xx, [x, x + 1], side="left").tolist()
+        k = a + int(np.searchsorted(lineIds[a:b], node.id))
+        lines[li] = (np.insert(lineIds, k, node.id), np.insert(xx, k, x))
+        return self.__reroute(branchIndex, x, x, ids, lambda: self.__graph.addSchemaNode(node))
+
+    def removeNode(self, id: int) -> "RouteEdit":
+        """ Удалить исходный узел схемы и перестроить затронутые разделы ветви. """
+        ids = np.array([id], dtype=np.int64)
+        if not self.__graph.isSchemaNode(ids)[0]:
+            raise Exception(f"Узел {id} не входит в схему")
+        branchIndex, li, x = self.__locate(id)
+        lines = self.__schemaLines(branchIndex)
+        lineIds, xx = lines[li]
+        a, b = np.searchsorted(xx, [x, x + 1], side="left").tolist()
+        k = a + int(np.flatnonzero(lineIds[a:b] == id)[0])
+        if len(lineIds) == 1:
+            del lines[li]
+        else:
+            lines[li] = (np.delete(lineIds, k), np.delete(xx, k))
+        return self.__reroute(branchIndex, x, x, ids, lambda: self.__graph.removeSchemaNodeIds(ids))
+
+    def setBreaking(self, id: int, breaking: bool) -> "RouteEdit":
+        """ Включить или снять разрыв в исходном узле схемы и перестроить затронутые разделы ветви. """
+        ids = np.array([id], dtype=np.int64)
+        if not self.__graph.isSchemaNode(ids)[0]:
+            raise Exception(f"Узел {id} не входит в схему")
+        branchIndex, _, x = self.__locate(id)
+        self.__schemaLines(branchIndex)
+        self.__store.setBreaking(id, breaking)
+        return self.__reroute(branchIndex, x, x, ids, None)
+
+    def setNetwork(self, branchIndex: int, networks: List[AcNetworkDto]) -> "RouteEdit":
+        """
+        Заменить описание КС ветви и перестроить разделы на участке изменившихся звеньев. Звенья до и после
+        участка (и их решетки проводимостей) переиспользуются.
+        """
+        old = self.networks[branchIndex]
+        chain = self.__network[branchIndex]
+        n = min(len(old), len(networks))
+        lo = 0
+        while lo < n and sameNetwork(old[lo], networks[lo]):
+            lo += 1
+        if lo == len(old) == len(networks):
+            return RouteEdit.empty(branchIndex)
+        same = 0
+        while same < n - lo and sameNetwork(old[-1 - same], networks[-1 - same]):
+            same += 1
+        # левая граница первого звена общего хвоста задается предыдущим звеном, которое изменилось
+        keep = max(same - 1, 0)
+        xLeft = chain.chainLinks[lo - 1].xRight if lo > 0 else None
+        changed = BranchNetworkChain.fromAcNetworkDto(networks[lo:len(networks) - keep], xLeft).chainLinks
+        links = chain.chainLinks[:lo] + changed + chain.chainLinks[len(old) - keep:]
+        xa = xLeft if xLeft is not None else int(np.iinfo(np.int64).min)
+        xb = max(
+            chain.chainLinks[len(old) - keep - 1].xRight if len(old) - keep > lo else xa,
+            changed[-1].xRight if len(changed) > 0 else xa
+        )
+        self.__network = {**self.__network, branchIndex: BranchNetworkChain(list(links))}
+        self.networks = {**self.networks, branchIndex: networks}
+        self.__schemaLines(branchIndex)
+        return self.__reroute(branchIndex, xa, xb, np.empty(0, dtype=np.int64), None)
+
+    def __locate(self, id: int) -> Tuple[int, int, int]:
+        """ Ветвь, линия и координата узла. """
+        branchIndex, li = divmod(int(self.__store.lineIndex[id]), 10_000)
+        if branchIndex not in self.__network:
+            raise Exception(f"Нет описания КС ветви {branchIndex}")
+        return branchIndex, li, int(self.__store.x[id])
+
+    def __schemaLines(self, branchIndex: int) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        if self.__schema is None:
+            self.__schema = self.__arrangeNodesByBranchIndex(self.__graph.nodesBeforeWiring())
+        return self.__schema.setdefault(branchIndex, {})
+
+    def __reroute(self, branchIndex: int, xa: int, xb: int, edited: np.ndarray, graphEdit: Callable[[], None] | None) -> "RouteEdit":
+        """
+        Перестроить разделы ветви, затронутые правкой схемы на участке [xa, xb]. Построение начинается с правой
+        границы последнего раздела левее участка: состояние построителя на границе -- ее сечение и узлы схемы правее,
+        поэтому разделы левее участка не меняются. Построение прекращается на первой границе правее участка, которая
+        совпадает с границей прежних разделов с теми же узлами сечения: дальше построитель повторил бы прежние разделы.
+        Прежние разделы между этими границами удаляются из графа вместе с нагрузками; новые получают ячейки, если
+        они были у прежних. graphEdit -- изменение исходных узлов графа, выполняется после построения.
+        """
+        with metrics.phase("reroute"):
+            chain = self.__network[branchIndex]
+            old = self.partitions.get(branchIndex, [])
+            lines = self.__schemaLines(branchIndex)
+            builder = BranchBuilder(self.__store, self.__graph)
+            oldLeft = np.array([p.xLeft for p in old], dtype=np.int64)
+            # первый сохраняемый прежний раздел
+            resync = [len(old)]
+            created = self.__store.size
+
+            def stop(x: int, section: Dict[int, Tuple[int, int]]) -> bool:
+                # сечения совпадают, если в каждой линии тот же узел схемы или в обоих -- узел, созданный построителем
+                if x <= xb:
+                    return False
+                j = int(np.searchsorted(oldLeft, x, side="left"))
+                if j == 0 or j == len(old) or oldLeft[j] != x:
+                    return False
+                prev = old[j - 1].rightSection.ids
+                if len(prev) != len(section):
+                    return False
+                schema = self.__graph.isSchemaNode(prev)
+                for li, id, isSchema in zip(self.__lines(prev), prev.tolist(), schema.tolist()):
+                    node = section.get(li)
+                    if node is None or node[1] != id and (isSchema or node[1] < created):
+                        return False
+                resync[0] = j
+                return True
+
+            i = 0
+            if len(old) > 0 and len(lines) > 0:
+                i = min(int(np.searchsorted(self.__bounds(branchIndex), xa, side="left")), len(old) - 1)
+            if len(lines) == 0:
+                new: List[Partition] = []
+            elif i == 0:
+                new = builder.build({li: LineQueue(ids, xx) for li, (ids, xx) in lines.items()}, chain, branchIndex, stop)
+            else:
+                leftBound = old[i].xLeft
+                boundary = old[i - 1].rightSection.ids
+                leftSection = {li: (leftBound, id) for li, id in zip(self.__lines(boundary), boundary.tolist())}
+                queues: Dict[int, LineQueue] = {}
+                for li, (ids, xx) in lines.items():
+                    a, b = np.searchsorted(xx, [leftBound, leftBound + 1], side="left").tolist()
+                    q = LineQueue(ids[b:], xx[b:])
+                    # узлы в самой границе, не вошедшие в ее сечение, остаются в очереди
+                    for id in reversed(ids[a:b].tolist()):
+                        if leftSection.get(li, (0, -1))[1] != id:
+                            q.push((leftBound, id))
+                    queues[li] = q
+                rightBound = max(int(xx[-1]) for _, xx in lines.values())
+                if chain.last().xRight < rightBound:
+                    rightBound = chain.last().xRight
+                new = list(builder.sweep(queues, chain, branchIndex, leftBound, rightBound, leftSection, stop))
+            j = resync[0]
+            if j < len(old):
+                # сохраняемые разделы ссылаются на прежнее сечение границы; узлы, созданные для нее заново, не нужны
+                new[-1].rightSection = old[j - 1].rightSection
+            removed = old[i:j]
+
+            def sectionIds(partitions: List[Partition], cells: bool) -> List[np.ndarray]:
+                if cells:
+                    return [s.ids for p in partitions for c in p.cells() for s in (c.leftSection, c.rightSection)]
+                return [s.ids for p in partitions for s in (p.leftSection, p.rightSection)]
+
+            ready = any(len(p.cells()) > 0 for p in old)
+            oldIds = np.unique(np.concatenate(sectionIds(removed, ready) + [np.empty(0, dtype=np.int64)]))
+            newIds = np.unique(np.concatenate(sectionIds(new, False) + [np.empty(0, dtype=np.int64)]))
+            keptIds = [newIds, [NodeStore.GROUND]]
+            if i > 0:
+                keptIds.append(old[i - 1].rightSection.ids)
+            if j < len(old):
+                keptIds.append(old[j].leftSection.ids)
+            candidates = np.unique(np.concatenate((oldIds, newIds, edited)))
+            before = self.__graph.hasNodeIds(candidates)
+
+            removedEdges = [c.edgeIds() for p in removed for c in p.cells()]
+            for p in removed:
+                p.removePayloads()
+                for c in p.cells():
+                    self.__graph.removeEdgeBlock(c.edgeBlock)
+            if graphEdit is not None:
+                graphEdit()
+            garbage = np.setdiff1d(oldIds, np.concatenate(keptIds))
+            garbage = garbage[~self.__graph.isSchemaNode(garbage)]
+            if len(garbage) > 0:
+                self.__graph.removeNodeIds(garbage)
+            addedEdges = []
+            if ready:
+                for p in new:
+                    p.initCells()
+                    addedEdges.extend(c.edgeIds() for c in p.cells())
+            after = self.__graph.hasNodeIds(candidates)
+
+            self.partitions[branchIndex] = old[:i] + new + old[j:]
+            self.__partitionBounds.pop(branchIndex, None)
+            gone = set(removed)
+            self.__loadedPartitions -= gone
+            self.__pendingPartitions -= gone
+            self.__dispatched = [(p, idx) for p, idx in self.__dispatched if p not in gone]
+            self.__arranged = [p for p in self.__arranged if p not in gone]
+            if metrics.enabled:
+                metrics.count("router.partitionsRerouted", len(new))
+            return RouteEdit(
+                branchIndex,
+                len(removed),
+                len(new),
+                candidates[before & ~after],
+                candidates[~before & after],
+                np.concatenate(removedEdges) if len(removedEdges) > 0 else np.empty(0, dtype=np.int64),
+                np.concatenate(addedEdges) if len(addedEdges) > 0 else np.empty(0, dtype=np.int64)
+            )
+
+    def __lines(self, ids: np.ndarray) -> List[int]:
+        return (self.__store.lineIndex[ids] % 10_000).tolist()
+
+    def __bounds(self, branchIndex: int) -> np.ndarray:
+        """ Правые границы разделов ветви. """
+        bounds = self.__partitionBounds.get(branchIndex)
+        if bounds is None:
+            bounds = np.array([p.xRight for p in self.partitions[branchIndex]], dtype=np.int64)
+            self.__partitionBounds[branchIndex] = bounds
+        return bounds
+
+    def __arrangeNodesByBranchIndex(self, ids: np.ndarray) -> Dict[int, Dict[int, Tuple[np.ndarray, np.ndarray]]]:
+        """
+        Разложить узлы по ветвям и линиям за одну сортировку по (ветвь, линия, координата). Узлы каждой линии
+        занимают непрерывный отрезок отсортированного массива; для линии возвращаются идентификаторы и координаты.
+        """
+        res: Dict[int, Dict[int, Tuple[np.ndarray, np.ndarray]]] = {}
+        if len(ids) == 0:
+            return res
+        lineIndices = self.__store.lineIndex[ids]
+        xx = self.__store.x[ids]
+        order = np.lexsort((ids, xx, lineIndices))
+        ids, xx, lineIndices = ids[order], xx[order], lineIndices[order]
+        starts = np.flatnonzero(np.diff(lineIndices, prepend=lineIndices[0] - 1))
+        ends = np.append(starts[1:], len(ids))
+        for start, end, lineIndex in zip(starts.tolist(), ends.tolist(), lineIndices[starts].tolist()):
+            branch = res.setdefault(lineIndex // 10_000, {})
+            branch[lineIndex % 10_000] = (ids[start:end], xx[start:end])
+        return res
 
-        leftBound = min((min(q) for q in branchNodeQueues.values())).x
-        rightBound = max((max(q) for q in branchNodeQueues.values())).x
+    def __binPositions(self, x: np.ndarray, trackNumbers: np.ndarray) -> Iterator[Tuple[Partition, np.ndarray, np.ndarray, np.ndarray]]:
+        """ Разбить нагрузки по разделам. Для каждого занятого раздела -- координаты, номера путей и исходные индексы. """
+        branchIndices = trackNumbers // 10_000
+        order = np.lexsort((x, branchIndices))
+        x, trackNumbers, branchIndices = x[order], trackNumbers[order], branchIndices[order]
+        starts = np.searchsorted(branchIndices, list(self.partitions.keys()), side="left")
+        ends = np.searchsorted(branchIndices, list(self.partitions.keys()), side="right")
+        for (branchIndex, partitions), start, end in zip(self.partitions.items(), starts.tolist(), ends.tolist()):
+            bounds = self.__bounds(branchIndex)
+            xs = x[start:end]
+            idx = np.searchsorted(bounds, xs, side="left")
+            if len(partitions) > 0:
+                idx[xs < partitions[0].xLeft] = len(partitions)
+            occupied, firsts, counts = np.unique(idx, return_index=True, return_counts=True)
+            for i, a, n in zip(occupied.tolist(), (firsts + start).tolist(), counts.tolist()):
+                if i < len(partitions):
+                    yield partitions[i], x[a:a + n], trackNumbers[a:a + n], order[a:a + n]
+
+
+@dataclass
+class StepDelta:
+    """
+    Изменение графа за шаг расписания. edgeIds -- ребра блоков, добавленные в граф или с пересчитанными
+    проводимостями, conductivities -- их проводимости, edgeSources и edgeTargets -- их концы: ребра ячейки,
+    переподключенной к другим сечениям, сохраняют номера, но меняют концы, поэтому копия графа, которая ведется
+    по изменениям шагов, берет концы отсюда. detachedEdgeIds -- ребра отключенных ячеек. payloadNodes --
+    узел подключения каждой нагрузки шага (-1 для нагрузок вне разделов); attachedPayloadNodes и
+    detachedPayloadNodes -- узлы, к которым нагрузки подключились и от которых отключились по сравнению с
+    предыдущим шагом.
+    """
+    step: int
+    edgeIds: np.ndarray
+    conductivities: np.ndarray
+    edgeSources: np.ndarray
+    edgeTargets: np.ndarray
+    detachedEdgeIds: np.ndarray
+    payloadNodes: np.ndarray
+    attachedPayloadNodes: np.ndarray
+    detachedPayloadNodes: np.ndarray
+
+
+@dataclass
+class RouteEdit:
+    """
+    Изменение графа при правке схемы (Router.addNode, removeNode, setBreaking, setNetwork). removedPartitions и
+    addedPartitions -- число перестроенных разделов ветви до и после правки; removedNodeIds и addedNodeIds -- узлы,
+    удаленные из графа и добавленные в него; removedEdgeIds и addedEdgeIds -- номера ребер ячеек удаленных и
+    новых разделов. Нагрузки перестроенных разделов снимаются до следующего распределения (dispatchPositions).
+    """
+    branchIndex: int
+    removedPartitions: int
+    addedPartitions: int
+    removedNodeIds: np.ndarray
+    addedNodeIds: np.ndarray
+    removedEdgeIds: np.ndarray
+    addedEdgeIds: np.ndarray
+
+    @classmethod
+    def empty(cls, branchIndex: int) -> "RouteEdit":
+        none = np.empty(0, dtype=np.int64)
+        return cls(branchIndex, 0, 0, none, none, none, none)
+
+
+def sameNetwork(a: AcNetworkDto, b: AcNetworkDto) -> bool:
+    return a.coordinate == b.coordinate and a.trackQty == b.trackQty and a.resistivities == b.resistivities
+
+
+class BranchBuilder:
+    """
+    Построитель разделов одной ветви. Новые узлы выделяются в хранилище store, изменения графа передаются в graph
+    (граф или буфер ветви GraphBuffer).
+    """
+
+    def __init__(self, store: NodeStore, graph: Graph | GraphBuffer) -> None:
+        self.store = store
+        self.graph = graph
+
+    def build(
+            self,
+            branchNodeQueues: Dict[int, "LineQueue"],
+            branchNetwork: BranchNetworkChain,
+            branchIndex: int,
+            stop: Callable[[int, Dict[int, Tuple[int, int]]], bool] | None = None
+    ) -> List[Partition]:
+        """ Построить разделы ветви по очередям узлов ее линий (stop -- см. sweep). """
+        leftBound = min(q.first() for q in branchNodeQueues.values())
+        rightBound = max(q.last() for q in branchNodeQueues.values())
         if branchNetwork.last().xRight < rightBound:
             rightBound = branchNetwork.last().xRight
+        leftSection = self.__startSection(branchNodeQueues, branchNetwork, branchIndex, leftBound)
+        return list(self.sweep(branchNodeQueues, branchNetwork, branchIndex, leftBound, rightBound, leftSection, stop))
 
-        leftSection: Dict[int, ICircuitNode] = {}
-        for li in branchNetwork.findChainLink(leftBound).lines:
-            q = branchNodeQueues.get(li)
-            if q is None or len(q) == 0:
-                leftSection[li] = ICircuitNode.createInstance(
-                    leftBound, branchIndex, li)
-            else:
-                n = heapq.heappop(q)
-                if n.x > leftBound:
-                    heapq.heappush(q, n)
-                    leftSection[li] = ICircuitNode.createInstance(
-                        leftBound, branchIndex, + li)
-                else:
-                    leftSection[li] = n
+    def stream(self, source: "NodeStream", branchIndex: int) -> Iterator[Partition]:
+        """ Строить разделы по узлам и звеньям КС из потока, выдавая каждый раздел, как только он построен. """
+        leftBound = source.first()
+        if leftBound is None:
+            return
+        rightBound = source.advance(leftBound)
+        leftSection = self.__startSection(source.queues, source.chain, branchIndex, leftBound)  # type: ignore
+        yield from self.sweep(source.queues, source.chain, branchIndex, leftBound, rightBound, leftSection, advance=source.advance)  # type: ignore
 
-        while (leftBound < rightBound):
-            leftMost = rightBound
-            rightSection: Dict[int, ICircuitNode] = {}
+    def sweep(
+            self,
+            branchNodeQueues: Dict[int, "LineQueue"],
+            branchNetwork: BranchNetworkChain,
+            branchIndex: int,
+            leftBound: int,
+            rightBound: int,
+            leftSection: Dict[int, Tuple[int, int]],
+            stop: Callable[[int, Dict[int, Tuple[int, int]]], bool] | None = None,
+            advance: Callable[[int], int] | None = None
+    ) -> Iterator[Partition]:
+        """
+        Строить разделы от сечения leftSection в точке leftBound до rightBound. Состояние построителя на границе
+        разделов -- точка границы, узлы правого сечения (линия -> (координата, идентификатор)) и очереди узлов
+        правее границы, поэтому построение можно начать с любой границы. Если задан stop, он вызывается после
+        каждого раздела с его правой границей и правым сечением; построение прекращается, когда stop вернет True.
+        advance (потоковый режим) вызывается перед каждым разделом с его левой границей: он дочитывает узлы до правой
+        границы звена КС этой точки и возвращает правую границу ветви, если она уже известна.
+        """
+        zeroNode = self.store.ground()
+        while True:
+            if advance is not None:
+                rightBound = advance(leftBound)
+            if leftBound >= rightBound:
+                break
             cl = branchNetwork.findChainLink(leftBound)
+            rightSection: Dict[int, Tuple[int, int]] = {}
             defaultX = min(cl.xRight, rightBound)
-            ls = NetworkSection([])
-            rs = NetworkSection([])
+            leftMost = defaultX
+            ls: List[int] = []
+            rs: List[int] = []
+            skipped: List[int] = []
             for li in cl.lines:
                 q = branchNodeQueues.get(li)
-                node: ICircuitNode
+                node: Tuple[int, int]
                 if q is None or len(q) == 0:
-                    node = ICircuitNode.createInstance(
-                        defaultX, branchIndex, + li)
+                    node = self.__createNode(defaultX, branchIndex, li)
                 else:
-                    n = heapq.heappop(q)
-                    while n.x < leftBound:
-                        n = heapq.heappop(q)
-                    if n.x > defaultX:
-                        heapq.heappush(q, n)
-                        node = ICircuitNode.createInstance(
-                            defaultX, branchIndex, li)
+                    n = q.pop()
+                    while n[0] < leftBound:
+                        skipped.append(n[1])
+                        n = q.pop()
+                    if n[0] > defaultX:
+                        q.push(n)
+                        node = self.__createNode(defaultX, branchIndex, li)
                     else:
                         node = n
                 rightSection[li] = node
-                if node.x < leftMost:
-                    leftMost = node.x
+                if node[0] < leftMost:
+                    leftMost = node[0]
             for li in cl.lines:
                 node = rightSection[li]
-                if node.x > leftMost:
+                if node[0] > leftMost:
                     q = branchNodeQueues.get(li)
                     if q is None:
-                        node.x = leftMost
+                        self.store.setX(node[1], leftMost)
+                        rightSection[li] = (leftMost, node[1])
                     else:
-                        heapq.heappush(q, node)
-                        rightSection[li] = ICircuitNode.createInstance(
-                            leftMost, branchIndex, li)
-                rs.nodes.append(rightSection[li])
-                ls.nodes.append(
+                        q.push(node)
+                        rightSection[li] = self.__createNode(leftMost, branchIndex, li)
+                rs.append(rightSection[li][1])
+                ls.append(
                     self.__copyIfBreaking(
                         leftSection.get(li) or
-                        ICircuitNode.createInstance(leftBound, branchIndex, li)
+                        self.__createNode(leftBound, branchIndex, li)
                     )
                 )
-            partitions.append(Partition(leftBound, leftMost,
-                              ls, rs, zeroNode, cl.lattice, self.__graph))
+            p = Partition(leftBound, leftMost,
+                          NetworkSection.fromIds(np.array(ls), self.store),
+                          NetworkSection.fromIds(np.array(rs), self.store),
+                          zeroNode, cl.lattice, self.graph)
+            # узлы прежнего правого сечения, не вошедшие в левое сечение раздела, и пропущенные узлы очередей
+            skipped.extend(id for _, id in leftSection.values() if id not in ls)
+            p.orphanIds = np.array(skipped, dtype=np.int64)
+            yield p
             leftSection = rightSection
             leftBound = leftMost
+            if stop is not None and stop(leftBound, rightSection):
+                break
 
-        return partitions
-
-    def __arrangeNodesByBranchIndex(self, nodes: Set[ICircuitNode]) -> Dict[int, Dict[int, List[ICircuitNode]]]:
-        res: Dict[int, Dict[int, List[ICircuitNode]]] = {}
-        for node in nodes:
-            branchIndex = node.branchIndex()
-            branch = res.get(branchIndex)
-            if branch is None:
-                branch = {}
-                res[branchIndex] = branch
-            li = node.relativeLineIndex()
-            h = branch.get(li)
-            if h is None:
-                h = []
-                heapq.heapify(h)
-                branch[li] = h
-            if node not in h:
-                heapq.heappush(h, node)
-        return res
+    def __startSection(
+            self,
+            branchNodeQueues: Dict[int, "LineQueue"],
+            branchNetwork: BranchNetworkChain,
+            branchIndex: int,
+            leftBound: int
+    ) -> Dict[int, Tuple[int, int]]:
+        """ Левое сечение первого раздела: узлы линий в точке leftBound, недостающие создаются. """
+        # узлы представлены парами (координата, идентификатор)
+        leftSection: Dict[int, Tuple[int, int]] = {}
+        for li in branchNetwork.findChainLink(leftBound).lines:
+            q = branchNodeQueues.get(li)
+            if q is None or len(q) == 0:
+                leftSection[li] = self.__createNode(leftBound, branchIndex, li)
+            else:
+                n = q.pop()
+                if n[0] > leftBound:
+                    q.push(n)
+                    leftSection[li] = self.__createNode(leftBound, branchIndex, li)
+                else:
+                    leftSection[li] = n
+        return leftSection
 
-    def __copyIfBreaking(self, node: ICircuitNode) -> ICircuitNode:
-        if node.breaking:
-            cp = ICircuitNode(node.lineIndex, node.axisCoordinate(), False)
-            cp.duplicatedBreakingNode = True
+    def __createNode(self, x: int, branchIndex: int, li: int) -> Tuple[int, int]:
+        return x, self.store.allocate(branchIndex * 10_000 + li, x)
+
+    def __copyIfBreaking(self, node: Tuple[int, int]) -> int:
+        x, id = node
+        if self.store.breaking[id]:
+            cp = self.store.allocate(int(self.store.lineIndex[id]), x)
+            self.store.setDuplicatedBreakingNode(cp, True)
             return cp
-        return node
+        return id
+
+
+def buildBranch(
+        branchIndex: int,
+        branchNetwork: BranchNetworkChain,
+        lines: List[Tuple[int, np.ndarray, np.ndarray]],
+        breaking: np.ndarray,
+        duplicated: np.ndarray,
+        initCells: bool
+) -> Tuple[List[Partition], GraphBuffer, NodeStore]:
+    """
+    Построить разделы ветви на локальном хранилище (задача для пула потоков или процессов). lines -- узлы ветви
+    по линиям: (линия, координаты, индексы линий), отсортированные по координате; breaking и duplicated -- признаки
+    узлов в том же порядке. Узлы ветви копируются в локальное хранилище с идентификаторами 1, 2, ... в этом порядке,
+    новые узлы получают следующие идентификаторы. Изменения графа записываются в буфер.
+    """
+    count = sum(len(xx) for _, xx, _ in lines)
+    store = NodeStore(count + 1)
+    queues: Dict[int, LineQueue] = {}
+    for li, xx, lineIndices in lines:
+        ids = store.allocateMany(lineIndices, xx)
+        queues[li] = LineQueue(ids, xx)
+    store.setBreaking(np.arange(1, count + 1), breaking)
+    store.setDuplicatedBreakingNode(np.arange(1, count + 1), duplicated)
+    buffer = GraphBuffer(store)
+    partitions = BranchBuilder(store, buffer).build(queues, branchNetwork, branchIndex)
+    if initCells:
+        for p in partitions:
+            p.initCells()
+    return partitions, buffer, store
+
+
+class LineQueue:
+    """
+    Очередь узлов линии по возрастанию координаты: отсортированный отрезок узлов и курсор. Узел представлен парой
+    (координата, идентификатор). Возвращенные в очередь узлы (не правее головы очереди) хранятся в стеке.
+    Массивы переводятся в пары порциями по мере чтения: очередь, из которой взята только голова (перестроение
+    нескольких разделов длинной линии), не обходит остальные узлы.
+    """
+
+    CHUNK = 256
+
+    def __init__(self, ids: np.ndarray, xx: np.ndarray) -> None:
+        self.__ids = ids
+        self.__xx = xx
+        self.__chunk: List[Tuple[int, int]] = []
+        self.__chunkStart = 0
+        self.__cursor = 0
+        self.__returned: List[Tuple[int, int]] = []
+
+    def first(self) -> int:
+        return self.__at(self.__cursor)[0]
+
+    def last(self) -> int:
+        return int(self.__xx[-1])
+
+    def pop(self) -> Tuple[int, int]:
+        if metrics.enabled:
+            metrics.count("builder.queuePops")
+        if len(self.__returned) > 0:
+            return self.__returned.pop()
+        if self.__cursor == len(self.__xx):
+            raise IndexError("pop from empty queue")
+        self.__cursor += 1
+        return self.__at(self.__cursor - 1)
+
+    def push(self, node: Tuple[int, int]) -> None:
+        if metrics.enabled:
+            metrics.count("builder.queuePushes")
+        self.__returned.append(node)
+
+    def __len__(self) -> int:
+        return len(self.__xx) - self.__cursor + len(self.__returned)
+
+    def __at(self, i: int) -> Tuple[int, int]:
+        k = i - self.__chunkStart
+        if k < 0 or k >= len(self.__chunk):
+            end = i + LineQueue.CHUNK
+            self.__chunk = list(zip(self.__xx[i:end].tolist(), self.__ids[i:end].tolist()))
+            self.__chunkStart = i
+            k = 0
+        return self.__chunk[k]
+
+
+class StreamQueue:
+    """ Очередь узлов линии, пополняемая из потока (см. NodeStream). Интерфейс -- как у LineQueue. """
+
+    def __init__(self) -> None:
+        self.__nodes: Deque[Tuple[int, int]] = deque()
+        self.__returned: List[Tuple[int, int]] = []
+
+    def append(self, node: Tuple[int, int]) -> None:
+        self.__nodes.append(node)
+
+    def pop(self) -> Tuple[int, int]:
+        if len(self.__returned) > 0:
+            return self.__returned.pop()
+        return self.__nodes.popleft()
+
+    def push(self, node: Tuple[int, int]) -> None:
+        self.__returned.append(node)
+
+    def __len__(self) -> int:
+        return len(self.__nodes) + len(self.__returned)
+
+
+class NodeStream:
+    """
+    Узлы и звенья КС ветви из потоков, отсортированных по координате (BranchBuilder.stream). Узел потока -- запись
+    (lineIndex, x, breaking), x в метрах. Узлы читаются в хранилище по мере продвижения построителя: до правой
+    границы звена КС, в котором находится построитель, и еще на один узел дальше. Узлы линий, которых нет в звене
+    КС в их точке, построителю не нужны и в хранилище не попадают; звенья левее построителя отбрасываются.
+    """
+
+    def __init__(
+            self,
+            nodes: Iterable[Tuple[int, int, bool]],
+            networks: Iterable[AcNetworkDto],
+            store: NodeStore,
+            branchIndex: int
+    ) -> None:
+        self.store = store
+        self.branchIndex = branchIndex
+        self.chain = StreamingChain(networks)
+        self.queues: Dict[int, StreamQueue] = {}
+        self.read = 0
+        self.__nodes = iter(nodes)
+        self.__next: Tuple[int, int, bool] | None = None
+        self.__maxX: int | None = None
+        self.__fetch()
+
+    def first(self) -> int | None:
+        """ Координата первого узла потока. """
+        return self.__next[1] if self.__next is not None else None
+
+    def advance(self, x: int) -> int:
+        """
+        Продвинуть построитель в точку x: дочитать узлы до правой границы звена КС точки x. Возвращает правую границу
+        ветви (меньшую из координаты последнего узла и правой границы КС), если она не правее этого звена, иначе
+        правую границу звена -- построитель все равно не выходит за нее в одном разделе.
+        """
+        self.chain.release(x)
+        cl = self.chain.findChainLink(x)
+        while self.__next is not None and self.__next[1] <= cl.xRight:
+            self.__take()
+        self.chain.readUntil(cl.xRight)
+        rightBound = cl.xRight
+        if self.__next is None and self.__maxX is not None:
+            rightBound = min(rightBound, self.__maxX)
+        end = self.chain.end()
+        if end is not None:
+            rightBound = min(rightBound, end)
+        return rightBound
+
+    def __fetch(self) -> None:
+        record = next(self.__nodes, None)
+        if record is not None:
+            lineIndex, x, breaking = record
+            if lineIndex // 10_000 != self.branchIndex:
+                raise Exception(f"Узел линии {lineIndex} не принадлежит ветви {self.branchIndex}")
+            if self.__maxX is not None and x < self.__maxX:
+                raise Exception(f"Узлы потока не упорядочены по координате -- {x}")
+            record = (int(lineIndex), int(x), bool(breaking))
+        self.__next = record
+
+    def __take(self) -> None:
+        lineIndex, x, breaking = self.__next  # type: ignore
+        self.__maxX = x
+        self.read += 1
+        li = lineIndex % 10_000
+        cl = self.chain.linkAt(x)
+        if cl is not None and li in cl.lines:
+            q = self.queues.get(li)
+            if q is None:
+                q = self.queues[li] = StreamQueue()
+            q.append((x, self.store.allocate(lineIndex, x, breaking)))
+        self.__fetch()
+
+
+def streamPartitions(
+        branchIndex: int,
+        nodes: Iterable[Tuple[int, int, bool]],
+        networks: Iterable[AcNetworkDto],
+        store: NodeStore | None = None,
+        graph: Graph | GraphBuffer | None = None
+) -> Iterator[Partition]:
+    """
+    Потоковое построение разделов ветви: узлы (lineIndex, x, breaking) и звенья КС читаются из итераторов,
+    отсортированных по координате, а каждый раздел выдается, как только зафиксировано его правое сечение. В памяти
+    построителя -- только узлы и звенья текущего звена КС, поэтому очень длинные ветви можно обрабатывать окнами:
+    потребитель создает ячейки выданных разделов (initCells), рассчитывает их и отпускает (Partition.release) в
+    порядке выдачи. Отпущенный раздел удаляет из графа свои блоки ребер и узлы, а их идентификаторы возвращает
+    хранилищу, поэтому граф и хранилище не растут с длиной ветви. Разделы совпадают по границам и сечениям с
+    Router.buildPartitions. Граф по умолчанию -- пустой граф над хранилищем store.
+    """
+    if store is None:
+        store = NodeStore()
+    if graph is None:
+        graph = Graph([], store)
+    return BranchBuilder(store, graph).stream(NodeStream(nodes, networks, store, branchIndex), branchIndex)
 
 
 if __name__ == "__main__":
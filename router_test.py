@@ -1,7 +1,24 @@
+import asyncio
+import json
+import os
+import tempfile
+import tracemalloc
 import unittest
-from context import AcNetworkDto, ICircuitNode
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Set, Tuple
+import numpy as np
+import benchmark
+import metrics
+import snapshot
+from cell import Cell
+from context import AcNetworkDto, AcNetworkLattice, ICircuitEdge, ICircuitNode, ISchemaPayload, NodeStore, Side
 from graph import Graph
-from router import Router
+from ingest import PositionIngestor
+from network import BranchNetworkChain, NetworkSection
+from ordering import ORDERINGS
+from pipeline import AdmittanceAssembly, StepPipeline
+from router import RouteEdit, Router, streamPartitions
+from solver import BandedLU
 
 
 class RouterTest(unittest.TestCase):
@@ -9,20 +26,7 @@ class RouterTest(unittest.TestCase):
         super().__init__(methodName)
 
     def test(self):
-        np = nodeProducer(1)
-        n1 = [np(1), np(2, True), np(5), np(13), np(15), np(20)]
-
-        np = nodeProducer(2)
-        n2 = [np(0), np(2, True), np(4), np(5)]
-
-        np = nodeProducer(3)
-        n3 = [np(2, True), np(6), np(17), np(22, True), np(25)]
-
-        graph = Graph(n1 + n2 + n3)
-
-        ntw = {0: [AcNetworkDto(10, 3), AcNetworkDto(21, 2), AcNetworkDto(24, 3)]}
-
-        r = Router(graph, ntw)
+        r, graph = buildTestRouter()
         r.buildPartitions()
         # for partitions in r.partitions.values():
         #     for p in partitions:
@@ -34,9 +38,992 @@ class RouterTest(unittest.TestCase):
         #             p.firstCell.pullRightSection((p.xRight + p.xLeft) // 2)
 
         print(r.partitions[0])
+        self.assertEqual(str(r.partitions[0]), EXPECTED_PARTITIONS)
         print(sorted(graph.nodes()))
         graph.plot(showZeroNode=False, shift=0.1)
 
+    def testNodeHandle(self):
+        store = NodeStore(capacity=2)
+        n = ICircuitNode(10_003, 1.5, True, store)
+        self.assertEqual((n.lineIndex, n.x, n.breaking), (10_003, 1500, True))
+        self.assertEqual((n.branchIndex(), n.relativeLineIndex()), (1, 3))
+        n.x = 2000
+        self.assertEqual(store.x[n.id], 2000)
+        self.assertEqual(store.node(n.id), n)
+        self.assertNotEqual(ICircuitNode(10_003, 2, store=store), n)
+        self.assertEqual(ICircuitNode(0, 0, store=store), ICircuitNode(0, 5, store=store))
+        self.assertEqual(hash(ICircuitNode(10_000, 0, store=store)), NodeStore.GROUND)
+
+    def testCellEdges(self):
+        store = NodeStore()
+        left = NetworkSection([ICircuitNode(1, 0, store=store), ICircuitNode(2, 0, store=store)])
+        right = NetworkSection([ICircuitNode(1, 10, store=store), ICircuitNode(2, 10, store=store)])
+        graph = Graph([], store)
+        cell = Cell(0, 10_000, left, right, LengthLattice(), graph, ICircuitNode(0, 0, store=store))
+        b = cell.edgeBlock
+        self.assertEqual(len(b), 10)
+        self.assertEqual(len(graph.edges()), 10)
+        self.assertTrue(np.all((b.source == b.target) == False))
+        self.assertEqual(int((b.target == NodeStore.GROUND).sum()), 4)
+        self.assertTrue(np.allclose(b.conductivities(), 10_000))
+        cell.pullRightSection(4000)
+        self.assertEqual(right.get(1).x, 4000)
+        self.assertTrue(np.allclose(b.conductivities(), 4000))
+        self.assertEqual(cell.edges[1].c, 4000)
+
+    def testLattice(self):
+        z = {(1, 1): 0.2 + 0.6j, (2, 2): 0.2 + 0.6j, (1, 2): 0.05 + 0.3j}
+        lattice = AcNetworkLattice({1, 2}, z, cacheSize=2)
+        li = np.array([1, 2, 1, 2])
+        sides = np.array([0, 0, 1, 1])
+        i, j = np.triu_indices(4)
+        c = lattice.condBatch(li[i], sides[i], li[j], sides[j], np.full(len(i), 2000))
+        # матрица узловых проводимостей, собранная из ребер, совпадает с матрицей 4-полюсника
+        y = np.zeros((4, 4), dtype=complex)
+        for a, b, g in zip(i, j, c):
+            y[a, a] += g
+            if a != b:
+                y[b, b] += g
+                y[a, b] -= g
+                y[b, a] -= g
+        a = np.linalg.inv(np.array([[0.2 + 0.6j, 0.05 + 0.3j], [0.05 + 0.3j, 0.2 + 0.6j]]) * 2)
+        self.assertTrue(np.allclose(y, np.block([[a, -a], [-a, a]])))
+        self.assertAlmostEqual(lattice.cond(1, Side.Left, 1, Side.Right, 2000), c[2])
+        lattice.condBatch(li, sides, li, sides, np.array([1000, 1000, 3000, 3000]))
+        info = lattice.cacheInfo()
+        self.assertEqual((info.hits, info.misses, info.size), (1, 3, 2))
+        self.assertAlmostEqual(info.hitRatio, 0.25)
+        # пустой запрос -- пустой массив проводимостей, кэш не затрагивается
+        empty = np.empty(0, dtype=np.int64)
+        c = lattice.condBatch(empty, empty, empty, empty, empty)
+        self.assertEqual((c.shape, c.dtype), ((0,), np.complex128))
+        self.assertEqual(lattice.cacheInfo(), info)
+
+    def testIncrementalArrangement(self):
+        r, graph = buildTestRouter()
+        r.buildPartitions()
+        p = r.partitions[0][5]
+        p.updateCapacity([7000, 8000, 9000])
+        r.initCells()
+
+        def place(xx, incremental):
+            p.removePayloads()
+            pls = [ISchemaPayload(x) for x in xx]
+            for pl in pls:
+                pl.trackNumber = 2
+            p.addPayloads(pls)
+            return p.arrangePayloads(incremental), pls
+
+        place([7, 9], False)
+        full = [(c.xLeft, c.xRight) for c in p.cells()]
+        place([8, 9.5], True)
+        changed, pls = place([7, 9], True)
+        self.assertEqual([(c.xLeft, c.xRight) for c in p.cells()], full)
+        self.assertEqual(pls[0].iplEdge.getSourceNode().x, 7000)
+        self.assertEqual(pls[0].iplEdge.getSourceNode().lineIndex, 2)
+        changed, _ = place([7, 9.2], True)
+        cells = p.cells()
+        # свободное сечение 8000 остается на месте, пересчитываются только ячейки по обе стороны от 9200
+        self.assertEqual([c.xLeft for c in cells], [6000, 7000, 8000, 9200])
+        self.assertTrue(np.array_equal(changed, np.concatenate([cells[2].edgeIds(), cells[3].edgeIds()])))
+        changed, _ = place([7, 9.2], True)
+        self.assertEqual(len(changed), 0)
+
+    def testConnectionIndex(self):
+        r, graph = buildTestRouter()
+        r.buildPartitions()
+        p = r.partitions[0][5]
+        p.updateCapacity([7000, 8000, 9000])
+        r.initCells()
+        store = graph.store
+        for xx in ([7000, 9000], [8000, 9500], [7000], [7000, 8000, 9000]):
+            p.setPayloads(np.array(xx), np.full(len(xx), 2))
+            p.arrangePayloads(True)
+            for c in p.cells():
+                self.assertIs(p.cellAt(c.xLeft), c)
+                for n in c.leftSection:
+                    self.assertEqual(p.connectingNode(c.xLeft, n.lineIndex), n.id)
+            self.assertIs(p.cellAt(p.xRight), p.lastCell)
+            self.assertEqual(store.x[p.payloadNodes()].tolist(), xx)
+        with self.assertRaises(Exception):
+            p.connectingNode(8500, 2)
+        with self.assertRaises(Exception):
+            p.cellAt(9500)
+        # сечение встает в точку, которую освобождает другое сечение
+        for xx in ([7000, 8000], [8000, 8500]):
+            p.setPayloads(np.array(xx), np.full(len(xx), 2))
+            p.arrangePayloads(True)
+            self.assertEqual(store.x[p.payloadNodes()].tolist(), xx)
+            self.assertEqual(store.lineIndex[p.payloadNodes()].tolist(), [2, 2])
+
+    def testLongChainPull(self):
+        store = NodeStore()
+        graph = Graph([], store)
+        zeroNode = ICircuitNode(0, 0, store=store)
+        lattice = CountingLattice()
+        sections = [NetworkSection([ICircuitNode(1, x, store=store)]) for x in range(5001)]
+        cells = [Cell(i * 1000, (i + 1) * 1000, sections[i], sections[i + 1], lattice, graph, zeroNode) for i in range(5000)]
+        for prev, next in zip(cells, cells[1:]):
+            prev.next = next
+            next.prev = prev
+        lattice.calls = 0
+        cells[0].pullRightSection(4_500_500)
+        self.assertEqual(lattice.calls, 4501)
+        self.assertEqual((cells[4499].xLeft, cells[4499].xRight), (4_500_500, 4_500_500))
+        self.assertEqual((cells[4500].xLeft, cells[4500].xRight), (4_500_500, 4_501_000))
+        self.assertEqual(sections[10].get(0).x, 4_500_500)
+
+    def testDispatch(self):
+        r, graph = buildTestRouter()
+        r.buildPartitions()
+        x = np.array([7000, 2000, 13_000, 1500, 30_000, 7500, 24_000])
+        trackNumbers = np.array([1, 2, 2, 3, 1, 1, 3])
+        for p in r.partitions[0]:
+            p.updateCapacity(x.tolist())
+        r.initCells()
+        pls = []
+        for xi, tn in zip(x.tolist(), trackNumbers.tolist()):
+            pl = ISchemaPayload(xi / 1000)
+            pl.trackNumber = tn
+            pls.append(pl)
+
+        r.dispatchPayloads(pls)
+        for p in r.partitions[0]:
+            p.arrangePayloads(True)
+        nodes = [p.payloadNodes().tolist() for p in r.partitions[0]]
+        self.assertEqual([i for i, n in enumerate(nodes) if len(n) > 0], [1, 5, 6, 11])
+        self.assertEqual([n.x for n in graph.store.nodes(nodes[5])], [7000, 7500])
+        self.assertEqual(pls[0].iplEdge.getSourceNode().x, 7000)
+        # нагрузка на границе разделов достается левому разделу
+        self.assertEqual(pls[1].iplEdge.getSourceNode(), r.partitions[0][1].rightSection.get(1))
+
+        # без объектов нагрузок узлы подключения те же, а разделы, из которых нагрузки ушли, очищаются
+        r.dispatchPositions(x[:3], trackNumbers[:3])
+        for p in r.partitions[0]:
+            p.arrangePayloads(True)
+        self.assertEqual(r.partitions[0][1].payloadNodes().tolist(), nodes[1][1:])
+        self.assertEqual(r.partitions[0][11].payloadNodes().tolist(), [])
+
+    def testDispatchBuckets(self):
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        reference, _ = buildJunctionRouter()
+        reference.buildPartitions(True)
+        rng = np.random.default_rng(17)
+        x = (rng.random(60) * 75_000).astype(np.int64)
+        trackNumbers = rng.integers(0, 4, 60) * 10_000 + rng.integers(1, 3, 60)
+        # границы разделов, включая последнюю координату ветви и левую границу первого раздела
+        bounds = [(p.xRight, 10_000 * b + 1) for b, ps in r.partitions.items() for p in ps[::5] + [ps[-1]]]
+        bounds += [(ps[0].xLeft, 10_000 * b + 2) for b, ps in r.partitions.items()]
+        x = np.append(x, [bx for bx, _ in bounds])
+        trackNumbers = np.append(trackNumbers, [tn for _, tn in bounds])
+        order = rng.permutation(len(x))
+        x, trackNumbers = x[order], trackNumbers[order]
+
+        r.dispatchPositions(x, trackNumbers)
+        r.arrangePayloads(True)
+        # прежний поиск раздела для каждой нагрузки: первый раздел ветви, в границы которого она попадает
+        for xi, tn in zip(x.tolist(), trackNumbers.tolist()):
+            pl = ISchemaPayload(xi / 1000)
+            pl.trackNumber = tn
+            for p in reference.partitions[tn // 10_000]:
+                if p.addPayload(pl):
+                    break
+        for ps in reference.partitions.values():
+            for p in ps:
+                p.arrangePayloads(True)
+
+        def buckets(router: Router):
+            store = router.graph.store
+            return [[list(zip(store.x[nodes].tolist(), store.lineIndex[nodes].tolist())) for nodes in (p.payloadNodes() for p in ps)] for ps in router.partitions.values()]
+
+        expected = buckets(reference)
+        self.assertEqual(buckets(r), expected)
+        # нагрузки вне разделов не распределяются
+        self.assertLess(sum(len(bucket) for branch in expected for bucket in branch), len(x))
+
+    def testCellPool(self):
+        r, graph = buildTestRouter()
+        r.buildPartitions()
+        r.initCells()
+        p = r.partitions[0][5]
+        track = np.array([2, 2, 2])
+        schedule = [(np.array([7000]), track[:1]), (np.array([7000, 8000, 9000]), track), (np.array([8500]), track[:1])]
+        r.planCapacity(schedule)
+        self.assertEqual(p.capacity(), 4)
+        self.assertEqual(r.partitions[0][0].capacity(), 1)
+        # цепочка сразу приводится к емкости, свободные сечения расставлены равномерно
+        self.assertEqual([c.xLeft for c in p.cells()], [6000, 7000, 8000, 9000])
+        blocks = len(graph.edgeBlocks())
+        nodes = len(graph.nodes())
+        version = graph.version
+
+        offsets = set()
+        for x, tn in schedule + schedule:
+            r.dispatchPositions(x, tn)
+            p.arrangePayloads(True)
+            self.assertEqual(len(p.cells()), 4)
+            self.assertTrue(all(c.xLeft < c.xRight for c in p.cells()))
+            for xi in x:
+                p.connectingNode(int(xi), 2)
+            offsets.update(c.edgeBlock.offset for c in p.cells())
+        # пока емкость не меняется, узлы и блоки ребер графа остаются прежними
+        self.assertEqual(len(offsets), 4)
+        self.assertEqual(len(graph.edgeBlocks()), blocks)
+        self.assertEqual(len(graph.nodes()), nodes)
+        self.assertEqual(graph.version, version)
+        r.dispatchPositions(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        p.arrangePayloads(True)
+        self.assertEqual(len(p.detachedEdges()), 0)
+        self.assertEqual(graph.version, version)
+
+        # при уменьшении емкости лишние ячейки и сечения отключаются от графа
+        r.planCapacity([(np.array([7000]), track[:1])])
+        self.assertEqual(p.capacity(), 2)
+        self.assertEqual(len(p.cells()), 2)
+        self.assertEqual(len(p.detachedEdges()), 2 * len(p.cells()[0].edgeBlock))
+        self.assertEqual(len(graph.edgeBlocks()), blocks - 2)
+        self.assertEqual(len(graph.nodes()), nodes - 2 * len(p.cells()[0].rightSection.ids))
+
+    def testChainOscillation(self):
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        rng = np.random.default_rng(7)
+        cycle = []
+        for n in (0, 11, 2, 9, 1, 11, 3, 10):
+            cycle.append(((rng.random(n) * 60_000).astype(np.int64), rng.integers(0, 4, n) * 10_000 + rng.integers(1, 3, n)))
+
+        # число нагрузок колеблется выше емкости разделов: цепочки удлиняются и укорачиваются, но ячейки и сечения
+        # берутся из пулов разделов, и после первого цикла хранилище и номера ребер не растут
+        sizes = []
+        for delta in r.simulate(cycle * 40):
+            if delta.step % len(cycle) == len(cycle) - 1:
+                sizes.append((graph.store.size, graph.edgeCount()))
+        self.assertEqual(len(set(sizes[1:])), 1)
+        matrix = graph.admittanceMatrix()
+        np.testing.assert_allclose(matrix.toDense(), denseAdmittance(graph))
+
+    def testAdmittanceMatrix(self):
+        r, graph = buildTestRouter()
+        r.buildPartitions()
+        r.initCells()
+        m = graph.admittanceMatrix()
+        np.testing.assert_allclose(m.toDense(), denseAdmittance(graph))
+        pattern = m.indices.copy()
+
+        p = r.partitions[0][5]
+        pls = [ISchemaPayload(7), ISchemaPayload(8.5)]
+        for pl in pls:
+            pl.trackNumber = 2
+            pl.iplEdge.c = 0.5 + 0.1j
+        r.dispatchPayloads(pls)
+        changed = p.arrangePayloads(True)
+        m = graph.admittanceMatrix(changed)
+        np.testing.assert_allclose(m.toDense(), denseAdmittance(graph))
+
+        # изменение проводимостей не меняет шаблон и переносится в data на месте
+        pattern = m.indices.copy()
+        data = m.data
+        pls[0].x, pls[1].x = 7500, 9000
+        r.dispatchPayloads(pls)
+        changed = p.arrangePayloads(True)
+        m = graph.admittanceMatrix(changed)
+        self.assertIs(m.data, data)
+        self.assertTrue(np.array_equal(m.indices, pattern))
+        np.testing.assert_allclose(m.toDense(), denseAdmittance(graph))
+        np.testing.assert_allclose(m.toScipy().toarray(), m.toDense())
+
+    def testOrdering(self):
+        reports = {}
+        for method in ORDERINGS:
+            r, graph = buildTestRouter(method)
+            r.buildPartitions()
+            r.initCells()
+            order = graph.numbering()
+            ids = graph.nodeIds()
+            self.assertEqual(sorted(order.tolist()), sorted(ids[ids != NodeStore.GROUND].tolist()))
+            if method == "coordinate":
+                self.assertTrue(np.all(np.diff(graph.store.x[order]) >= 0))
+            report = r.orderingReport()
+            reports[method] = report
+            # прогноз совпадает со структурой множителя L, полученной исключением по шаблону матрицы
+            pattern = graph.admittanceMatrix().toScipy().toarray() != 0
+            np.fill_diagonal(pattern, True)
+            rows, cols = np.nonzero(np.tril(pattern))
+            self.assertEqual(report.bandwidth, int(np.max(rows - cols)))
+            for k in range(len(pattern) - 1):
+                pattern[k + 1:, k + 1:] |= np.outer(pattern[k + 1:, k], pattern[k, k + 1:])
+            self.assertEqual(report.factorNnz, np.count_nonzero(np.tril(pattern)))
+        self.assertLessEqual(reports["rcm"].bandwidth, reports["coordinate"].bandwidth)
+        self.assertLessEqual(reports["minimumDegree"].factorNnz, reports["coordinate"].factorNnz)
+
+    def testBandedLU(self):
+        r, graph = buildTestRouter()
+        r.buildPartitions()
+        r.initCells()
+        pls = [ISchemaPayload(7), ISchemaPayload(18)]
+        for pl in pls:
+            pl.trackNumber = 2
+            pl.iplEdge.c = 0.3 + 0.2j
+        r.dispatchPayloads(pls)
+        for partitions in r.partitions.values():
+            for p in partitions:
+                p.arrangePayloads(True)
+        m = graph.admittanceMatrix()
+        lu = BandedLU(m)
+
+        def dense():
+            d = m.toDense()
+            floating = ~np.any(d != 0, axis=1)
+            d[floating, floating] = 1
+            return d
+
+        rhs = np.arange(m.shape[0]) + 1j
+        np.testing.assert_allclose(lu.solve(rhs), np.linalg.solve(dense(), rhs))
+        rhs2 = np.stack((rhs, rhs.conj()), axis=1)
+        np.testing.assert_allclose(lu.solve(rhs2), np.linalg.solve(dense(), rhs2))
+
+        # изменилась проводимость нагрузки правее начала сети -- пересчитывается только хвостовой блок
+        pls[1].iplEdge.c = 2 + 1j
+        graph.admittanceMatrix(np.empty(0, dtype=np.int64))
+        start = lu.update()
+        self.assertGreater(start, 0)
+        self.assertLess(start, m.shape[0])
+        np.testing.assert_allclose(lu.solve(rhs), np.linalg.solve(dense(), rhs))
+        self.assertEqual(lu.update(), m.shape[0])
+
+    def testSteadyStructure(self):
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        rng = np.random.default_rng(5)
+        schedule = []
+        for _ in range(6):
+            x = (rng.random(8) * 60_000).astype(np.int64)
+            schedule.append((x, rng.integers(0, 4, 8) * 10_000 + rng.integers(1, 3, 8)))
+        r.planCapacity(schedule)
+        version = graph.version
+        m = graph.admittanceMatrix()
+        indices = m.indices
+        lu = BandedLU(m)
+        bandwidth = lu.bandwidth
+
+        # нагрузки переходят между разделами, но пока емкость не меняется, узлы и блоки графа остаются прежними:
+        # матрица обновляется на месте, а разложение -- с первой затронутой строки без повторного анализа
+        loaded = []
+        for delta in r.simulate(schedule):
+            loaded.append({id(p) for ps in r.partitions.values() for p in ps if p.hasPayloads()})
+            self.assertEqual(graph.version, version)
+            self.assertEqual(len(delta.detachedEdgeIds), 0)
+            m = graph.admittanceMatrix(delta.edgeIds)
+            self.assertIs(m.indices, indices)
+            lu.update()
+            self.assertEqual(lu.bandwidth, bandwidth)
+            self.assertEqual(m.version, version)
+        self.assertGreater(len(set.union(*loaded) - set.intersection(*loaded)), 0)
+        np.testing.assert_allclose(m.toDense(), denseAdmittance(graph))
+
+    def testParallelBuild(self):
+        def run(parallel: str, initCells: bool):
+            r, graph = buildJunctionRouter(parallel)
+            r.buildPartitions(initCells)
+            if not initCells:
+                r.initCells()
+            rng = np.random.default_rng(1)
+            changed = []
+            for _ in range(5):
+                x = (rng.random(8) * 60_000).astype(np.int64)
+                tn = rng.integers(0, 4, 8) * 10_000 + rng.integers(1, 3, 8)
+                r.dispatchPositions(x, tn)
+                changed.append(r.arrangePayloads(True).tolist())
+            store = graph.store
+            blocks = sorted(graph.edgeBlocks(), key=lambda b: b.offset)
+            return (
+                changed,
+                [(b.offset, b.source.tolist(), b.target.tolist(), b.re.tolist()) for b in blocks],
+                store.x[:store.size].tolist(),
+                store.lineIndex[:store.size].tolist(),
+                sorted(graph.nodeIds().tolist()),
+                [[(p.xLeft, p.xRight, p.leftSection.ids.tolist()) for p in ps] for ps in r.partitions.values()],
+            )
+
+        # ветви, построенные и расставленные в пуле, дают те же узлы, ребра и номера, что и последовательный режим
+        expected = run("serial", False)
+        for parallel in ("thread", "process"):
+            for initCells in (False, True):
+                self.assertEqual(run(parallel, initCells), expected)
+
+    def testSimulate(self):
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        # копия состояния ребер (концы и проводимость), которая ведется только по изменениям шагов
+        def edges():
+            res = {}
+            for b in graph.edgeBlocks():
+                res.update(zip(range(b.offset, b.offset + len(b)), zip(b.source.tolist(), b.target.tolist(), b.conductivities().tolist())))
+            return res
+
+        replica = edges()
+
+        rng = np.random.default_rng(3)
+
+        def schedule():
+            for _ in range(6):
+                x = (rng.random(8) * 60_000).astype(np.int64)
+                yield x, rng.integers(0, 4, 8) * 10_000 + rng.integers(1, 3, 8)
+
+        attached = set()
+        for delta in r.simulate(schedule()):
+            for e in delta.detachedEdgeIds.tolist():
+                del replica[e]
+            replica.update(zip(
+                delta.edgeIds.tolist(),
+                zip(delta.edgeSources.tolist(), delta.edgeTargets.tolist(), delta.conductivities.tolist())
+            ))
+            self.assertEqual(replica, edges())
+
+            attached -= set(delta.detachedPayloadNodes.tolist())
+            attached |= set(delta.attachedPayloadNodes.tolist())
+            nodes = delta.payloadNodes[delta.payloadNodes >= 0]
+            self.assertEqual(attached, set(nodes.tolist()))
+            self.assertTrue(set(nodes.tolist()) <= set(graph.nodeIds().tolist()))
+        self.assertEqual(delta.step, 5)
+
+    def testSnapshot(self):
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "schema.rtsn")
+            snapshot.save(r, path)
+            savedX = graph.store.x[:graph.store.size].tolist()
+            loaded = snapshot.load(path)
+            self.assertIsInstance(loaded.graph.store.x, np.memmap)
+            self.assertEqual(loaded.graph.nodeIds().tolist(), graph.nodeIds().tolist())
+            np.testing.assert_allclose(loaded.graph.admittanceMatrix().toDense(), graph.admittanceMatrix().toDense())
+
+            rng = np.random.default_rng(5)
+            schedule = [((rng.random(8) * 60_000).astype(np.int64), rng.integers(0, 4, 8) * 10_000 + rng.integers(1, 3, 8)) for _ in range(4)]
+            for expected, actual in zip(r.simulate(schedule), loaded.simulate(schedule)):
+                self.assertEqual(actual.edgeIds.tolist(), expected.edgeIds.tolist())
+                np.testing.assert_allclose(actual.conductivities, expected.conductivities)
+                self.assertEqual(actual.payloadNodes.tolist(), expected.payloadNodes.tolist())
+            # изменения загруженного состояния не попадают в файл
+            self.assertEqual(snapshot.load(path).graph.store.x.tolist(), savedX)
+            with open(path, "r+b") as f:
+                f.write(b"XXXX")
+            with self.assertRaises(Exception):
+                snapshot.load(path)
+
+    def testFork(self):
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        fork = r.fork()
+        self.assertIs(fork.graph.store.x, graph.store.x)
+
+        def schedule(seed: int):
+            rng = np.random.default_rng(seed)
+            return [((rng.random(8) * 60_000).astype(np.int64), rng.integers(0, 4, 8) * 10_000 + rng.integers(1, 3, 8)) for _ in range(4)]
+
+        def run(router: Router, seed: int):
+            deltas = [(d.edgeIds.tolist(), d.conductivities, d.payloadNodes.tolist()) for d in router.simulate(schedule(seed))]
+            return deltas, router.graph.admittanceMatrix().toDense()
+
+        # копия и оригинал по разным сценариям в разных потоках дают то же, что и независимо построенные трассировщики
+        with ThreadPoolExecutor(2) as ex:
+            forkResult = ex.submit(run, fork, 11)
+            parentResult = ex.submit(run, r, 12)
+            actual = [forkResult.result(), parentResult.result()]
+        for (deltas, matrix), seed in zip(actual, (11, 12)):
+            reference, _ = buildJunctionRouter()
+            reference.buildPartitions(True)
+            expectedDeltas, expectedMatrix = run(reference, seed)
+            for (edgeIds, c, payloadNodes), (expectedIds, expectedC, expectedNodes) in zip(deltas, expectedDeltas):
+                self.assertEqual(edgeIds, expectedIds)
+                np.testing.assert_allclose(c, expectedC)
+                self.assertEqual(payloadNodes, expectedNodes)
+            np.testing.assert_allclose(matrix, expectedMatrix)
+        self.assertIsNot(fork.graph.store.x, graph.store.x)
+        # сценарий копии не меняет узлы и проводимости оригинала
+        parentX = graph.store.x[:graph.store.size].copy()
+        parentMatrix = graph.admittanceMatrix().toDense()
+        fork2 = r.fork()
+        for _ in fork2.simulate(schedule(13)):
+            pass
+        np.testing.assert_array_equal(graph.store.x[:len(parentX)], parentX)
+        graph.admittanceMatrix().update()
+        np.testing.assert_allclose(graph.admittanceMatrix().toDense(), parentMatrix)
+
+        # нагрузки, распределенные до копирования, копируются вместе с ребрами: расстановка в копии не
+        # переподключает ребра оригинала к узлам копии хранилища
+        pls = [ISchemaPayload(31), ISchemaPayload(20)]
+        for pl, tn in zip(pls, (10_002, 30_001)):
+            pl.trackNumber = tn
+        r.dispatchPayloads(pls)
+        r.arrangePayloads(True)
+        fork3 = r.fork()
+        fork3.arrangePayloads(False)
+        self.assertTrue(all(pl.iplEdge.getSourceNode().store is graph.store for pl in pls))
+        self.assertEqual(graph.looseEdges(), {pl.iplEdge for pl in pls})
+        self.assertEqual(sorted(hash(e.getSourceNode()) for e in fork3.graph.looseEdges()), sorted(hash(pl.iplEdge.getSourceNode()) for pl in pls))
+        self.assertTrue(fork3.graph.looseEdges().isdisjoint(graph.looseEdges()))
+
+    def testIngest(self):
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        messages = [
+            [("a", 10_000, 1), ("b", 30_000, 10_002), ("a", 12_000, 1), ("c", 50_000, 20_001)],
+            [("b", 31_000, 10_002), ("c", None, 0), ("d", 5_000, 30_002)],
+            [("a", 20_000, 2)],
+        ]
+
+        async def feed():
+            for burst in messages:
+                for train, x, track in burst:
+                    yield json.dumps({"train": train, "x": x, "track": track})
+                yield "not a message"
+                # без пути, с неизвестной ветвью, с линией сверх числа путей ветви
+                yield json.dumps({"train": "e", "x": 15_000})
+                yield json.dumps({"train": "e", "x": 15_000, "track": 40_001})
+                yield json.dumps({"train": "e", "x": 15_000, "track": 10_004})
+                await asyncio.sleep(0.1)
+
+        ticks = []
+        ingestor = PositionIngestor(r, tick=0.02, onDelta=lambda t, d: ticks.append((t, d)))
+        stats = asyncio.run(ingestor.run(feed()))
+        self.assertEqual((stats.messages, stats.malformed, stats.coalesced), (8, 12, 1))
+        self.assertEqual(stats.applied + stats.dropped, stats.ticks)
+        self.assertEqual(ingestor.positions(), {"a": (20_000, 2), "b": (31_000, 10_002), "d": (5_000, 30_002)})
+        t, delta = ticks[-1]
+        self.assertEqual(t.trains, ("a", "b", "d"))
+        # нагрузки подключены к узлам с их координатами и путями
+        store = graph.store
+        self.assertEqual(store.x[delta.payloadNodes].tolist(), t.x.tolist())
+        self.assertEqual(store.lineIndex[delta.payloadNodes].tolist(), t.trackNumbers.tolist())
+        with self.assertRaises(Exception):
+            PositionIngestor(r, policy="latest")
+
+        # ошибка обработчика шага прекращает прием и передается из run, а не останавливает очередь навсегда
+        def fail(t, d):
+            raise ValueError(t.number)
+
+        async def failing():
+            ingestor = PositionIngestor(r, tick=0.01, maxPending=1, onDelta=fail)
+            return await asyncio.wait_for(ingestor.run(feed()), 5)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(failing())
+
+    def testPipeline(self):
+        def schedule():
+            rng = np.random.default_rng(5)
+            for _ in range(8):
+                x = (rng.random(8) * 60_000).astype(np.int64)
+                yield x, rng.integers(0, 4, 8) * 10_000 + rng.integers(1, 3, 8)
+
+        reference, graph = buildJunctionRouter()
+        reference.buildPartitions(True)
+        reference.planCapacity(schedule())
+        expected = []
+        for delta in reference.simulate(schedule()):
+            expected.append((delta.edgeIds.tolist(), delta.payloadNodes.tolist(), graph.admittanceMatrix(delta.edgeIds).toDense()))
+
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        r.planCapacity(schedule())
+        order = []
+
+        def consume(step):
+            # расстановка следующих шагов не меняет снимок и матрицу уже собранного шага
+            order.append(step.delta.step)
+            return step.results[0].toDense()
+
+        steps = list(StepPipeline(r, [AdmittanceAssembly(), consume], depth=1).run(schedule()))
+        self.assertEqual([s.delta.step for s in steps], list(range(8)))
+        self.assertEqual(order, list(range(8)))
+        for step, (edgeIds, payloadNodes, matrix) in zip(steps, expected):
+            self.assertEqual(step.delta.edgeIds.tolist(), edgeIds)
+            self.assertEqual(step.delta.payloadNodes.tolist(), payloadNodes)
+            np.testing.assert_allclose(step.results[1], matrix)
+            np.testing.assert_allclose(step.results[0].toDense(), matrix)
+        # снимки соседних шагов разделяют блоки, ребра которых не изменились
+        for prev, step in zip(steps, steps[1:]):
+            shared = {id(b) for b in prev.graph.edgeBlocks()}
+            copied = [b for b in step.graph.edgeBlocks() if id(b) not in shared]
+            self.assertLessEqual(len(copied), len(step.delta.edgeIds))
+            self.assertLess(len(copied), len(shared))
+
+        def fail(step):
+            if step.delta.step == 2:
+                raise ValueError(step.delta.step)
+
+        with self.assertRaises(ValueError):
+            for _ in StepPipeline(r, [fail]).run(schedule()):
+                pass
+        # досрочно прерванный конвейер останавливает свои потоки
+        for _ in StepPipeline(r, [AdmittanceAssembly()]).run(schedule()):
+            break
+        with self.assertRaises(Exception):
+            StepPipeline(r, depth=0)
+
+    def testBenchmark(self):
+        a = benchmark.generateSchema(200, branches=2, seed=1)
+        b = benchmark.generateSchema(200, branches=2, seed=1)
+        self.assertEqual(a.graph.nodeIds().tolist(), b.graph.nodeIds().tolist())
+        np.testing.assert_array_equal(a.graph.store.x, b.graph.store.x)
+        schedule = benchmark.generateSchedule(a, trains=5, steps=4, seed=1)
+        for x, _ in schedule:
+            self.assertTrue(np.all((x >= 0) & (x <= max(a.lengths) * 1000)))
+        res = benchmark.run(200, branches=2, trains=5, steps=3, seed=1)
+        self.assertEqual(
+            set(res["phases"]), {"buildPartitions", "initCells", "assembleMatrix", "arrangePayloads", "updateConductivities"}
+        )
+        self.assertEqual(res["phases"]["arrangePayloads"]["calls"], 3)
+        self.assertGreater(res["phases"]["initCells"]["peakBytes"], 0)
+        json.dumps(res)
+
+    def testMetrics(self):
+        r, graph = buildJunctionRouter()
+        rng = np.random.default_rng(3)
+        schedule = [((rng.random(8) * 60_000).astype(np.int64), rng.integers(0, 4, 8) * 10_000 + rng.integers(1, 3, 8)) for _ in range(3)]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.json")
+            metrics.enable(trace=path)
+            try:
+                r.buildPartitions(True)
+                for _ in r.simulate(schedule):
+                    pass
+            finally:
+                metrics.disable()
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+        snap = metrics.snapshot()
+        for name in ("cell.edgesRecomputed", "lattice.condEdges", "partition.payloadsAttached", "router.partitionsArranged", "builder.queuePops",
+                     "cell.pulls", "cell.cascadeCells"):
+            self.assertGreater(snap.counters.get(name, 0), 0, name)
+        self.assertGreater(snap.maxima.get("cell.cascadeDepth", 0), 0)
+        self.assertEqual(snap.phaseCalls["arrangePayloads"], 3)
+        self.assertEqual([s.step for s in snap.steps], [0, 1, 2])
+        self.assertEqual(sum(s.counters.get("partition.payloadsAttached", 0) for s in snap.steps), snap.counters["partition.payloadsAttached"])
+        self.assertIn("arrangePayloads", snap.steps[0].phases)
+        self.assertEqual(len([e for e in events if e["ph"] == "C"]), 3)
+        self.assertIn("buildPartitions", {e["name"] for e in events if e["ph"] == "X"})
+        # выключенные метрики ничего не накапливают
+        for _ in r.simulate(schedule):
+            pass
+        self.assertEqual(metrics.snapshot().counters, snap.counters)
+
+    def testGraphIndex(self):
+        r, graph = buildJunctionRouter()
+        r.buildPartitions(True)
+        store = graph.store
+        # общий узел один на все ветви
+        self.assertEqual({p.zeroNode.id for partitions in r.partitions.values() for p in partitions}, {NodeStore.GROUND})
+        self.assertEqual(int(np.count_nonzero(store.lineIndex[1:store.size] % 10_000 == 0)), 0)
+
+        rng = np.random.default_rng(4)
+        for count in (6, 3, 5, 0, 4):
+            pls = []
+            for x, tn in zip(rng.random(count) * 60, rng.integers(0, 4, count) * 10_000 + rng.integers(1, 3, count)):
+                pl = ISchemaPayload(float(x))
+                pl.trackNumber = int(tn)
+                pls.append(pl)
+            r.dispatchPayloads(pls)
+            r.arrangePayloads(True)
+            # в графе только ребра нагрузок текущего шага, попавших в разделы
+            inside = r.payloadNodes(len(pls)) >= 0
+            self.assertEqual(graph.looseEdges(), {pl.iplEdge for pl, ok in zip(pls, inside.tolist()) if ok})
+
+            expected = {}
+            for e in graph.edges():
+                s, t = hash(e.getSourceNode()), hash(e.getTargetNode())
+                expected.setdefault(s, []).append(t)
+                expected.setdefault(t, []).append(s)
+            for id in graph.nodeIds().tolist():
+                self.assertEqual(graph.degree(id), len(expected.get(id, [])))
+                self.assertEqual(graph.neighbors(id).tolist(), sorted(set(expected.get(id, []))))
+
+        edge = next(iter(graph.looseEdges()))
+        replacement = ICircuitEdge(2 + 0j)
+        graph.replaceEdge(edge, replacement)
+        self.assertEqual(replacement.getSourceNode(), edge.getSourceNode())
+        self.assertEqual(replacement.getTargetNode().id, NodeStore.GROUND)
+        with self.assertRaises(Exception):
+            graph.removeEdge(edge)
+
+    def testPayloadMovesLeft(self):
+        r, graph = buildTestRouter()
+        r.buildPartitions(True)
+        a, q = ISchemaPayload(7), ISchemaPayload(9)
+        r.dispatchPayloads([a, q])
+        r.arrangePayloads(True)
+        # нагрузка переходит в раздел левее, прежний раздел остается занятым другой нагрузкой
+        a.x = 4000
+        r.dispatchPayloads([a, q])
+        r.arrangePayloads(True)
+        self.assertEqual(graph.looseEdges(), {a.iplEdge, q.iplEdge})
+        self.assertEqual(graph.store.x[hash(a.iplEdge.getSourceNode())], 4000)
+        r.dispatchPayloads([q])
+        r.arrangePayloads(True)
+        self.assertEqual(graph.looseEdges(), {q.iplEdge})
+
+    def testChainLookup(self):
+        chain = BranchNetworkChain.fromAcNetworkDto([AcNetworkDto(10, 3), AcNetworkDto(21, 2), AcNetworkDto(24, 3)])
+        xs = np.array([-5000, 0, 9999, 10_000, 15_000, 21_000, 23_999, 24_000])
+        expected = [0, 0, 0, 1, 1, 2, 2, 2]
+        self.assertEqual(chain.findChainLinks(xs).tolist(), expected)
+        for x, i in zip(xs.tolist(), expected):
+            self.assertIs(chain.findChainLink(x), chain.chainLinks[i])
+        with self.assertRaises(Exception):
+            chain.findChainLink(24_001)
+        with self.assertRaises(Exception):
+            chain.findChainLinks(np.array([0, 24_001]))
+
+    def testReroute(self):
+        schema = benchmark.generateSchema(400, branches=2, seed=5)
+        graph = schema.graph
+        store = graph.store
+        r = Router(graph, schema.networks)
+        r.buildPartitions(True)
+
+        def rebuilt() -> Router:
+            fresh = NodeStore()
+            ids = np.sort(graph.nodesBeforeWiring())
+            nodes = [
+                ICircuitNode(int(store.lineIndex[id]), int(store.x[id]) / 1000, bool(store.breaking[id]), store=fresh)
+                for id in ids.tolist()
+            ]
+            res = Router(Graph(nodes, fresh), r.networks)
+            res.buildPartitions(True)
+            return res
+
+        def key(s: NodeStore, id: int) -> Tuple[int, int, bool]:
+            return int(s.lineIndex[id]), int(s.x[id]), bool(s.duplicatedBreakingNode[id])
+
+        def layout(router: Router):
+            g = router.graph
+            partitions = {
+                b: [(p.xLeft, p.xRight, [key(g.store, id) for id in p.leftSection.ids.tolist()],
+                     [key(g.store, id) for id in p.rightSection.ids.tolist()]) for p in pp]
+                for b, pp in router.partitions.items()
+            }
+            edges = sorted(
+                tuple(sorted((key(g.store, s), key(g.store, t)))) + (round(re, 9), round(im, 9))
+                for b in g.edgeBlocks()
+                for s, t, re, im in zip(b.source.tolist(), b.target.tolist(), b.re.tolist(), b.im.tolist())
+            )
+            return partitions, edges, sorted(key(g.store, id) for id in g.nodeIds().tolist())
+
+        def edgeIds() -> Set[int]:
+            return {i for b in graph.edgeBlocks() for i in range(b.offset, b.offset + len(b))}
+
+        def check(edit: Callable[[], RouteEdit]) -> RouteEdit:
+            nodesBefore, edgesBefore = set(graph.nodeIds().tolist()), edgeIds()
+            res = edit()
+            self.assertEqual(layout(r), layout(rebuilt()))
+            self.assertEqual(set(graph.nodeIds().tolist()), nodesBefore - set(res.removedNodeIds.tolist()) | set(res.addedNodeIds.tolist()))
+            self.assertEqual(edgeIds(), edgesBefore - set(res.removedEdgeIds.tolist()) | set(res.addedEdgeIds.tolist()))
+            return res
+
+        total = len(r.partitions[0])
+        lines = graph.nodesBeforeWiring()
+        ids = lines[store.lineIndex[lines] == 1]
+        middle = int(ids[np.argsort(store.x[ids])[len(ids) // 2]])
+        # разрыв в середине ветви перестраивает несколько разделов рядом с узлом
+        res = check(lambda: r.setBreaking(middle, not bool(store.breaking[middle])))
+        self.assertLessEqual(res.removedPartitions, 4)
+        self.assertLess(res.removedPartitions, total // 10)
+        self.assertGreater(len(res.addedNodeIds), 0)
+        check(lambda: r.setBreaking(middle, not bool(store.breaking[middle])))
+        added = ICircuitNode(2, (int(store.x[middle]) + 137) / 1000, store=store)
+        check(lambda: r.addNode(added))
+        check(lambda: r.removeNode(middle))
+        check(lambda: r.removeNode(added.id))
+        # замена звена КС посередине ветви и удаление звена
+        networks = list(r.networks[1])
+        k = len(networks) // 2
+        networks[k] = AcNetworkDto(networks[k].coordinate, 2, benchmark.resistivities(2))
+        check(lambda: r.setNetwork(1, networks))
+        check(lambda: r.setNetwork(1, networks[:k] + networks[k + 1:]))
+        with self.assertRaises(Exception):
+            r.removeNode(middle)
+
+    def testStreamPartitions(self):
+        schema = benchmark.generateSchema(2000, branches=2, seed=3)
+        graph = schema.graph
+        store = graph.store
+        r = Router(graph, schema.networks)
+        r.buildPartitions()
+
+        def layout(s: NodeStore, partitions) -> List:
+            return [
+                (p.xLeft, p.xRight,
+                 [(int(s.lineIndex[id]), int(s.x[id]), bool(s.duplicatedBreakingNode[id])) for id in p.leftSection.ids.tolist()],
+                 [(int(s.lineIndex[id]), int(s.x[id]), bool(s.duplicatedBreakingNode[id])) for id in p.rightSection.ids.tolist()])
+                for p in partitions
+            ]
+
+        ids = graph.nodesBeforeWiring()
+        for branchIndex, networks in schema.networks.items():
+            branch = ids[store.lineIndex[ids] // 10_000 == branchIndex]
+            branch = branch[np.lexsort((branch, store.x[branch]))]
+            records = list(zip(store.lineIndex[branch].tolist(), store.x[branch].tolist(), store.breaking[branch].tolist()))
+            read = []
+
+            def nodes():
+                for k, record in enumerate(records):
+                    read.append(k)
+                    yield record
+
+            fresh = NodeStore()
+            stream = streamPartitions(branchIndex, nodes(), iter(networks), fresh)
+            first = next(stream)
+            # первый раздел выдается до чтения всей ветви
+            self.assertLess(len(read), len(records) // 10)
+            self.assertEqual(layout(fresh, [first] + list(stream)), layout(store, r.partitions[branchIndex]))
+            self.assertEqual(len(read), len(records))
+
+        with self.assertRaises(Exception):
+            list(streamPartitions(0, iter([(1, 2000, False), (2, 1000, False)]), iter([AcNetworkDto(10, 2)])))
+
+        def window(km: int) -> Tuple[int, int, int, int]:
+            def nodes():
+                for x in range(0, km * 1000, 50):
+                    for li in (1, 2):
+                        yield li, x, x % 1000 == 500
+
+            fresh = NodeStore()
+            g = Graph([], fresh)
+            tracemalloc.start()
+            try:
+                for p in streamPartitions(0, nodes(), (AcNetworkDto(k, 2) for k in range(1, km + 1)), fresh, g):
+                    p.initCells()
+                    p.release()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            return peak, fresh.size, len(g.nodeIds()), len(g.edgeBlocks())
+
+        # отпущенные разделы возвращают узлы хранилищу и удаляют блоки из графа: память не растет с длиной ветви
+        short, long = window(10), window(40)
+        self.assertEqual(short[1:], long[1:])
+        self.assertEqual(long[3], 0)
+        self.assertLess(long[0], 1.5 * short[0])
+
+    def testReducedAdmittance(self):
+        schema = benchmark.generateSchema(2000, branches=2, seed=1)
+        graph = schema.graph
+        # решетки без таблиц сопротивлений замыкают каждый узел на общий -- полная система невырождена
+        networks = {b: [AcNetworkDto(n.coordinate, n.trackQty) for n in ntw] for b, ntw in schema.networks.items()}
+        r = Router(graph, networks)
+        r.buildPartitions(True)
+        rng = np.random.default_rng(2)
+        idle = r.partitions[0][0]
+        for x, trackNumbers in benchmark.generateSchedule(schema, 6, 3, seed=1):
+            pls = []
+            for xi, tn in zip(x.tolist(), trackNumbers.tolist()):
+                pl = ISchemaPayload(xi / 1000)
+                pl.trackNumber = tn
+                pls.append(pl)
+            r.dispatchPayloads(pls)
+            r.arrangePayloads(True)
+            matrix = graph.admittanceMatrix()
+            matrix.update()
+            reduced = r.reducedAdmittance()
+            self.assertLess(reduced.shape[0], matrix.shape[0] // 5)
+            self.assertLess(reduced.nnz(), matrix.nnz() // 20)
+            rows = matrix.rowOf(reduced.order)
+            self.assertTrue(np.all(rows >= 0))
+            rhs = np.zeros(matrix.shape[0], dtype=np.complex128)
+            rhs[rows] = rng.random(len(rows))
+            np.testing.assert_allclose(BandedLU(reduced).solve(rhs[rows]), BandedLU(matrix).solve(rhs)[rows], atol=1e-12)
+            # узлы подключения нагрузок остаются в системе
+            nodes = r.payloadNodes(len(pls))
+            self.assertTrue(np.all(reduced.rowOf(nodes[nodes >= 0]) >= 0))
+
+        # многополюсник раздела без нагрузок кэшируется до появления в нем нагрузки
+        eq = idle.equivalent()
+        self.assertIs(idle.equivalent(), eq)
+        self.assertEqual(eq.y.shape, (2 * idle.leftSection.size(),) * 2)
+        pl = ISchemaPayload((idle.xLeft + idle.xRight) / 2000)
+        pl.trackNumber = int(graph.store.lineIndex[idle.leftSection.ids[0]])
+        r.dispatchPayloads([pl])
+        r.arrangePayloads(True)
+        self.assertIsNot(idle.equivalent(), eq)
+        self.assertEqual(idle.equivalent().y.shape, eq.y.shape)
+        keep = r.reducedAdmittance().eliminated[:3]
+        self.assertTrue(np.all(r.reducedAdmittance(keep).rowOf(keep) >= 0))
+
+
+class CountingLattice(AcNetworkLattice):
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls = 0
+
+    def condBatch(self, lineIndex1, side1, lineIndex2, side2, length):
+        self.calls += 1
+        return super().condBatch(lineIndex1, side1, lineIndex2, side2, length)
+
+
+class LengthLattice(AcNetworkLattice):
+    """ Проводимость равна длине ячейки -- удобно для проверки пересчета. """
+
+    def condBatch(self, lineIndex1, side1, lineIndex2, side2, length):
+        return length.astype(complex)
+
+
+EXPECTED_PARTITIONS = (
+    "[{ left: [0, 0, 0], right: [1000, 1000, 1000] }, { left: [1000, 1000, 1000], right: [!2000, !2000, !2000] }, "
+    "{ left: [~2000, ~2000, ~2000], right: [4000, 4000, 4000] }, { left: [4000, 4000, 4000], right: [5000, 5000, 5000] }, "
+    "{ left: [5000, 5000, 5000], right: [6000, 6000, 6000] }, { left: [6000, 6000, 6000], right: [10000, 10000, 10000] }, "
+    "{ left: [10000, 10000], right: [13000, 13000] }, { left: [13000, 13000], right: [15000, 15000] }, "
+    "{ left: [15000, 15000], right: [20000, 20000] }, { left: [20000, 20000], right: [21000, 21000] }, "
+    "{ left: [21000, 21000, 21000], right: [22000, 22000, !22000] }, { left: [22000, 22000, ~22000], right: [24000, 24000, 24000] }]"
+)
+
+
+def buildTestRouter(ordering: str = "coordinate"):
+    p = nodeProducer(1)
+    n1 = [p(1), p(2, True), p(5), p(13), p(15), p(20)]
+
+    p = nodeProducer(2)
+    n2 = [p(0), p(2, True), p(4), p(5)]
+
+    p = nodeProducer(3)
+    n3 = [p(2, True), p(6), p(17), p(22, True), p(25)]
+
+    graph = Graph(n1 + n2 + n3)
+    ntw = {0: [AcNetworkDto(10, 3), AcNetworkDto(21, 2), AcNetworkDto(24, 3)]}
+    return Router(graph, ntw, ordering), graph
+
+
+def buildJunctionRouter(parallel: str = "serial"):
+    """ Узел из четырех ветвей по три линии со своим хранилищем узлов. """
+    z = {(1, 1): 0.2 + 0.6j, (2, 2): 0.2 + 0.6j, (3, 3): 0.25 + 0.7j, (1, 2): 0.05 + 0.3j, (1, 3): 0.04 + 0.2j, (2, 3): 0.05 + 0.25j}
+    store = NodeStore()
+    rng = np.random.default_rng(7)
+    nodes = []
+    networks = {}
+    for branchIndex in range(4):
+        for li in range(1, 4):
+            for x in np.append(np.sort(rng.random(6) * 60), 70):
+                nodes.append(ICircuitNode(10_000 * branchIndex + li, x, bool(rng.random() < 0.2), store=store))
+        networks[branchIndex] = [AcNetworkDto(25, 3, z), AcNetworkDto(45, 2, {k: v for k, v in z.items() if max(k) <= 2}), AcNetworkDto(70, 3, z)]
+    graph = Graph(nodes, store)
+    return Router(graph, networks, parallel=parallel, workers=3), graph
+
+
+def denseAdmittance(graph: Graph) -> np.ndarray:
+    """ Матрица узловых проводимостей, собранная поэлементно по ребрам графа. """
+    order = graph.numbering()
+    row = {id: k for k, id in enumerate(order.tolist())}
+    res = np.zeros((len(order), len(order)), dtype=np.complex128)
+    for e in graph.edges():
+        i = row.get(hash(e.getSourceNode()))
+        j = row.get(hash(e.getTargetNode()))
+        for a, b, sign in ((i, i, 1), (j, j, 1), (i, j, -1), (j, i, -1)):
+            if a is not None and b is not None:
+                res[a, b] += sign * e.c
+    return res
+
 
 def nodeProducer(tn: int):
     def _f(x: float, breaking=False):
@@ -0,0 +1,182 @@
+import json
+import struct
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from cell import Cell
+from context import AcNetworkDto, EdgeBlock, NodeStore
+from graph import Graph
+from network import NetworkSection
+from partition import Partition
+from router import Router
+
+
+# Снимок трассированной топологии: заголовок (MAGIC, версия формата, длина оглавления), оглавление в JSON и массивы,
+# выровненные по ALIGN байт. Оглавление содержит описания КС ветвей, способ нумерации и расположение массивов.
+MAGIC = b"RTSN"
+FORMAT_VERSION = 1
+ALIGN = 64
+HEADER = struct.Struct("<4sIQ")
+# массивы EdgeBlock и их типы
+EDGE_FIELDS = {
+    "source": np.int64, "target": np.int64, "line1": np.int32, "side1": np.int8,
+    "line2": np.int32, "side2": np.int8, "re": np.float64, "im": np.float64,
+}
+
+
+def save(router: Router, path: str) -> None:
+    """
+    Сохранить разделы, ячейки, ребра и узлы трассировщика в файл. Нагрузки разделов не сохраняются: снимок
+    описывает статическую топологию.
+    """
+    graph = router.graph
+    store = graph.store
+    sectionIndex: Dict[int, int] = {}
+    sections: List[NetworkSection] = []
+
+    def section(s: NetworkSection) -> int:
+        k = sectionIndex.get(id(s))
+        if k is None:
+            k = sectionIndex[id(s)] = len(sections)
+            sections.append(s)
+        return k
+
+    blocks = sorted(graph.edgeBlocks(), key=lambda b: b.offset)
+    blockIndex = {id(b): k for k, b in enumerate(blocks)}
+    partitionRows: List[Tuple[int, ...]] = []
+    cellRows: List[Tuple[int, ...]] = []
+    for branchIndex, partitions in router.partitions.items():
+        for p in partitions:
+            partitionRows.append((
+                branchIndex, p.xLeft, p.xRight, section(p.leftSection), section(p.rightSection), p.zeroNode.id, p.capacity()
+            ))
+            for c in p.cells():
+                cellRows.append((
+                    len(partitionRows) - 1, c.xLeft, c.xRight, section(c.leftSection), section(c.rightSection),
+                    blockIndex[id(c.edgeBlock)]
+                ))
+    partitionTable = np.array(partitionRows, dtype=np.int64).reshape(-1, 7)
+    cellTable = np.array(cellRows, dtype=np.int64).reshape(-1, 6)
+
+    arrays: Dict[str, np.ndarray] = {
+        "nodes.lineIndex": store.lineIndex[:store.size],
+        "nodes.x": store.x[:store.size],
+        "nodes.breaking": store.breaking[:store.size],
+        "nodes.duplicatedBreakingNode": store.duplicatedBreakingNode[:store.size],
+        "graph.nodes": np.sort(graph.nodeIds()),
+        "graph.nodesBeforeWiring": np.sort(graph.nodesBeforeWiring()),
+        "sections.ids": _concat([s.ids for s in sections], np.int64),
+        "sections.bounds": _bounds([len(s.ids) for s in sections]),
+        "blocks.offset": np.array([b.offset for b in blocks], dtype=np.int64),
+        "blocks.bounds": _bounds([len(b) for b in blocks]),
+        "partitions": partitionTable,
+        "cells": cellTable,
+    }
+    for name, dtype in EDGE_FIELDS.items():
+        arrays["edges." + name] = _concat([getattr(b, name) for b in blocks], dtype)
+
+    layout = {}
+    offset = 0
+    for name, a in arrays.items():
+        layout[name] = [a.dtype.str, list(a.shape), offset]
+        offset = _align(offset + a.nbytes)
+    manifest = json.dumps({
+        "ordering": router.ordering,
+        "networks": {
+            str(branchIndex): [[n.coordinate, n.trackQty, _resistivities(n)] for n in ntw]
+            for branchIndex, ntw in router.networks.items()
+        },
+        "arrays": layout,
+    }).encode("utf-8")
+    dataStart = _align(HEADER.size + len(manifest))
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(manifest)))
+        f.write(manifest)
+        for name, a in arrays.items():
+            f.seek(dataStart + layout[name][2])
+            f.write(np.ascontiguousarray(a).tobytes())
+        f.truncate(dataStart + offset)
+
+
+def load(path: str, parallel: str = "serial", workers: int | None = None) -> Router:
+    """
+    Восстановить трассировщик из снимка. Массивы узлов, сечений и ребер отображаются в память в режиме
+    копирования при записи: процессы, загрузившие один снимок, разделяют страницы файла, а изменения (перемещение
+    сечений, пересчет проводимостей) остаются локальными. Решетки проводимостей строятся заново по описаниям КС.
+    """
+    with open(path, "rb") as f:
+        magic, version, manifestLength = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise Exception("Файл не является снимком трассировщика")
+        if version != FORMAT_VERSION:
+            raise Exception(f"Неподдерживаемая версия снимка: {version}")
+        manifest = json.loads(f.read(manifestLength).decode("utf-8"))
+    dataStart = _align(HEADER.size + manifestLength)
+    arrays: Dict[str, np.ndarray] = {}
+    for name, (dtype, shape, offset) in manifest["arrays"].items():
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="c", offset=dataStart + offset, shape=tuple(shape))
+
+    store = NodeStore.fromArrays(
+        arrays["nodes.lineIndex"], arrays["nodes.x"], arrays["nodes.breaking"], arrays["nodes.duplicatedBreakingNode"]
+    )
+    graph = Graph.fromIds(arrays["graph.nodes"], arrays["graph.nodesBeforeWiring"], store)
+    networks = {
+        int(branchIndex): [AcNetworkDto(x, trackQty, _resistivitiesFromJson(z)) for x, trackQty, z in ntw]
+        for branchIndex, ntw in manifest["networks"].items()
+    }
+    router = Router(graph, networks, manifest["ordering"], parallel, workers)
+
+    sectionIds, sectionBounds = arrays["sections.ids"], arrays["sections.bounds"].tolist()
+    sections = [NetworkSection.fromIds(sectionIds[a:b], store) for a, b in zip(sectionBounds[:-1], sectionBounds[1:])]
+    blockBounds = arrays["blocks.bounds"].tolist()
+    blocks = []
+    for k, (a, b) in enumerate(zip(blockBounds[:-1], blockBounds[1:])):
+        block = EdgeBlock.fromArrays(
+            *(arrays["edges." + name][a:b] for name in EDGE_FIELDS), store, int(arrays["blocks.offset"][k])  # type: ignore
+        )
+        graph.addEdgeBlock(block)
+        blocks.append(block)
+
+    partitions: Dict[int, List[Partition]] = {int(b): [] for b in networks}
+    allPartitions: List[Partition] = []
+    for branchIndex, xLeft, xRight, left, right, zeroNode, capacity in arrays["partitions"].tolist():
+        lattice = router.chain(branchIndex).findChainLink(xLeft).lattice
+        p = Partition(xLeft, xRight, sections[left], sections[right], store.node(zeroNode), lattice, graph)
+        partitions[branchIndex].append(p)
+        allPartitions.append(p)
+    cells: List[List[Cell]] = [[] for _ in allPartitions]
+    for k, xLeft, xRight, left, right, block in arrays["cells"].tolist():
+        p = allPartitions[k]
+        cells[k].append(Cell.restore(xLeft, xRight, sections[left], sections[right], p.lattice, blocks[block]))
+    for p, cc, capacity in zip(allPartitions, cells, arrays["partitions"][:, 6].tolist()):
+        p.restoreCells(cc, capacity)
+    router.restorePartitions(partitions)
+    return router
+
+
+def _align(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _bounds(lengths: List[int]) -> np.ndarray:
+    return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))).astype(np.int64)
+
+
+def _concat(arrays: List[np.ndarray], dtype) -> np.ndarray:
+    return np.concatenate(arrays).astype(dtype, copy=False) if len(arrays) > 0 else np.empty(0, dtype=dtype)
+
+
+def _resistivities(ntw: AcNetworkDto) -> List[List[float]] | None:
+    if ntw.resistivities is None:
+        return None
+    return [[li1, li2, r.real, r.imag] for (li1, li2), r in ntw.resistivities.items()]
+
+
+def _resistivitiesFromJson(z: List[List[float]] | None) -> Dict[Tuple[int, int], complex] | None:
+    if z is None:
+        return None
+    return {(int(li1), int(li2)): complex(re, im) for li1, li2, re, im in z}
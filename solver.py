@@ -0,0 +1,118 @@
+import numpy as np
+
+from admittance import AdmittanceMatrix
+
+
+class BandedLU:
+    """
+    LU-разложение матрицы проводимостей без выбора ведущего элемента в ленточном хранении.
+    Матрица с полушириной ленты b хранится построчно в плоском массиве: элемент (i, j) лежит по адресу
+    i * (2b + 1) + j - i + b; в конце массива b дополнительных нулевых строк, чтобы шаг исключения у правого края
+    не требовал усечения. При исключении k-го узла изменяются элементы k * (2b + 1) + P, где P -- постоянная
+    матрица смещений размера b x b, так что шаг исключения -- одна векторная операция.
+    Структура ленты (ширина, адреса элементов CSR в ленте) сохраняется между шагами расчета. Если изменились
+    только значения, разложение пересчитывается с первой затронутой строки: строки и столбцы L и U с меньшими
+    номерами от изменений не зависят. При нумерации по координате это хвостовой блок за изменившимися ячейками.
+    Шаблон матрицы, а с ним лента и нумерация узлов, меняется только при изменении емкости разделов.
+    Матрица проводимостей с ребрами на общий узел диагонально преобладает, поэтому ведущий элемент не выбирается.
+    Узлы без ребер (например, исходные узлы, замененные копиями) получают единичную диагональ и нулевое решение.
+    """
+
+    def __init__(self, matrix: AdmittanceMatrix) -> None:
+        self.matrix = matrix
+        self.factorStart = 0  # первая строка, с которой пересчитывалось разложение при последнем обновлении
+        self.__analyze()
+        self.__factor(0)
+
+    @property
+    def bandwidth(self) -> int:
+        return self.__b
+
+    def update(self) -> int:
+        """
+        Перенести в разложение текущие значения матрицы. Возвращает номер первой пересчитанной строки (размер
+        матрицы, если значения не изменились). При изменении шаблона матрицы разложение строится заново.
+        """
+        m = self.matrix
+        if m.version != self.__version or len(m.data) != len(self.__data):
+            self.__analyze()
+            self.__factor(0)
+            return 0
+        changed = np.flatnonzero(m.data != self.__data)
+        if len(changed) == 0:
+            self.factorStart = self.__n
+            return self.__n
+        start = int(np.min(np.minimum(self.__rows[changed], m.indices[changed])))
+        self.__data = m.data.copy()
+        self.__a[self.__pos] = self.__data
+        self.__a[self.__floating] = 1
+        self.__factor(start)
+        return start
+
+    def solve(self, rhs: np.ndarray) -> np.ndarray:
+        """ Решить систему с правой частью rhs (вектор или матрица, столбцы -- правые части). """
+        n, b, w = self.__n, self.__b, self.__w
+        lu = self.__lu
+        rhs = np.asarray(rhs)
+        y = np.zeros((n + b,) + rhs.shape[1:], dtype=np.complex128)
+        y[:n] = rhs
+        lower = np.arange(1, b + 1) * 2 * b + b
+        upper = np.arange(b + 1, 2 * b + 1)
+        for k in range(n):
+            y[k + 1:k + b + 1] -= np.multiply.outer(lu[k * w + lower], y[k])
+        for k in range(n - 1, -1, -1):
+            y[k] = (y[k] - lu[k * w + upper] @ y[k + 1:k + b + 1]) / lu[k * w + b]
+        return y[:n]
+
+    def __analyze(self) -> None:
+        """ Определить ширину ленты и адреса элементов CSR в ленточном хранении. """
+        m = self.matrix
+        n = m.shape[0]
+        rows = np.repeat(np.arange(n), np.diff(m.indptr))
+        b = int(np.max(np.abs(rows - m.indices))) if len(rows) > 0 else 0
+        w = 2 * b + 1
+        self.__version = m.version
+        self.__n, self.__b, self.__w = n, b, w
+        self.__rows = rows
+        self.__pos = rows * w + m.indices - rows + b
+        self.__a = np.zeros((n + b) * w, dtype=np.complex128)
+        self.__data = m.data.copy()
+        self.__a[self.__pos] = self.__data
+        # диагональ узлов без ребер
+        empty = np.ones(n, dtype=np.bool_)
+        empty[rows[self.__data != 0]] = False
+        self.__floating = np.flatnonzero(empty) * w + b
+        self.__a[self.__floating] = 1
+        self.__lu = self.__a.copy()
+        d = np.arange(1, b + 1)
+        self.__lower = d * 2 * b + b
+        self.__p = d[:, None] * 2 * b + d[None, :] + b
+
+    def __factor(self, start: int) -> None:
+        """ Исключить узлы start, start + 1, ... Строки и столбцы L и U с номерами меньше start не меняются. """
+        n, b, w = self.__n, self.__b, self.__w
+        lu = self.__lu
+        self.factorStart = start
+        if start > 0:
+            # элементы (i, j), i, j >= start: исходные значения минус вклады уже исключенных узлов start - b .. start - 1
+            band = lu.reshape(n + b, w)
+            a = self.__a.reshape(n + b, w)
+            for i in range(start, start + b):
+                band[i, start - i + b:] = a[i, start - i + b:]
+            band[start + b:] = a[start + b:]
+            for k in range(max(start - b, 0), start):
+                t = start - k - 1
+                base = k * w
+                lu[base + self.__p[t:, t:]] -= np.outer(lu[base + self.__lower[t:]], lu[base + b + 1 + t:base + w])
+        else:
+            lu[:] = self.__a
+        lower, p = self.__lower, self.__p
+        for k in range(start, n):
+            base = k * w
+            pivot = lu[base + b]
+            if pivot == 0:
+                raise Exception(f"Нулевой ведущий элемент в строке {k}")
+            col = lu[base + lower] / pivot
+            lu[base + lower] = col
+            lu[base + p] -= np.outer(col, lu[base + b + 1:base + w])
+